@@ -0,0 +1,62 @@
+# Measures the cold start cost of the husmow entry points: the time spent importing their modules in a
+# fresh interpreter, and the heavy modules they load.
+#
+#     python benchmarks/import_time.py [--runs 10]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = [
+    ('husmow', 'import pyhusmow'),
+    ('husmow_logger', 'import pyhusmow.status_logger'),
+    ('husmow server', 'import pyhusmow.server'),
+]
+HEAVY_MODULES = ['requests', 'urllib3', 'dateutil', 'http.server', 'pprint', 'concurrent.futures', 'sqlite3',
+                 'numpy', 'gzip']
+
+
+def top_level_imports(code):
+    # Cumulative import time (microseconds) of each top level import reported by -X importtime
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Nested imports are indented
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def import_time(code):
+    # Ignore what the interpreter imports at startup
+    startup = top_level_imports('pass')
+    return sum(cumulative for name, cumulative in top_level_imports(code).items() if name not in startup)
+
+
+def loaded_modules(code):
+    check = '%s\nimport sys\nprint(" ".join(m for m in %r if m in sys.modules))' % (code, HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', check], cwd=ROOT, stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    return result.stdout.strip() or '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of the husmow entry points.')
+    parser.add_argument('--runs', type=int, default=10, help='Number of fresh interpreters per entry point')
+    args = parser.parse_args()
+
+    print('%-16s %12s  %s' % ('entry point', 'import (ms)', 'heavy modules loaded'))
+    for name, code in ENTRY_POINTS:
+        times = [import_time(code) for _ in range(args.runs)]
+        print('%-16s %12.1f  %s' % (name, statistics.median(times) / 1000, loaded_modules(code)))
+
+
+if __name__ == '__main__':
+    main()
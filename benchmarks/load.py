@@ -0,0 +1,185 @@
+# End-to-end load benchmark of husmow server and husmow_logger against the local mock of the Husqvarna
+# APIs (pyhusmow.mock_server), so performance regressions can be caught without an account.
+#
+#     python benchmarks/load.py [--clients 20] [--requests 200] [--latency 0.2] [--error-rate 0.05]
+#
+# The server is hit on /status by concurrent clients: reported are the throughput, the p50/p99 latency and
+# the number of requests that reached the mock. The logger logs all the mowers for a while: reported are the
+# samples per second and the p50/p99 gap between two samples of the same mower.
+import argparse
+import csv
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pyhusmow.husmow import API, TokenConfig  # noqa: E402
+from pyhusmow.mock_server import start_mock_server  # noqa: E402
+
+
+def percentile(values, ratio):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn(module, args, cwd):
+    # The output goes to a file: a pipe nobody reads would block the process once full
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    with open(os.path.join(cwd, 'output.log'), 'ab') as output:
+        return subprocess.Popen([sys.executable, '-c', 'import %s as m; m.main()' % module] + args, cwd=cwd,
+                                env=env, stdout=output, stderr=subprocess.STDOUT)
+
+
+def wait_port(port, process, cwd, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            with open(os.path.join(cwd, 'output.log')) as output:
+                raise RuntimeError('The process exited: %s' % output.read())
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Nothing is listening on port %d' % port)
+
+
+def stop(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def bench_server(url, state, args, workdir):
+    port = free_port()
+    server = spawn('pyhusmow', ['--auth-url', url, '--track-url', url, '--login', 'bench', '--password', 'bench',
+                                '--no-token', '--log-level', 'ERROR', 'server', '--port', str(port),
+                                '--expire', str(args.expire)], workdir)
+    try:
+        wait_port(port, server, workdir)
+        state.calls.clear()
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def client(count):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            for _ in range(count):
+                start = time.perf_counter()
+                conn.request('GET', '/status')
+                response = conn.getresponse()
+                response.read()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if response.status != 200:
+                        errors.append(response.status)
+            conn.close()
+
+        threads = [threading.Thread(target=client, args=(args.requests,)) for _ in range(args.clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        stop(server)
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'upstream': sum(state.calls.values()),
+    }
+
+
+def bench_logger(url, state, args, workdir):
+    # husmow_logger needs a valid token.cfg
+    mow = API(url, url)
+    mow.login('bench', 'bench')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        tc = TokenConfig()
+        tc.token = mow.token
+        tc.provider = mow.provider
+        tc.expire_on = mow.expire_on
+        tc.save_config()
+    finally:
+        os.chdir(cwd)
+
+    output = os.path.join(workdir, 'log.csv')
+    state.calls.clear()
+    logger = spawn('pyhusmow.status_logger', ['--auth-url', url, '--track-url', url, '--all-mowers',
+                                              '--delay', '1', '--flush-interval', '0', '--file', output], workdir)
+    time.sleep(args.duration)
+    stop(logger)
+
+    samples = {}
+    with open(output) as f:
+        for row in csv.DictReader(f):
+            samples.setdefault(row['mower'], []).append(time.mktime(time.strptime(row['time'][:19],
+                                                                                  '%Y-%m-%dT%H:%M:%S')))
+    gaps = [later - earlier for times in samples.values() for earlier, later in zip(times, times[1:])]
+    count = sum(len(times) for times in samples.values())
+    return {
+        'samples': count,
+        'samples_per_second': count / args.duration,
+        'p50': percentile(gaps, 0.5),
+        'p99': percentile(gaps, 0.99),
+        'upstream': sum(state.calls.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load benchmark of husmow server and husmow_logger.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--clients', type=int, default=20, help='Concurrent clients of the server')
+    parser.add_argument('--requests', type=int, default=200, help='Requests sent by each client')
+    parser.add_argument('--expire', type=int, default=30, help='--expire option of the server')
+    parser.add_argument('--duration', type=float, default=10, help='Duration (seconds) of the logger run')
+    parser.add_argument('--mowers', type=int, default=3, help='Number of mowers of the mock account')
+    parser.add_argument('--latency', type=float, default=0.2, help='Latency (seconds) of the mock')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Jitter (seconds) of the mock')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0,
+                        help='Ratio of the mock requests answered with 503')
+    args = parser.parse_args()
+
+    httpd, url, state = start_mock_server(mowers=args.mowers, latency=args.latency, jitter=args.jitter,
+                                          error_rate=args.error_rate)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            result = bench_server(url, state, args, workdir)
+            print('husmow server: %(requests)d requests, %(errors)d errors, %(throughput).1f req/s, '
+                  'p50 %(p50).4fs, p99 %(p99).4fs, %(upstream)d upstream requests' % result)
+        with tempfile.TemporaryDirectory() as workdir:
+            result = bench_logger(url, state, args, workdir)
+            print('husmow_logger: %(samples)d samples, %(samples_per_second).2f samples/s, '
+                  'gap p50 %(p50).2fs, p99 %(p99).2fs, %(upstream)d upstream requests' % result)
+    finally:
+        httpd.shutdown()
+
+
+if __name__ == '__main__':
+    main()
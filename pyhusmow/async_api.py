@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from .husmow import API, CircuitBreaker, CommandException, RateLimiter, find_robot, retry_delay
+
+
+class AsyncAPI:
+    # Same interface as API, with coroutines, on a pooled aiohttp session. Many calls can run concurrently
+    # from one event loop:
+    #
+    #     async with AsyncAPI() as mow:
+    #         await mow.login(login, password)
+    #         robots = await mow.list_robots()
+    #         statuses = await asyncio.gather(*[mow.status(robot['id']) for robot in robots])
+    _API_IM = API._API_IM
+    _API_TRACK = API._API_TRACK
+    _HEADERS = API._HEADERS
+    _RETRY_STATUS = API._RETRY_STATUS
+
+    def __init__(self, auth_url=None, track_url=None, rate=5, burst=10, retries=3, backoff=1, max_backoff=30,
+                 timeout=30, failure_threshold=5, reset_timeout=60, connections=20):
+        self.logger = logging.getLogger("main.automower")
+        self.session = None
+        self.auth_url = auth_url or self._API_IM
+        self.track_url = track_url or self._API_TRACK
+        self.headers = dict(self._HEADERS)
+        self.device_id = None
+        self.token = None
+        self.provider = None
+        self.expire_on = None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.connections = connections
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        # Jitter of the retries
+        self.random = random.Random()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _get_session(self):
+        # The session is bound to the running event loop, so it is created on first use
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request(self, operation, method, url, **kwargs):
+        self.circuit_breaker.check()
+        session = self._get_session()
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.rate_limiter.reserve())
+            response = error = None
+            start = time.perf_counter()
+            try:
+                response = await session.request(method, url, headers=self.headers, **kwargs)
+                # Read the body before the connection goes back to the pool
+                await response.read()
+                response.release()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                error = ex
+                response = None
+            attempt += 1
+            delay = retry_delay(self, operation, method, url, attempt, time.perf_counter() - start, response,
+                                response.status if response is not None else None, error)
+            if delay is None:
+                return response
+            await asyncio.sleep(delay)
+
+    async def login(self, login, password):
+        response = await self._request('login', 'post', self.auth_url + 'token',
+                                       json={
+                                           "data": {
+                                               "attributes": {
+                                                   "password": password,
+                                                   "username": login
+                                               },
+                                               "type": "token"
+                                           }
+                                       })
+
+        self.logger.info('Logged in successfully')
+
+        json = await response.json(content_type=None)
+        expires_in = json["data"]["attributes"]["expires_in"]
+        self.set_token(json["data"]["id"], json["data"]["attributes"]["provider"],
+                       datetime.now() + timedelta(0, expires_in))
+        return expires_in
+
+    async def logout(self):
+        await self._request('logout', 'delete', self.auth_url + 'token/%s' % self.token)
+        self.device_id = None
+        self.token = None
+        self.expire_on = None
+        self.headers.pop('Authorization', None)
+        self.headers.pop('Authorization-Provider', None)
+        self.logger.info('Logged out successfully')
+
+    def set_token(self, token, provider, expire_on=None):
+        self.token = token
+        self.provider = provider
+        self.expire_on = expire_on
+        self.headers.update({
+            'Authorization': "Bearer " + self.token,
+            'Authorization-Provider': provider
+        })
+
+    def token_valid(self, margin=0):
+        if not self.token:
+            return False
+        return self.expire_on is None or self.expire_on > datetime.now() + timedelta(0, margin)
+
+    async def list_robots(self):
+        response = await self._request('list_robots', 'get', self.track_url + 'mowers')
+
+        return await response.json(content_type=None)
+
+    async def select_robot(self, mower, robots=None):
+        result = await self.list_robots() if robots is None else robots
+        if not len(result):
+            raise CommandException('No mower found')
+        if mower:
+            self.device_id = find_robot(result, mower)['id']
+        else:
+            self.device_id = result[0]['id']
+
+    async def status(self, device_id=None):
+        response = await self._request('status', 'get',
+                                       self.track_url + 'mowers/%s/status' % (device_id or self.device_id))
+
+        return await response.json(content_type=None)
+
+    async def geo_status(self, device_id=None):
+        response = await self._request('geo_status', 'get',
+                                       self.track_url + 'mowers/%s/geofence' % (device_id or self.device_id))
+
+        return await response.json(content_type=None)
+
+    async def control(self, command, device_id=None):
+        if command not in ['PARK', 'STOP', 'START']:
+            raise CommandException("Unknown command")
+
+        await self._request('control', 'post', self.track_url + 'mowers/%s/control' % (device_id or self.device_id),
+                            json={
+                                "action": command
+                            })
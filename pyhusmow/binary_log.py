@@ -0,0 +1,191 @@
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from datetime import datetime
+from time import time
+
+# File layout: a fixed size header followed by fixed size records appended in time order.
+# The header holds the magic string, the record size and the table of the status names: records only
+# store the index of their status in this table.
+MAGIC = b'HUSMOWB1'
+HEADER_SIZE = 4096
+_HEADER = struct.Struct('<8sHH')
+STATUS_OFFSET = 64
+STATUS_SIZE = 32
+MAX_STATUSES = (HEADER_SIZE - STATUS_OFFSET) // STATUS_SIZE
+
+# time (unix timestamp), status index, battery %, next start timestamp (0 when none), status duration
+# (seconds), latitude, longitude
+RECORD = struct.Struct('<dBBqIdd')
+FIELDS = ('time', 'status', 'battery', 'next_start', 'duration', 'latitude', 'longitude')
+NUMPY_DTYPE = [('time', '<f8'), ('status', 'u1'), ('battery', 'u1'), ('next_start', '<i8'),
+               ('duration', '<u4'), ('latitude', '<f8'), ('longitude', '<f8')]
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _read_header(f):
+    f.seek(0)
+    header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError('Not a husmow binary log: header is truncated')
+    magic, record_size, count = _HEADER.unpack_from(header)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError('Not a husmow binary log or unsupported version')
+    statuses = []
+    for i in range(count):
+        offset = STATUS_OFFSET + i * STATUS_SIZE
+        statuses.append(header[offset:offset + STATUS_SIZE].rstrip(b'\0').decode('ascii'))
+    return statuses
+
+
+class BinaryLogWriter:
+    # With append, an existing log is continued. Otherwise the log is started again, like the other formats:
+    # the records must stay in time order
+    def __init__(self, path, flush_interval=60, append=False):
+        self.path = path
+        self.flush_interval = flush_interval
+        if append and os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            self.file = open(path, 'r+b')
+            self.statuses = _read_header(self.file)
+            # Drop a record partially written before a crash
+            size = os.path.getsize(path)
+            self.file.truncate(size - (size - HEADER_SIZE) % RECORD.size)
+        else:
+            self.file = open(path, 'w+b')
+            self.statuses = []
+            self.file.write(_HEADER.pack(MAGIC, RECORD.size, 0).ljust(HEADER_SIZE, b'\0'))
+        self.file.seek(0, os.SEEK_END)
+        self.codes = {status: i for i, status in enumerate(self.statuses)}
+        self.flushed_on = time()
+        self.dirty = False
+
+    def _status_code(self, status):
+        code = self.codes.get(status)
+        if code is not None:
+            return code
+        if len(self.statuses) >= MAX_STATUSES:
+            raise ValueError('Too many different statuses in %s' % self.path)
+        name = status.encode('ascii')[:STATUS_SIZE]
+        code = len(self.statuses)
+        self.statuses.append(status)
+        self.codes[status] = code
+        # Register the new status in the header before writing records using it
+        self.file.flush()
+        self.file.seek(STATUS_OFFSET + code * STATUS_SIZE)
+        self.file.write(name.ljust(STATUS_SIZE, b'\0'))
+        self.file.seek(0)
+        self.file.write(_HEADER.pack(MAGIC, RECORD.size, len(self.statuses)))
+        self.file.seek(0, os.SEEK_END)
+        return code
+
+    def write_status(self, sample_time, status, battery, next_start, duration, latitude, longitude, mower=None,
+                     raw=None):
+        # One file per mower: the mower is not recorded. Neither is the raw status
+        self.file.write(RECORD.pack(
+            sample_time.timestamp(),
+            self._status_code(status),
+            battery,
+            int((next_start - _EPOCH).total_seconds()) if next_start else 0,
+            int(duration.total_seconds()),
+            latitude,
+            longitude))
+        self.dirty = True
+        if time() - self.flushed_on >= self.flush_interval:
+            self.flush()
+
+    def flush_due(self):
+        return self.flushed_on + self.flush_interval - time() if self.dirty else None
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.flushed_on = time()
+        self.dirty = False
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+class BinaryLogReader:
+    # Reads a binary log through a read-only memory map: nothing is parsed until it is queried
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.statuses = _read_header(self.file)
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = (size - HEADER_SIZE) // RECORD.size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else None
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Arrays returned by records() still use the map: it is released with them
+                pass
+            self.map = None
+        self.file.close()
+
+    def _time(self, index):
+        return RECORD.unpack_from(self.map, HEADER_SIZE + index * RECORD.size)[0]
+
+    def _range(self, start, end):
+        # Records are sorted by time: binary search the bounds without reading the other records
+        times = _TimeIndex(self)
+        first = bisect_left(times, start) if start is not None else 0
+        last = bisect_left(times, end) if end is not None else self.count
+        return first, last
+
+    def rows(self, start=None, end=None):
+        first, last = self._range(_timestamp(start), _timestamp(end))
+        for index in range(first, last):
+            record = list(RECORD.unpack_from(self.map, HEADER_SIZE + index * RECORD.size))
+            record[1] = self.statuses[record[1]]
+            yield tuple(record)
+
+    def records(self, start=None, end=None):
+        # Returns a structured NumPy array over the memory map (no copy) of the records in [start, end)
+        import numpy as np
+
+        first, last = self._range(_timestamp(start), _timestamp(end))
+        if not self.count:
+            return np.zeros(0, dtype=NUMPY_DTYPE)
+        # An end before the start selects nothing: a negative count would read to the end of the file
+        last = max(first, last)
+        return np.frombuffer(self.map, dtype=NUMPY_DTYPE, count=last - first,
+                             offset=HEADER_SIZE + first * RECORD.size)
+
+    def columns(self, start=None, end=None):
+        # Returns a dict of NumPy arrays, one per field. Status names are in self.statuses
+        records = self.records(start, end)
+        return {field: records[field] for field in FIELDS}
+
+
+class _TimeIndex:
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.count
+
+    def __getitem__(self, index):
+        return self.reader._time(index)
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return value.timestamp()
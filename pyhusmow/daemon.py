@@ -0,0 +1,97 @@
+import http.client
+import json
+import os
+import socket
+from urllib.parse import quote
+
+from .husmow import log_error, logger
+
+# Commands that a running `husmow server --daemon` can answer in place of the CLI
+FORWARDED_COMMANDS = ('status', 'control', 'list')
+
+
+# Longer than the worst case of a request to Husqvarna servers: 4 attempts of 30s with up to 30s between them
+DAEMON_TIMEOUT = 240
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=DAEMON_TIMEOUT):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def daemon_running(path):
+    if not path or not os.path.exists(path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+        return True
+    except OSError:
+        return False
+
+
+def mower_path(args, route):
+    return '/mowers/%s/%s' % (quote(args.mower, safe=''), route) if args.mower else '/' + route
+
+
+def forward_command(args, out):
+    # Sends the command to the daemon listening on args.socket. Returns False when no daemon answered:
+    # the command must then be sent to Husqvarna servers directly.
+    if args.command not in FORWARDED_COMMANDS or not os.path.exists(args.socket):
+        return False
+    body = None
+    method = 'GET'
+    if args.command == 'status':
+        path = mower_path(args, 'status')
+    elif args.command == 'list':
+        path = '/mowers'
+    elif args.mowers or args.all_mowers:
+        method = 'POST'
+        path = '/control'
+        orders = {'command': args.action}
+        if not args.all_mowers:
+            orders['mowers'] = [name.strip() for name in args.mowers.split(',')]
+        body = json.dumps(orders)
+    else:
+        path = mower_path(args, args.action.lower())
+
+    conn = UnixHTTPConnection(args.socket)
+    try:
+        try:
+            conn.connect()
+        except (FileNotFoundError, ConnectionRefusedError) as ex:
+            # The daemon is not running anymore
+            logger.info('No daemon on %s (%s), sending the command directly' % (args.socket, ex))
+            return False
+        conn.request(method, path, body=body, headers={'Content-Type': 'application/json'} if body else {})
+        response = conn.getresponse()
+        content = response.read()
+    except (OSError, http.client.HTTPException) as ex:
+        # The daemon may have got the command: it did not answer in time, usually because Husqvarna servers are
+        # slow, or it closed the connection. Sending the command again directly could send it twice
+        log_error(args, "[ERROR] Failed to send the command: no answer from the daemon on %s (%s)" % (
+            args.socket, ex or type(ex).__name__))
+        return True
+    finally:
+        conn.close()
+
+    if response.status == 404:
+        log_error(args, "[ERROR] Wrong parameters: Could not find a mower matching %s" % (args.mower or args.mowers))
+    elif response.status == 503:
+        log_error(args, "[ERROR] Failed to send the command: Husqvarna servers are unavailable")
+    elif response.status != 200:
+        log_error(args, "[ERROR] Failed to send the command: %s %s" % (response.status, response.reason))
+    elif content:
+        result = json.loads(content.decode('utf-8'))
+        out(result)
+        if method == 'POST':
+            for item in result:
+                if not item['success']:
+                    log_error(args, "[ERROR] Failed to send %s to %s: %s" % (args.action, item['name'], item['error']))
+    return True
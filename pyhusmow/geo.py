@@ -0,0 +1,203 @@
+import os
+import threading
+from collections import deque
+
+# Trail of the locations of a mower, accumulated from the lastLocations of its successive statuses.
+#
+# Each status carries the latest locations of the mower (about 50), most of them already received with the
+# previous status: only the new ones are kept. The statistics (distance, coverage heatmap, distance from the
+# geofence center) are updated with the new points only, with NumPy, so the cost of an update does not
+# depend on the length of the trail. NumPy is required (pip install pyhusmow[numpy]).
+#
+# A trail can be saved in a file of fixed-size records: poll time (uint32), latitude and longitude (int32,
+# in 1e-7 degrees, about 1cm). 12 bytes per point, read back with numpy.fromfile(path, NUMPY_DTYPE).
+
+NUMPY_DTYPE = [('time', '<u4'), ('latitude', '<i4'), ('longitude', '<i4')]
+RECORD_SIZE = 12
+SCALE = 10 ** 7
+EARTH_RADIUS = 6371008.8
+# Number of known points that must match to find where the new locations start
+MATCH = 3
+# Known points kept to find where the new locations start
+RECENT_SIZE = 100
+
+
+def to_point(location):
+    return int(round(location['latitude'] * SCALE)), int(round(location['longitude'] * SCALE))
+
+
+def new_points(recent, locations):
+    # recent: points already known, oldest first. locations: lastLocations of a status, latest first.
+    # Returns the points of locations that are not known yet, oldest first
+    points = [to_point(location) for location in reversed(locations)]
+    tail = list(recent)[-MATCH:]
+    if not tail:
+        return points
+    # The latest occurrence of the known tail is where the known trail ends. When the mower does not move,
+    # the same point is repeated and the match is at the very end: nothing is new
+    size = len(tail)
+    for end in range(len(points), size - 1, -1):
+        if points[end - size:end] == tail:
+            return points[end:]
+    # No overlap: the mower moved more than the length of lastLocations since the previous status
+    return points
+
+
+def parse_geofence(geofence):
+    # Returns ((latitude, longitude), radius in meters) of the geofence returned by API.geo_status, or None
+    try:
+        point = geofence['centralPoint']
+        return (point['location']['latitude'], point['location']['longitude']), point['sensitivity']['radius']
+    except (KeyError, TypeError):
+        return None
+
+
+class Trail:
+    def __init__(self, path=None, cell_size=1.0, geofence=None, append=True):
+        # cell_size is the side (meters) of the heatmap cells. When append is False, the points read from path
+        # are analyzed but the new ones are not saved
+        self.path = path
+        self.cell_size = cell_size
+        self.geofence = parse_geofence(geofence) if geofence else None
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=RECENT_SIZE)
+        # Points are projected on a plane (meters) around origin: good enough at the scale of a garden
+        self.origin = self.geofence[0] if self.geofence else None
+        self.count = 0
+        self.distance = 0.0
+        self.heatmap = {}
+        self.last = None
+        self.updated = None
+        self.max_center_distance = None
+        self.center_distance = None
+        self.outside = 0
+        self.file = None
+        if path:
+            if os.path.exists(path):
+                self.load(path)
+            if append:
+                self.file = open(path, 'ab')
+                # The new records follow the complete ones: drop a partial record written during a crash
+                size = os.path.getsize(path)
+                self.file.truncate(size - size % RECORD_SIZE)
+
+    def load(self, path):
+        import numpy as np
+
+        # A partial record written during a crash is ignored
+        records = np.fromfile(path, dtype=NUMPY_DTYPE, count=os.path.getsize(path) // RECORD_SIZE)
+        if len(records):
+            self.add(records['time'], records['latitude'], records['longitude'])
+            self.recent.extend(zip(records['latitude'][-RECENT_SIZE:].tolist(),
+                                   records['longitude'][-RECENT_SIZE:].tolist()))
+
+    def project(self, latitudes, longitudes):
+        import numpy as np
+
+        latitude, longitude = self.origin
+        x = np.radians(longitudes - longitude) * EARTH_RADIUS * np.cos(np.radians(latitude))
+        y = np.radians(latitudes - latitude) * EARTH_RADIUS
+        return x, y
+
+    def unproject(self, x, y):
+        import numpy as np
+
+        latitude, longitude = self.origin
+        latitudes = latitude + np.degrees(y / EARTH_RADIUS)
+        longitudes = longitude + np.degrees(x / (EARTH_RADIUS * np.cos(np.radians(latitude))))
+        return latitudes, longitudes
+
+    def add(self, times, latitudes, longitudes):
+        # Updates the statistics with new points (arrays of integer coordinates), in chronological order
+        import numpy as np
+
+        latitudes = np.asarray(latitudes, dtype=np.float64) / SCALE
+        longitudes = np.asarray(longitudes, dtype=np.float64) / SCALE
+        if self.origin is None:
+            self.origin = (float(latitudes[0]), float(longitudes[0]))
+        x, y = self.project(latitudes, longitudes)
+
+        # Distance along the trail, from the last known point
+        if self.last is not None:
+            path_x, path_y = np.concatenate(([self.last[0]], x)), np.concatenate(([self.last[1]], y))
+        else:
+            path_x, path_y = x, y
+        self.distance += float(np.hypot(np.diff(path_x), np.diff(path_y)).sum())
+        self.last = (float(x[-1]), float(y[-1]))
+
+        cells, counts = np.unique(np.stack((np.floor(x / self.cell_size), np.floor(y / self.cell_size)), axis=1)
+                                  .astype(np.int64), axis=0, return_counts=True)
+        for (column, row), count in zip(cells.tolist(), counts.tolist()):
+            self.heatmap[column, row] = self.heatmap.get((column, row), 0) + count
+
+        if self.geofence:
+            center_x, center_y = self.project(*self.geofence[0])
+            distances = np.hypot(x - center_x, y - center_y)
+            self.max_center_distance = max(self.max_center_distance or 0.0, float(distances.max()))
+            self.center_distance = float(distances[-1])
+            self.outside += int((distances > self.geofence[1]).sum())
+
+        self.count += len(x)
+        self.updated = int(times[-1])
+
+    def update(self, status, timestamp):
+        # Adds the new locations of a status received at timestamp. Returns the number of new points
+        import numpy as np
+
+        with self.lock:
+            points = new_points(self.recent, status.get('lastLocations') or [])
+            if not points:
+                return 0
+            self.recent.extend(points)
+            records = np.zeros(len(points), dtype=NUMPY_DTYPE)
+            records['time'] = int(timestamp)
+            records['latitude'], records['longitude'] = np.array(points, dtype=np.int64).T
+            self.add(records['time'], records['latitude'], records['longitude'])
+            if self.file is not None:
+                self.file.write(records.tobytes())
+                self.file.flush()
+            return len(points)
+
+    def heatmap_cells(self):
+        # Returns [latitude, longitude, count] of the center of each cell with at least one point
+        import numpy as np
+
+        with self.lock:
+            if not self.heatmap:
+                return []
+            cells = np.array(list(self.heatmap.keys()), dtype=np.float64)
+            counts = list(self.heatmap.values())
+        latitudes, longitudes = self.unproject((cells[:, 0] + 0.5) * self.cell_size,
+                                               (cells[:, 1] + 0.5) * self.cell_size)
+        return [[round(latitude, 7), round(longitude, 7), count]
+                for latitude, longitude, count in zip(latitudes.tolist(), longitudes.tolist(), counts)]
+
+    def summary(self, heatmap=False):
+        with self.lock:
+            result = {
+                'points': self.count,
+                'distance': round(self.distance, 1),
+                'cell_size': self.cell_size,
+                'cells': len(self.heatmap),
+                'covered_area': round(len(self.heatmap) * self.cell_size ** 2, 1),
+                'updated': self.updated,
+            }
+            if self.geofence:
+                (latitude, longitude), radius = self.geofence
+                result['geofence'] = {
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'radius': radius,
+                    'distance': None if self.center_distance is None else round(self.center_distance, 1),
+                    'margin': None if self.center_distance is None else round(radius - self.center_distance, 1),
+                    'max_distance': None if self.max_center_distance is None else round(self.max_center_distance, 1),
+                    'outside': self.outside,
+                }
+        if heatmap:
+            result['heatmap'] = self.heatmap_cells()
+        return result
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+from datetime import datetime
+from time import time
+
+_COLUMNS = ('mower', 'time', 'status', 'battery', 'next_start', 'latitude', 'longitude')
+
+
+def parse_time(value):
+    # Accepts unix timestamps or ISO 8601 dates
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+class HistoryStore:
+    # Status history of the mowers in a SQLite database. Samples are inserted by batches of batch_size,
+    # or every flush_interval seconds. The connection can be shared between threads.
+    def __init__(self, path, batch_size=100, flush_interval=30):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.flushed_on = time()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets readers (the server, the dashboards) query while a logger writes
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS status ('
+                              'mower TEXT NOT NULL, '
+                              'time REAL NOT NULL, '
+                              'status TEXT, '
+                              'battery INTEGER, '
+                              'next_start INTEGER, '
+                              'latitude REAL, '
+                              'longitude REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS status_mower_time ON status (mower, time)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS status_time ON status (time)')
+
+    def add_status(self, mower, timestamp, status):
+        locations = status.get('lastLocations') or [{}]
+        sample = (mower, timestamp, status.get('mowerStatus'), status.get('batteryPercent'),
+                  status.get('nextStartTimestamp') or None,
+                  locations[0].get('latitude'), locations[0].get('longitude'))
+        with self.lock:
+            self.pending.append(sample)
+            if len(self.pending) >= self.batch_size or time() - self.flushed_on >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        if self.pending:
+            with self.conn:
+                self.conn.executemany('INSERT INTO status VALUES (?, ?, ?, ?, ?, ?, ?)', self.pending)
+            self.pending = []
+        self.flushed_on = time()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def query(self, mower=None, start=None, end=None, step=None, limit=None):
+        # With step (seconds), only the latest sample of each step long period is returned
+        where = []
+        params = []
+        if mower is not None:
+            where.append('mower = ?')
+            params.append(mower)
+        if start is not None:
+            where.append('time >= ?')
+            params.append(start)
+        if end is not None:
+            where.append('time < ?')
+            params.append(end)
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+        if step:
+            # SQLite takes the bare columns from the row holding MAX(time)
+            sql = ('SELECT mower, MAX(time), status, battery, next_start, latitude, longitude FROM status%s '
+                   'GROUP BY mower, CAST(time / ? AS INTEGER) ORDER BY 2' % where)
+            params.append(step)
+        else:
+            sql = 'SELECT %s FROM status%s ORDER BY time' % (', '.join(_COLUMNS), where)
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            self._flush()
+            rows = self.conn.execute(sql, params).fetchall()
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
@@ -1,14 +1,15 @@
 import argparse
-import json
 import logging
-import pprint
+import random
+import threading
 import time
 from configparser import ConfigParser
-from datetime import datetime, timedelta
-from dateutil.parser import parse
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta, timezone
 
-import requests
+from . import metrics
+
+# requests, pprint and the other heavy modules are imported where they are used: husmow is run often by
+# scripts and most of the commands do not need all of them
 
 logger = logging.getLogger("main")
 
@@ -21,6 +22,9 @@ class AutoMowerConfig(ConfigParser):
         self.password = ""
         self.log_level = 'INFO'
         self.expire_status = "30"
+        self.mower_cache_ttl = "86400"
+        self.auth_url = ""
+        self.track_url = ""
 
     def load_config(self):
         return self.read('automower.cfg')
@@ -61,10 +65,36 @@ class AutoMowerConfig(ConfigParser):
     def expire_status(self, value):
         self['husqvarna.net']['expire_status'] = str(value)
 
+    @property
+    def mower_cache_ttl(self):
+        return int(self['husqvarna.net']['mower_cache_ttl'])
+
+    @mower_cache_ttl.setter
+    def mower_cache_ttl(self, value):
+        self['husqvarna.net']['mower_cache_ttl'] = str(value)
+
+    @property
+    def auth_url(self):
+        return self['husqvarna.net']['auth_url']
+
+    @auth_url.setter
+    def auth_url(self, value):
+        self['husqvarna.net']['auth_url'] = value
+
+    @property
+    def track_url(self):
+        return self['husqvarna.net']['track_url']
+
+    @track_url.setter
+    def track_url(self, value):
+        self['husqvarna.net']['track_url'] = value
+
 
 class TokenConfig(ConfigParser):
     def __init__(self):
         super(TokenConfig, self).__init__()
+        # (raw value, parsed date) of expire_on, so the date is parsed only when it changes
+        self._expire_on = None
         self['husqvarna.net'] = {}
         self.token = ""
         self.provider = ""
@@ -95,7 +125,10 @@ class TokenConfig(ConfigParser):
 
     @property
     def expire_on(self):
-        return parse(self['husqvarna.net']['expire_on'])
+        value = self['husqvarna.net']['expire_on']
+        if self._expire_on is None or self._expire_on[0] != value:
+            self._expire_on = (value, datetime.fromisoformat(value))
+        return self._expire_on[1]
 
     @expire_on.setter
     def expire_on(self, value):
@@ -105,100 +138,324 @@ class TokenConfig(ConfigParser):
         return True if self.token and self.expire_on > datetime.now() else False
 
 
+class MowerCache(ConfigParser):
+    def __init__(self):
+        super(MowerCache, self).__init__(interpolation=None)
+        # Keep the case of the mower ids
+        self.optionxform = str
+        self['husqvarna.net'] = {}
+        self['mowers'] = {}
+        self.login = ""
+        self.updated_on = datetime(1900, 1, 1)
+
+    def load_config(self):
+        return self.read('mowers.cfg')
+
+    def save_config(self):
+        with open('mowers.cfg', mode='w') as f:
+            return self.write(f)
+
+    @property
+    def login(self):
+        return self['husqvarna.net']['login']
+
+    @login.setter
+    def login(self, value):
+        self['husqvarna.net']['login'] = value
+
+    @property
+    def updated_on(self):
+        return datetime.fromisoformat(self['husqvarna.net']['updated_on'])
+
+    @updated_on.setter
+    def updated_on(self, value):
+        self['husqvarna.net']['updated_on'] = value.isoformat()
+
+    @property
+    def robots(self):
+        return [{'id': id, 'name': name} for id, name in self['mowers'].items()]
+
+    @robots.setter
+    def robots(self, robots):
+        self['mowers'] = {robot['id']: robot['name'] for robot in robots}
+
+    def cache_valid(self, login, ttl):
+        return bool(len(self['mowers'])) and self.login == login and \
+            self.updated_on > datetime.now() - timedelta(0, ttl)
+
+
 class CommandException(Exception):
     pass
 
 
+class CircuitOpenException(Exception):
+    pass
+
+
+def find_robot(robots, mower):
+    for item in robots:
+        if item['name'] == mower or item['id'] == mower:
+            return item
+    raise CommandException('Could not find a mower matching %s' % mower)
+
+
+class RateLimiter:
+    # Token bucket: allows bursts of `burst` requests, then `rate` requests per second
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # Returns how long the caller must wait before sending its request
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # The token is reserved now so concurrent callers queue up behind each other
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    # Opened after `threshold` consecutive failed requests: requests then fail immediately until
+    # `reset_timeout` seconds have passed, when a single request is allowed to test the servers again
+    def __init__(self, threshold, reset_timeout, timefunc=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.timefunc = timefunc
+        self.failures = 0
+        self.opened_on = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        return self.opened_on is not None and self.timefunc() - self.opened_on < self.reset_timeout
+
+    def check(self):
+        with self.lock:
+            if self.opened_on is None:
+                return
+            if self.is_open():
+                raise CircuitOpenException('Husqvarna servers are unavailable, retrying in %ds' % (
+                    self.reset_timeout - (self.timefunc() - self.opened_on)))
+            # Let this request through and keep failing the other ones until it answers
+            self.opened_on = self.timefunc()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_on = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_on = self.timefunc()
+
+
+def retry_after(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(api, operation, method, url, attempt, duration, response, code, error):
+    # Outcome of an attempt of API or AsyncAPI: response (with its HTTP status code) or the connection error.
+    # Records the metrics, then returns None when the response is final, the delay before the next attempt
+    # when it is worth retrying. Raises when giving up
+    metrics.API_LATENCY.observe(duration, operation)
+    metrics.API_REQUESTS.inc(operation, code if response is not None else 'error')
+    if response is not None and code not in API._RETRY_STATUS:
+        # The servers answered: even a client error means they are up
+        api.circuit_breaker.success()
+        response.raise_for_status()
+        return None
+
+    # Exponential backoff with full jitter, unless the servers told us how long to wait
+    delay = retry_after(response)
+    if delay is None:
+        delay = api.random.uniform(0, min(api.max_backoff, api.backoff * 2 ** attempt))
+    if attempt > api.retries or delay > api.max_backoff:
+        api.circuit_breaker.failure()
+        if response is not None:
+            response.raise_for_status()
+        raise error
+    api.logger.warning('%s %s failed (%s). Retrying in %.1fs' % (
+        method.upper(), url, code if response is not None else error, delay))
+    metrics.API_RETRIES.inc(operation)
+    return delay
+
+
 class API:
     _API_IM = 'https://iam-api.dss.husqvarnagroup.net/api/v3/'
     _API_TRACK = 'https://amc-api.dss.husqvarnagroup.net/v1/'
     _HEADERS = {'Accept': 'application/json', 'Content-type': 'application/json'}
+    # Responses worth retrying: the request may succeed later
+    _RETRY_STATUS = (429, 500, 502, 503, 504)
 
-    def __init__(self):
+    def __init__(self, auth_url=None, track_url=None, rate=5, burst=10, retries=3, backoff=1, max_backoff=30,
+                 timeout=30, failure_threshold=5, reset_timeout=60):
         self.logger = logging.getLogger("main.automower")
+        import requests
         self.session = requests.Session()
+        # The base URLs can be changed to use another backend, like pyhusmow.mock_server
+        self.auth_url = auth_url or self._API_IM
+        self.track_url = track_url or self._API_TRACK
         self.device_id = None
         self.token = None
         self.provider = None
+        self.expire_on = None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        # Waits between the retries, and their jitter. A replay replaces them with the sleep of its virtual
+        # clock and a seeded generator
+        self.sleep = time.sleep
+        self.random = random.Random()
+
+    def _request(self, operation, method, url, **kwargs):
+        # operation names the API method in the metrics
+        import requests
+        self.circuit_breaker.check()
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            response = error = None
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = ex
+            attempt += 1
+            delay = retry_delay(self, operation, method, url, attempt, time.perf_counter() - start, response,
+                                response.status_code if response is not None else None, error)
+            if delay is None:
+                return response
+            self.sleep(delay)
 
     def login(self, login, password):
-        response = self.session.post(self._API_IM + 'token',
-                                     headers=self._HEADERS,
-                                     json={
-                                         "data": {
-                                             "attributes": {
-                                                 "password": password,
-                                                 "username": login
-                                             },
-                                             "type": "token"
-                                         }
-                                     })
+        response = self._request('login', 'post', self.auth_url + 'token',
+                                 headers=self._HEADERS,
+                                 json={
+                                     "data": {
+                                         "attributes": {
+                                             "password": password,
+                                             "username": login
+                                         },
+                                         "type": "token"
+                                     }
+                                 })
 
-        response.raise_for_status()
         self.logger.info('Logged in successfully')
 
         json = response.json()
-        self.set_token(json["data"]["id"], json["data"]["attributes"]["provider"])
-        return json["data"]["attributes"]["expires_in"]
+        expires_in = json["data"]["attributes"]["expires_in"]
+        self.set_token(json["data"]["id"], json["data"]["attributes"]["provider"],
+                       datetime.now() + timedelta(0, expires_in))
+        return expires_in
 
     def logout(self):
-        response = self.session.delete(self._API_IM + 'token/%s' % self.token)
-        response.raise_for_status()
+        self._request('logout', 'delete', self.auth_url + 'token/%s' % self.token)
         self.device_id = None
         self.token = None
+        self.expire_on = None
         del (self.session.headers['Authorization'])
         self.logger.info('Logged out successfully')
 
-    def set_token(self, token, provider):
+    def set_token(self, token, provider, expire_on=None):
         self.token = token
         self.provider = provider
+        self.expire_on = expire_on
         self.session.headers.update({
             'Authorization': "Bearer " + self.token,
             'Authorization-Provider': provider
         })
 
+    def token_valid(self, margin=0):
+        if not self.token:
+            return False
+        # A token set without expiration date is considered valid until the server refuses it
+        return self.expire_on is None or self.expire_on > datetime.now() + timedelta(0, margin)
+
     def list_robots(self):
-        response = self.session.get(self._API_TRACK + 'mowers', headers=self._HEADERS)
-        response.raise_for_status()
+        response = self._request('list_robots', 'get', self.track_url + 'mowers', headers=self._HEADERS)
 
         return response.json()
 
-    def select_robot(self, mower):
-        result = self.list_robots()
+    def select_robot(self, mower, robots=None):
+        result = self.list_robots() if robots is None else robots
         if not len(result):
             raise CommandException('No mower found')
         if mower:
-            for item in result:
-                if item['name'] == mower or item['id'] == mower:
-                    self.device_id = item['id']
-                    break
-            if self.device_id is None:
-                raise CommandException('Could not find a mower matching %s' % mower)
+            self.device_id = find_robot(result, mower)['id']
         else:
             self.device_id = result[0]['id']
 
-    def status(self):
-        response = self.session.get(self._API_TRACK + 'mowers/%s/status' % self.device_id, headers=self._HEADERS)
-        response.raise_for_status()
+    def status(self, device_id=None):
+        response = self._request('status', 'get', self.track_url + 'mowers/%s/status' % (device_id or self.device_id),
+                                 headers=self._HEADERS)
 
         return response.json()
 
-    def geo_status(self):
-        response = self.session.get(self._API_TRACK + 'mowers/%s/geofence' % self.device_id, headers=self._HEADERS)
-        response.raise_for_status()
+    def geo_status(self, device_id=None):
+        response = self._request('geo_status', 'get',
+                                 self.track_url + 'mowers/%s/geofence' % (device_id or self.device_id),
+                                 headers=self._HEADERS)
 
         return response.json()
 
-    def control(self, command):
+    def control(self, command, device_id=None):
         if command not in ['PARK', 'STOP', 'START']:
             raise CommandException("Unknown command")
 
-        response = self.session.post(self._API_TRACK + 'mowers/%s/control' % self.device_id,
-                                    headers=self._HEADERS,
-                                    json={
-                                        "action": command
-                                    })
-        response.raise_for_status()
+        self._request('control', 'post', self.track_url + 'mowers/%s/control' % (device_id or self.device_id),
+                      headers=self._HEADERS,
+                      json={
+                          "action": command
+                      })
+
+
+def batch_control(control, orders, executor=None):
+    # Sends the (robot, command) orders concurrently with control(command, device_id), usually API.control, and
+    # returns the result of each one
+    def send(order):
+        robot, command = order
+        started = time.time()
+        try:
+            control(command, robot['id'])
+            error = None
+        except Exception as ex:
+            error = str(ex)
+        result = {'id': robot['id'], 'name': robot['name'], 'command': command, 'success': error is None,
+                  'duration': round(time.time() - started, 3)}
+        if error is not None:
+            result['error'] = error
+        return result
+
+    if executor is not None:
+        return list(executor.map(send, orders))
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(len(orders), 1)) as executor:
+        return list(executor.map(send, orders))
 
 
 def as_json(**kwargs):
@@ -227,6 +484,12 @@ def create_config(args):
         config.log_level = args.log_level
     if hasattr(args, "expire_status") and args.expire_status:
         config.expire_status = args.expire_status
+    if args.mower_cache_ttl is not None:
+        config.mower_cache_ttl = args.mower_cache_ttl
+    if args.auth_url:
+        config.auth_url = args.auth_url
+    if args.track_url:
+        config.track_url = args.track_url
     tokenConfig = TokenConfig()
     tokenConfig.load_config()
 
@@ -254,141 +517,165 @@ def configure_log(config):
     logger.info('Logger configured')
 
 
-def setup_api(config, tokenConfig, args):
-    mow = API()
+def login_api(mow, config, tokenConfig, args):
+    expire = mow.login(config.login, config.password)
+    if args.token:
+        tokenConfig.token = mow.token
+        tokenConfig.provider = mow.provider
+        tokenConfig.expire_on = mow.expire_on
+        tokenConfig.save_config()
+        logger.info('Updated token')
+    return expire
+
+
+def connect_api(config, tokenConfig, args):
+    mow = API(config.auth_url, config.track_url)
+    if getattr(args, 'record', None) or getattr(args, 'replay', None):
+        from .replay import install
+        install(mow, args)
     if args.token and tokenConfig.token and not tokenConfig.token_valid():
         logger.warn('The token expired on %s. Will create a new one.' % tokenConfig.expire_on)
     if args.token and tokenConfig.token_valid():
-        mow.set_token(tokenConfig.token, tokenConfig.provider)
+        mow.set_token(tokenConfig.token, tokenConfig.provider, tokenConfig.expire_on)
     else:
-        expire = mow.login(config.login, config.password)
-        if args.token:
-            tokenConfig.token = mow.token
-            tokenConfig.provider = mow.provider
-            tokenConfig.expire_on = datetime.now() + timedelta(0, expire)
-            tokenConfig.save_config()
-            logger.info('Updated token')
-    mow.select_robot(args.mower)
+        login_api(mow, config, tokenConfig, args)
     return mow
 
 
-def run_cli(config, tokenConfig, args):
-    retry = 3
-    if args.json:
-        out = lambda res: as_json(**{args.command: res})
-    else:
-        pp = pprint.PrettyPrinter(indent=2)
-        out = pp.pprint
-    while retry > 0:
-        try:
-            mow = setup_api(config, tokenConfig, args)
-            if args.command == 'control':
-                mow.control(args.action)
-            elif args.command == 'status':
-                out(mow.status())
-            elif args.command == 'list':
-                out(mow.list_robots())
+def load_robots(mow, config, refresh=False):
+    # Returns (robots, cached). The list of the mowers is kept in mowers.cfg for mower_cache_ttl seconds
+    mowerCache = MowerCache()
+    mowerCache.load_config()
+    if not refresh and mowerCache.cache_valid(config.login, config.mower_cache_ttl):
+        return mowerCache.robots, True
+    robots = mow.list_robots()
+    if config.mower_cache_ttl:
+        mowerCache.login = config.login
+        mowerCache.robots = robots
+        mowerCache.updated_on = datetime.now()
+        mowerCache.save_config()
+    return robots, False
+
+
+def select_cached_robot(mow, config, args, refresh=False):
+    robots, cached = load_robots(mow, config, refresh)
+    try:
+        mow.select_robot(args.mower, robots)
+    except CommandException:
+        if not cached:
+            raise
+        # The mower may have been added since the list was cached
+        return select_cached_robot(mow, config, args, refresh=True)
+    return cached
 
-            retry = 0
-        except CommandException as ce:
-            log_error(args, "[ERROR] Wrong parameters: %s" % ce)
-            break
-        except Exception as ex:
-            retry -= 1
-            if retry > 0:
-                log_error(args, "[ERROR] %s. Retrying to send the command %d" % (ex, 3- retry))
-            else:
-                log_error(args, "[ERROR] Failed to send the command")
-                break
 
-    logger.info("Done")
+def setup_api(config, tokenConfig, args):
+    mow = connect_api(config, tokenConfig, args)
+    select_cached_robot(mow, config, args)
+    return mow
 
-    if not args.token:
-        mow.logout()
 
+def geo_summary(args, mow=None):
+    # Analyzes the trail saved in args.trail, or the latest locations of the selected mower
+    from .geo import Trail
+    if mow is None:
+        trail = Trail(args.trail, args.cell, append=False)
+    else:
+        trail = Trail(cell_size=args.cell, geofence=mow.geo_status())
+        trail.update(mow.status(), time.time())
+    trail.close()
+    return trail.summary(args.heatmap)
 
-class HTTPRequestHandler(BaseHTTPRequestHandler):
-    config = None
-    tokenConfig = None
-    args = None
-    last_status = ""
-    last_status_check = 0
-
-    def do_GET(self):
-        logger.info("Try to execute " + self.path)
-
-        # use cache for status command
-        if self.path == '/status':
-            # XXX where do we store status properly ? Class variables are not thread safe...
-            if HTTPRequestHandler.last_status_check > time.time() - HTTPRequestHandler.config.expire_status:
-                logger.info("Get status from cache")
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(HTTPRequestHandler.last_status).encode('ascii'))
-                return
 
-        retry = 3
-        fatal = False
-        while retry > 0:
-            try:
-                mow = setup_api(HTTPRequestHandler.config, HTTPRequestHandler.tokenConfig, HTTPRequestHandler.args)
-
-                if self.path == '/start':
-                    mow.control('START')
-                    self.send_response(200)
-                    self.end_headers()
-                elif self.path == '/stop':
-                    mow.control('STOP')
-                    self.send_response(200)
-                    self.end_headers()
-                elif self.path == '/park':
-                    mow.control('PARK')
-                    self.send_response(200)
-                    self.end_headers()
-                elif self.path == '/status':
-                    logger.info("Get status from Husqvarna servers")
-                    HTTPRequestHandler.last_status = mow.status()
-                    HTTPRequestHandler.last_status_check = time.time()
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps(HTTPRequestHandler.last_status).encode('ascii'))
-                else:
-                    self.send_response(400)
-                    self.end_headers()
-
-                retry = 0
-            except CommandException as ce:
-                msg = "[ERROR] Wrong parameters: %s" % ce
-                logger.error(msg)
-                self.send_response(500, msg)
-                fatal = True
-                break
-            except Exception as ex:
-                retry -= 1
-                if retry > 0:
-                    logger.error(ex)
-                    logger.error("[ERROR] Retrying to send the command %d" % retry)
-                else:
-                    logger.error("[ERROR] Failed to send the command")
-                    self.send_response(500)
-
-            logger.info("Done")
-
-            if not HTTPRequestHandler.args.token:
-                mow.logout()
-            if fatal:
-                exit(1)
-
-
-def run_server(config, tokenConfig, args):
-    server_address = (args.address, args.port)
-    HTTPRequestHandler.config = config
-    HTTPRequestHandler.tokenConfig = tokenConfig
-    HTTPRequestHandler.args = args
-    httpd = HTTPServer(server_address, HTTPRequestHandler)
-    httpd.serve_forever()
+def make_output(args):
+    if args.json:
+        return lambda res: as_json(**{args.command: res})
+    import pprint
+    return pprint.PrettyPrinter(indent=2).pprint
+
+
+def run_cli(config, tokenConfig, args):
+    out = make_output(args)
+    mow = None
+    # Failed requests are already retried by the API with a backoff
+    try:
+        if args.command == 'control' and (args.mowers or args.all_mowers):
+            mow = connect_api(config, tokenConfig, args)
+            robots, cached = load_robots(mow, config)
+            results = []
+            if args.all_mowers:
+                selected = robots
+            else:
+                names = [name.strip() for name in args.mowers.split(',')]
+                known = {robot['name'] for robot in robots} | {robot['id'] for robot in robots}
+                if cached and not known.issuperset(names):
+                    # The mower may have been added since the list was cached
+                    robots, _ = load_robots(mow, config, refresh=True)
+                selected = []
+                for name in names:
+                    # Like POST /control of the server: an unknown mower fails, the others get the command
+                    try:
+                        selected.append(find_robot(robots, name))
+                    except CommandException as ce:
+                        results.append({'id': None, 'name': name, 'command': args.action, 'success': False,
+                                        'duration': 0, 'error': str(ce)})
+            results.extend(batch_control(mow.control, [(robot, args.action) for robot in selected]))
+            out(results)
+            for result in results:
+                if not result['success']:
+                    log_error(args, "[ERROR] Failed to send %s to %s: %s" % (
+                        args.action, result['name'], result['error']))
+            return
+        mow = connect_api(config, tokenConfig, args)
+        if args.command == 'list':
+            # Always ask the servers, this also refreshes the cached mower list
+            out(load_robots(mow, config, refresh=True)[0])
+            return
+        cached = select_cached_robot(mow, config, args)
+
+        def send_command():
+            if args.command == 'control':
+                mow.control(args.action)
+            elif args.command == 'status':
+                out(mow.status())
+            elif args.command == 'geo':
+                out(geo_summary(args, mow))
+
+        import requests
+        try:
+            send_command()
+        except requests.HTTPError as ex:
+            if not cached or ex.response.status_code != 404:
+                raise
+            # The cached mower id is outdated
+            select_cached_robot(mow, config, args, refresh=True)
+            send_command()
+    except CommandException as ce:
+        log_error(args, "[ERROR] Wrong parameters: %s" % ce)
+    except Exception as ex:
+        log_error(args, "[ERROR] Failed to send the command: %s" % ex)
+    finally:
+        logger.info("Done")
+
+        if not args.token and mow is not None and mow.token:
+            mow.logout()
+
+
+# The token of the long-lived server session is renewed this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 10 * 60
+
+
+def refresh_api(mow, config, tokenConfig, args, force=False):
+    if not force and mow.token_valid(TOKEN_REFRESH_MARGIN):
+        return
+    if not config.login or not config.password:
+        if not force and mow.token_valid():
+            # Nothing to renew it with: keep using the token until it really expires
+            return
+        raise CommandException('The token expired and no login or password is available to renew it')
+    logger.info('Renewing the token')
+    metrics.TOKEN_REFRESHES.inc()
+    login_api(mow, config, tokenConfig, args)
 
 
 def main():
@@ -400,10 +687,24 @@ def main():
     parser_control = subparsers.add_parser('control', help='Send command to your automower')
     parser_control.add_argument('action', choices=['STOP', 'START', 'PARK'],
                                 help='the command')
+    parser_control.add_argument('--mower', dest='mowers',
+                                help='Comma separated names or ids of the mowers to send the command to at once')
+    parser_control.add_argument('--all', dest='all_mowers', action='store_true',
+                                help='Send the command to all the mowers of the account at once')
 
     parser_list = subparsers.add_parser('list', help='List all the mowers connected to the account.')
     parser_status = subparsers.add_parser('status', help='Get the status of your automower')
 
+    parser_geo = subparsers.add_parser('geo', help='Analyze the locations of your automower: distance, coverage '
+                                                    'and distance from the geofence center. Requires numpy')
+    parser_geo.add_argument('--trail', dest='trail',
+                            help='Analyze a trail saved by "server --trail-dir" or husmow_logger --trail-file instead '
+                                 'of the latest locations of the mower')
+    parser_geo.add_argument('--cell', dest='cell', type=float, default=1.0,
+                            help='Side (meters) of the cells of the coverage heatmap')
+    parser_geo.add_argument('--heatmap', dest='heatmap', action='store_true',
+                            help='Include the coverage heatmap: the number of locations in each cell')
+
     parser_server = subparsers.add_parser('server', help='Run an http server to handle commands')
     parser_server.add_argument('--address', dest='address', default='127.0.0.1',
                                help='IP address for server')
@@ -411,6 +712,32 @@ def main():
                                help='port for server')
     parser_server.add_argument('--expire', dest='expire_status', type=int, default=30,
                                help='Status needs to be refreshed after this time')
+    parser_server.add_argument('--poll', dest='poll', type=int, default=0,
+                               help='Refresh the status of the mowers in background every POLL seconds. '
+                                    'The status is then always served from memory. 0 disables the polling')
+    parser_server.add_argument('--schedule', dest='schedule', choices=['fixed', 'adaptive'], default='fixed',
+                               help='When the status is polled, like with husmow_logger --schedule')
+    parser_server.add_argument('--poll-active', dest='poll_active', type=int,
+                               help='Polling interval (seconds) while the mower is mowing, with --schedule fixed. '
+                                    'Default is 30')
+    parser_server.add_argument('--poll-parked', dest='poll_parked', type=int, default=600,
+                               help='Maximal polling interval (seconds) while the mower is parked by the timer, '
+                                    'or in any status with --schedule adaptive')
+    parser_server.add_argument('--gzip', dest='gzip', action='store_true',
+                               help='Compress large responses when the client accepts gzip')
+    parser_server.add_argument('--daemon', dest='listen_socket', action='store_true',
+                               help='Also listen on the unix socket given by --socket. The status, control and '
+                                    'list commands are then forwarded to this server')
+    parser_server.add_argument('--history-db', dest='history_db',
+                               help='Record the status of the mowers in this SQLite database and serve it on /history')
+    parser_server.add_argument('--geo', dest='geo', action='store_true',
+                               help='Accumulate the locations of the mowers and serve their analysis on /geo. '
+                                    'Requires numpy')
+    parser_server.add_argument('--geo-cell', dest='geo_cell', type=float, default=1.0,
+                               help='Side (meters) of the cells of the coverage heatmap')
+    parser_server.add_argument('--trail-dir', dest='trail_dir',
+                               help='With --geo, save the locations of each mower in this directory and reload '
+                                    'them on restart')
 
     parser.add_argument('--login', dest='login', help='Your login')
     parser.add_argument('--password', dest='password', nargs='?', const=ask_password,
@@ -423,6 +750,24 @@ def main():
                         help='Logout an existing token saved in token.cfg')
     parser.add_argument('--mower', dest='mower',
                         help='Select the mower to use. It can be the name or the id of the mower. If not provied the first mower will be used.')
+    parser.add_argument('--mower-cache-ttl', dest='mower_cache_ttl', type=int,
+                        help='How long (in seconds) the list of the mowers is kept in mowers.cfg. '
+                             '0 disables the cache. Default is one day')
+    parser.add_argument('--socket', dest='socket', default='husmow.sock',
+                        help='Unix socket of the daemon started with "server --daemon"')
+    parser.add_argument('--no-daemon', dest='daemon', action='store_false',
+                        help='Do not forward status, control and list commands to a running daemon')
+    parser.add_argument('--auth-url', dest='auth_url',
+                        help='Base URL of the authentication API. Default is the Husqvarna one')
+    parser.add_argument('--track-url', dest='track_url',
+                        help='Base URL of the mower API. Default is the Husqvarna one')
+    parser.add_argument('--record', dest='record',
+                        help='Record the responses of Husqvarna servers in this file (gzip), for --replay')
+    parser.add_argument('--replay', dest='replay',
+                        help='Answer the requests with the responses recorded with --record instead of '
+                             'Husqvarna servers. The login and the password are not needed')
+    parser.add_argument('--speed', dest='speed', type=float, default=1,
+                        help='With --replay, how many times faster than the real time the recording is replayed')
     parser.add_argument('--log-level', dest='log_level', choices=['INFO', 'ERROR'],
                         help='Display all logs or just in case of error')
     parser.add_argument('--json', action='store_true',
@@ -436,6 +781,34 @@ def main():
     if args.json:
         args.log_level = 'ERROR'
 
+    if args.command == 'server' and args.schedule == 'adaptive' and args.poll_active is not None:
+        parser.error('--poll-active only applies to --schedule fixed')
+
+    if args.replay:
+        if args.speed <= 0:
+            parser.error('--speed must be positive')
+        # The replay accepts any login. Neither the token, the configuration nor the mower list are saved,
+        # and the daemon is not asked
+        args.login = args.login or 'replay'
+        args.password = args.password or 'replay'
+        args.token = False
+        args.save = False
+        args.mower_cache_ttl = 0
+        args.daemon = False
+
+    if args.daemon and not args.logout and args.command != 'server':
+        # A running server answers in a few milliseconds with its warm session and status cache
+        from .daemon import forward_command
+        if forward_command(args, make_output(args)):
+            if args.json and _errors:
+                as_json(errors=_errors)
+            exit(0)
+
+    if args.command == 'geo' and args.trail:
+        # A saved trail is analyzed offline
+        make_output(args)(geo_summary(args))
+        exit(0)
+
     config, tokenConfig = create_config(args)
     if not config:
         if args.json:
@@ -447,12 +820,13 @@ def main():
     configure_log(config)
 
     if args.logout and tokenConfig.token_valid():
-        mow = API()
+        mow = API(config.auth_url, config.track_url)
         mow.set_token(tokenConfig.token, tokenConfig.provider)
         mow.logout()
         tokenConfig = TokenConfig()
         tokenConfig.save_config()
     elif args.command == 'server':
+        from .server import run_server
         run_server(config, tokenConfig, args)
     else:
         run_cli(config, tokenConfig, args)
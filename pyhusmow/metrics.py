@@ -0,0 +1,155 @@
+import os
+import threading
+from bisect import bisect_left
+
+# Metrics in the Prometheus text format, served by husmow server on /metrics and written by husmow_logger
+# with --metrics-file. Updating a metric is a dict lookup under a lock: cheap enough to do on each request.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds (seconds) of the latency buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values]
+    return '{%s}' % ','.join('%s="%s"' % label for label in zip(names, escaped))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def label_values(labels):
+    # Label values are kept as strings: keys mixing an int and a str (a status code or 'error') still sort
+    return tuple(str(label) for label in labels)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labels, key, value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, values, value in self.samples():
+            lines.append('%s%s %s' % (name, format_labels(labels, values), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        if not self.labels:
+            # Exported from the start, so rates can be computed from 0
+            self.values[()] = 0
+
+    def inc(self, *labels, amount=1):
+        labels = label_values(labels)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        labels = label_values(labels)
+        with self.lock:
+            self.values[labels] = value
+
+    def remove(self, *labels):
+        labels = label_values(labels)
+        with self.lock:
+            self.values.pop(labels, None)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        labels = label_values(labels)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One count per bucket, then the sum of the values
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in sorted(self.values.items())]
+        samples = []
+        bucket_labels = self.labels + ('le',)
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                samples.append((self.name + '_bucket', bucket_labels, key + (format_value(bound),), total))
+            samples.append((self.name + '_sum', self.labels, key, counts[-1]))
+            samples.append((self.name + '_count', self.labels, key, total))
+        return samples
+
+
+API_REQUESTS = Counter('husmow_api_requests_total', 'Requests sent to Husqvarna servers, by API operation and '
+                       'HTTP status (error when no answer was received)', ['operation', 'code'])
+API_LATENCY = Histogram('husmow_api_request_duration_seconds', 'Duration of the requests sent to Husqvarna '
+                        'servers, by API operation', ['operation'])
+API_RETRIES = Counter('husmow_api_retries_total', 'Requests to Husqvarna servers retried, by API operation',
+                      ['operation'])
+STATUS_CACHE = Counter('husmow_status_cache_total', 'Status requests of husmow server answered from the cache '
+                       '(hit) or from Husqvarna servers (miss)', ['result'])
+TOKEN_REFRESHES = Counter('husmow_token_refreshes_total', 'Logins done to renew the token')
+MOWER_BATTERY = Gauge('husmow_mower_battery_percent', 'Battery level of the mower', ['mower'])
+MOWER_STATUS = Gauge('husmow_mower_status', 'Current status of the mower: 1 for its status', ['mower', 'status'])
+MOWER_UPDATED = Gauge('husmow_mower_status_updated_seconds', 'Time when the status of the mower was fetched',
+                      ['mower'])
+
+METRICS = [API_REQUESTS, API_LATENCY, API_RETRIES, STATUS_CACHE, TOKEN_REFRESHES, MOWER_BATTERY, MOWER_STATUS,
+           MOWER_UPDATED]
+
+# Last status of each mower, to remove its series from MOWER_STATUS when it changes
+_mower_status = {}
+_mower_status_lock = threading.Lock()
+
+
+def observe_status(mower, status, updated):
+    MOWER_BATTERY.set(status['batteryPercent'], mower)
+    MOWER_UPDATED.set(updated, mower)
+    with _mower_status_lock:
+        previous = _mower_status.get(mower)
+        if previous is not None and previous != status['mowerStatus']:
+            MOWER_STATUS.remove(mower, previous)
+        _mower_status[mower] = status['mowerStatus']
+        MOWER_STATUS.set(1, mower, status['mowerStatus'])
+
+
+def render():
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
+
+
+def write_textfile(path):
+    # Written in a temporary file then renamed, so a collector never reads a partial file
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(render())
+    os.replace(tmp, path)
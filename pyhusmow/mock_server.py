@@ -0,0 +1,258 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Husqvarna token and mower APIs, to develop and benchmark without an account:
+#
+#     python -m pyhusmow.mock_server --port 8080 --mowers 3 --latency 0.2 --error-rate 0.05
+#     husmow --login me --password secret --auth-url http://127.0.0.1:8080/ --track-url http://127.0.0.1:8080/ status
+#
+# Each mower goes through a mowing cycle (leaving, cutting, searching, charging, parked by the timer) driven
+# by the clock, moving along a circle while it mows. Control commands override the cycle.
+
+CYCLE = [('OK_LEAVING', 0.05), ('OK_CUTTING', 0.45), ('OK_SEARCHING', 0.05), ('OK_CHARGING', 0.3),
+         ('PARKED_TIMER', 0.15)]
+# Points kept in lastLocations, the latest first
+TRAIL_SIZE = 50
+CENTER = (45.0, 5.0)
+
+
+class MockMower:
+    def __init__(self, index, period):
+        self.id = '%06d-%06d' % (index, random.randint(0, 999999))
+        self.name = 'mower%d' % (index + 1)
+        self.period = period
+        # Spread the mowers over the cycle
+        self.offset = index * period / 7.0
+        self.override = None
+
+    def phase(self, now):
+        position = ((now + self.offset) % self.period) / self.period
+        start = 0
+        for status, duration in CYCLE:
+            if position < start + duration:
+                return status, (position - start) / duration, start
+            start += duration
+        return CYCLE[-1][0], 1, start
+
+    def location(self, now):
+        angle = (now + self.offset) / self.period * 40 * math.pi
+        radius = 0.0002 * (1 + math.sin(angle / 7))
+        return {'latitude': round(CENTER[0] + radius * math.cos(angle), 7),
+                'longitude': round(CENTER[1] + radius * math.sin(angle), 7),
+                'gpsStatus': 'USING_GPS'}
+
+    def status(self, now):
+        status, progress, _ = self.phase(now)
+        if status in ('OK_LEAVING', 'OK_CUTTING', 'OK_SEARCHING'):
+            battery = 100 - int(progress * 30) if status != 'OK_CUTTING' else 95 - int(progress * 70)
+        elif status == 'OK_CHARGING':
+            battery = 20 + int(progress * 80)
+        else:
+            battery = 100
+        if self.override is not None:
+            status = self.override
+        # A location is recorded every step seconds: successive statuses share most of their locations
+        step = self.period / 400.0
+        latest = now - now % step
+        locations = [self.location(latest - i * step) for i in range(TRAIL_SIZE)]
+        next_start = 0
+        if status == 'PARKED_TIMER':
+            # Local time expressed as a UTC timestamp, like the real API
+            remaining = (1 - progress) * CYCLE[-1][1] * self.period
+            next_start = int(now + remaining - time.timezone)
+        return {
+            'batteryPercent': battery,
+            'connected': True,
+            'lastErrorCode': 0,
+            'lastErrorCodeTimestamp': 0,
+            'mowerStatus': status,
+            'nextStartSource': 'WEEK_TIMER' if next_start else 'NO_SOURCE',
+            'nextStartTimestamp': next_start,
+            'operatingMode': 'AUTO',
+            'storedTimestamp': int(now * 1000),
+            'showAsDisconnected': False,
+            'valueFound': True,
+            'cachedSettingsUUID': self.id,
+            'lastLocations': locations,
+        }
+
+    def geofence(self):
+        return {
+            'centralPoint': {
+                'location': {'latitude': CENTER[0], 'longitude': CENTER[1]},
+                'sensitivity': {'level': 'MEDIUM', 'radius': 50}
+            },
+            'geoFenceEnabled': True,
+        }
+
+    def control(self, action):
+        self.override = {'PARK': 'PARKED_PARKED_SELECTED', 'STOP': 'PAUSED', 'START': None}[action]
+
+
+class MockState:
+    def __init__(self, mowers=1, period=3600, latency=0, jitter=0, error_rate=0, throttle_rate=0,
+                 token_ttl=3600):
+        self.mowers = [MockMower(i, period) for i in range(mowers)]
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.token_ttl = token_ttl
+        self.tokens = {}
+        self.lock = threading.Lock()
+        # Number of requests received per (method, route)
+        self.calls = {}
+
+    def count(self, method, route):
+        with self.lock:
+            key = '%s %s' % (method, route)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def find(self, mower_id):
+        for mower in self.mowers:
+            if mower.id == mower_id:
+                return mower
+        return None
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, code=200, headers=None):
+        body = json.dumps(obj).encode('ascii') if obj is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def inject(self):
+        # Simulated network latency and failures. Returns True when the request was answered with an error
+        state = self.state
+        delay = state.latency + random.uniform(0, state.jitter)
+        if delay:
+            time.sleep(delay)
+        draw = random.random()
+        if draw < state.throttle_rate:
+            self.send_json({'errors': [{'status': '429'}]}, 429, {'Retry-After': '1'})
+            return True
+        if draw < state.throttle_rate + state.error_rate:
+            self.send_json({'errors': [{'status': '503'}]}, 503)
+            return True
+        return False
+
+    def authorized(self):
+        header = self.headers.get('Authorization', '')
+        token = header[len('Bearer '):] if header.startswith('Bearer ') else None
+        with self.state.lock:
+            expire_on = self.state.tokens.get(token)
+        if expire_on is None or expire_on < time.time():
+            self.send_json({'errors': [{'status': '401'}]}, 401)
+            return False
+        return True
+
+    def route(self, method):
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        self.state.count(method, '/'.join(parts[:1] + ['<id>'] * (len(parts) > 1) + parts[2:]))
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        if self.inject():
+            return
+
+        if method == 'POST' and parts == ['token']:
+            token = str(uuid.uuid4())
+            with self.state.lock:
+                self.state.tokens[token] = time.time() + self.state.token_ttl
+            return self.send_json({'data': {'id': token, 'type': 'token', 'attributes': {
+                'expires_in': self.state.token_ttl, 'provider': 'husqvarna', 'user_id': 'mock'}}}, 201)
+        if method == 'DELETE' and len(parts) == 2 and parts[0] == 'token':
+            with self.state.lock:
+                self.state.tokens.pop(parts[1], None)
+            return self.send_json(None, 204)
+        if not self.authorized():
+            return
+        if method == 'GET' and parts == ['mowers']:
+            return self.send_json([{'id': mower.id, 'name': mower.name, 'model': 'mock'}
+                                   for mower in self.state.mowers])
+        mower = self.state.find(parts[1]) if len(parts) == 3 and parts[0] == 'mowers' else None
+        if mower is None:
+            return self.send_json({'errors': [{'status': '404'}]}, 404)
+        if method == 'GET' and parts[2] == 'status':
+            return self.send_json(mower.status(time.time()))
+        if method == 'GET' and parts[2] == 'geofence':
+            return self.send_json(mower.geofence())
+        if method == 'POST' and parts[2] == 'control':
+            action = (body or {}).get('action')
+            if action not in ('PARK', 'STOP', 'START'):
+                return self.send_json({'errors': [{'status': '400'}]}, 400)
+            mower.control(action)
+            return self.send_json({'status': 'OK'})
+        self.send_json({'errors': [{'status': '404'}]}, 404)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start_mock_server(address='127.0.0.1', port=0, **kwargs):
+    # Starts the mock in a background thread. Returns the server, its base URL and its state
+    state = MockState(**kwargs)
+    handler = type('MockRequestHandler', (MockRequestHandler,), {'state': state})
+    httpd = MockHTTPServer((address, port), handler)
+    threading.Thread(target=httpd.serve_forever, name='mock-server', daemon=True).start()
+    return httpd, 'http://%s:%d/' % httpd.server_address[:2], state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Husqvarna APIs.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--address', default='127.0.0.1', help='IP address for server')
+    parser.add_argument('--port', type=int, default=8080, help='port for server')
+    parser.add_argument('--mowers', type=int, default=1, help='Number of mowers of the account')
+    parser.add_argument('--period', type=float, default=3600,
+                        help='Duration (seconds) of a complete mowing and charging cycle')
+    parser.add_argument('--latency', type=float, default=0, help='Delay (seconds) added to each answer')
+    parser.add_argument('--jitter', type=float, default=0, help='Random delay (seconds) added to the latency')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0,
+                        help='Ratio of the requests answered with 503')
+    parser.add_argument('--throttle-rate', dest='throttle_rate', type=float, default=0,
+                        help='Ratio of the requests answered with 429 and Retry-After')
+    parser.add_argument('--token-ttl', dest='token_ttl', type=int, default=3600,
+                        help='Validity (seconds) of the tokens')
+    args = parser.parse_args()
+
+    httpd, url, state = start_mock_server(args.address, args.port, mowers=args.mowers, period=args.period,
+                                          latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                          throttle_rate=args.throttle_rate, token_ttl=args.token_ttl)
+    print('Mock Husqvarna API listening on %s' % url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        httpd.shutdown()
+        print(json.dumps(state.calls, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import gzip
+import json
+import random
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+from http.client import responses
+
+import requests
+
+# Recording and replay of the traffic with Husqvarna servers, to run husmow server or husmow_logger without
+# network: the caching and the scheduling can be benchmarked and compared on the same traffic.
+#
+# A recording is a gzip file with one JSON object per response received: its time, the method, the URL
+# relative to the base URL of the API, the HTTP status and the body (except for the authentication API, to keep
+# the tokens out of the file). Requests that got no answer are recorded with the code null. A few days of
+# polling take a few hundred kilobytes: the statuses compress well.
+#
+# The replay answers each request with the latest response recorded for the same method and URL before the
+# current time of a virtual clock. The clock starts at the time of the first response and runs speed times
+# faster than the real time. With speed 0, only the sleeps of the logger advance it: the logger replays a day
+# in a few seconds, always polling at the same times. The recordings and replays happen at the session level:
+# the API still retries, opens its circuit breaker and counts its metrics.
+
+# Response to the logins replayed
+TOKEN_BODY = json.dumps({'data': {'id': 'replay', 'type': 'token',
+                                  'attributes': {'expires_in': 24 * 3600, 'provider': 'husqvarna'}}})
+
+
+class Clock:
+    # Real time
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, waiter, timeout):
+        # waiter is a threading.Event or a threading.Condition
+        return waiter.wait(timeout)
+
+
+class VirtualClock(Clock):
+    def __init__(self, start, speed=0):
+        self.start = start
+        self.speed = speed
+        self.origin = time.monotonic()
+        # Time added by the sleeps when speed is 0
+        self.skipped = 0.0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.start + self.skipped + (time.monotonic() - self.origin) * self.speed
+
+    def now(self):
+        return datetime.fromtimestamp(self.time())
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        else:
+            with self.lock:
+                self.skipped += seconds
+
+    def wait(self, waiter, timeout):
+        if self.speed:
+            return waiter.wait(timeout / self.speed)
+        self.sleep(timeout)
+        return waiter.wait(0)
+
+
+SYSTEM_CLOCK = Clock()
+
+
+def relative_url(url, bases):
+    # Returns (path, auth) of url: its path relative to the base URLs of the API, and whether it is a request
+    # of the authentication API. The token in the URL of a logout is dropped
+    for base in bases:
+        if base and url.startswith(base):
+            path = url[len(base):]
+            if path.split('/')[0] == 'token':
+                return 'token', True
+            return path, False
+    return url, False
+
+
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+            # Each record is a complete gzip block: the recording survives a crash
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RecordingSession(requests.Session):
+    def __init__(self, recorder, bases):
+        super(RecordingSession, self).__init__()
+        self.recorder = recorder
+        self.bases = bases
+
+    def request(self, method, url, **kwargs):
+        path, auth = relative_url(url, self.bases)
+        record = {'t': round(time.time(), 3), 'method': method.lower(), 'url': path}
+        try:
+            response = super(RecordingSession, self).request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            record['code'] = None
+            self.recorder.write(record)
+            raise
+        record['code'] = response.status_code
+        if not auth:
+            record['body'] = response.text
+        if 'Retry-After' in response.headers:
+            record['retry_after'] = response.headers['Retry-After']
+        self.recorder.write(record)
+        return response
+
+
+def read_records(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.endswith('\n'):
+                    yield json.loads(line)
+        except EOFError:
+            # The recorder was killed: its last block is complete but the file has no gzip trailer
+            pass
+
+
+class Replay:
+    def __init__(self, path, speed=0):
+        # Records of each (method, url), in chronological order
+        self.records = {}
+        for record in read_records(path):
+            self.records.setdefault((record['method'], record['url']), []).append(record)
+        if not self.records:
+            raise ValueError('%s has no recorded response' % path)
+        for records in self.records.values():
+            records.sort(key=lambda record: record['t'])
+        self.times = {key: [record['t'] for record in records] for key, records in self.records.items()}
+        self.clock = VirtualClock(min(times[0] for times in self.times.values()), speed)
+
+    def find(self, method, url):
+        # Latest record before the current time, the first one when the clock is before all of them
+        key = (method, url)
+        records = self.records.get(key)
+        if not records:
+            return None
+        return records[max(0, bisect_right(self.times[key], self.clock.time()) - 1)]
+
+
+def make_response(url, code, body, retry_after=None):
+    response = requests.Response()
+    response.status_code = code
+    response.reason = responses.get(code, '')
+    response.url = url
+    response.encoding = 'utf-8'
+    response._content = body.encode('utf-8')
+    response.headers['Content-Type'] = 'application/json'
+    if retry_after is not None:
+        response.headers['Retry-After'] = retry_after
+    return response
+
+
+class ReplaySession(requests.Session):
+    def __init__(self, replay, bases):
+        super(ReplaySession, self).__init__()
+        self.replay = replay
+        self.bases = bases
+
+    def request(self, method, url, **kwargs):
+        method = method.lower()
+        path, auth = relative_url(url, self.bases)
+        record = self.replay.find(method, path)
+        if record is None:
+            # The recording may have been done with a saved token, and without any command sent to the mowers
+            record = {'code': 404 if method == 'get' else 200}
+        if record['code'] is None:
+            raise requests.ConnectionError('Recorded connection error for %s %s' % (method.upper(), url))
+        body = record.get('body')
+        if body is None:
+            # A successful login gets a fake token
+            body = TOKEN_BODY if auth and method == 'post' and record['code'] < 400 else '{}'
+        return make_response(url, record['code'], body, record.get('retry_after'))
+
+
+# Replays are loaded once, to share the clock between the API and its users
+_replays = {}
+_replays_lock = threading.Lock()
+
+
+def load_replay(path, speed):
+    with _replays_lock:
+        if path not in _replays:
+            _replays[path] = Replay(path, speed)
+        return _replays[path]
+
+
+def make_clock(args):
+    # Virtual clock of the replay given by --replay, the real time otherwise
+    if not getattr(args, 'replay', None):
+        return SYSTEM_CLOCK
+    return load_replay(args.replay, args.speed).clock
+
+
+def install(mow, args):
+    # Records or replays the traffic of mow, as requested by --record and --replay
+    bases = (mow.auth_url, mow.track_url)
+    if getattr(args, 'replay', None):
+        replay = load_replay(args.replay, args.speed)
+        mow.session = ReplaySession(replay, bases)
+        # The retries and the circuit breaker follow the virtual time. The rate limit protects Husqvarna
+        # servers, not the recording
+        mow.sleep = replay.clock.sleep
+        mow.random = random.Random(0)
+        mow.circuit_breaker.timefunc = replay.clock.time
+        mow.rate_limiter.rate = 10 ** 9
+    elif getattr(args, 'record', None):
+        mow.session = RecordingSession(Recorder(args.record), bases)
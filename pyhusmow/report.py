@@ -0,0 +1,228 @@
+import io
+import json
+import os
+from datetime import datetime, timedelta
+
+from .scheduling import MOWING_STATUSES, TRANSIENT_STATUSES
+
+# Daily statistics over the files written by husmow_logger (csv or jsonl, possibly rotated and compressed
+# with gzip or zstd). The files are read in a single pass, by chunks of samples, so the memory used does not
+# depend on their size. The chunks are processed with NumPy when it is installed.
+#
+# The time between two samples of a mower is attributed to the status of the first one, on the day of the
+# first one. Longer gaps than max_gap (the logger was stopped) are not attributed.
+
+MOWING = 1
+CHARGING = 2
+# Using the battery: mowing, leaving or searching the charging station
+ACTIVE = 4
+ERROR = 8
+
+ERROR_STATUSES = ('OFF_HATCH_OPEN', 'OFF_HATCH_CLOSED')
+# Naive local times are counted from this date: whole days are local days
+_EPOCH = datetime(1970, 1, 1)
+DAY = 24 * 3600
+
+FIELDS = ['day', 'mower', 'samples', 'mowing hours', 'charging hours', 'discharge %/h', 'charge %/h', 'errors']
+
+
+def status_kind(status):
+    kind = 0
+    if status in MOWING_STATUSES:
+        kind |= MOWING | ACTIVE
+    elif status in TRANSIENT_STATUSES:
+        kind |= ACTIVE
+    elif status == 'OK_CHARGING':
+        kind |= CHARGING
+    if status.startswith('ERROR') or status in ERROR_STATUSES:
+        kind |= ERROR
+    return kind
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rt')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('zstd files require the zstandard package')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    return open(path)
+
+
+def read_samples(path):
+    # Yields (mower, time, status, battery) of each sample of a csv or jsonl log file. time is in seconds
+    # since _EPOCH. Files without mower column are named after the file
+    default_mower = os.path.basename(path).split('.')[0]
+    with open_log(path) as f:
+        columns = None
+        for line in f:
+            if not line.strip():
+                continue
+            if line.startswith('{'):
+                sample = json.loads(line)
+                yield (sample.get('mower') or default_mower,
+                       (datetime.fromisoformat(sample['time']) - _EPOCH).total_seconds(),
+                       sample['status'], sample['battery'])
+                continue
+            if columns is None or line.startswith('time,') or line.startswith('mower,'):
+                # Header of the file or of a segment appended later
+                columns = line.rstrip('\n').split(',')
+                tagged = columns[0] == 'mower'
+                continue
+            # The status duration can contain a comma: only split the first columns
+            values = line.split(',', 4)
+            if tagged:
+                mower, sample_time, status, battery = values[:4]
+            else:
+                mower = default_mower
+                sample_time, status, battery = values[:3]
+            yield mower, (datetime.fromisoformat(sample_time) - _EPOCH).total_seconds(), status, int(battery)
+
+
+def first_sample_time(path):
+    # The files are read in chronological order, whatever the names of the rotated segments
+    for _, sample_time, _, _ in read_samples(path):
+        return sample_time
+    return 0
+
+
+class Report:
+    def __init__(self, max_gap=2 * 3600):
+        self.max_gap = max_gap
+        # Last sample (time, kind, battery) of each mower, to continue in the next chunk
+        self.last = {}
+        self.kinds = {}
+        # Statistics by (day, mower)
+        self.days = {}
+
+    def kind(self, status):
+        kind = self.kinds.get(status)
+        if kind is None:
+            kind = self.kinds[status] = status_kind(status)
+        return kind
+
+    def day(self, day, mower):
+        key = (day, mower)
+        stats = self.days.get(key)
+        if stats is None:
+            stats = self.days[key] = dict(samples=0, mowing=0.0, charging=0.0, drain_time=0.0, drain=0.0,
+                                          charge_time=0.0, charge=0.0, errors=0)
+        return stats
+
+    def add_files(self, paths, chunk_size=64 * 1024):
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        chunk = []
+        for path in sorted(paths, key=first_sample_time):
+            for sample in read_samples(path):
+                chunk.append(sample)
+                if len(chunk) >= chunk_size:
+                    self.add_chunk(np, chunk)
+                    chunk = []
+        if chunk:
+            self.add_chunk(np, chunk)
+
+    def add_chunk(self, np, samples):
+        by_mower = {}
+        for mower, sample_time, status, battery in samples:
+            by_mower.setdefault(mower, []).append((sample_time, self.kind(status), battery))
+        for mower, rows in by_mower.items():
+            if np is not None:
+                self.add_numpy(np, mower, rows)
+            else:
+                self.add_python(mower, rows)
+            self.last[mower] = rows[-1]
+
+    def add_python(self, mower, rows):
+        for sample_time, _, _ in rows:
+            self.day(int(sample_time // DAY), mower)['samples'] += 1
+        previous = self.last.get(mower)
+        for current in rows:
+            if previous is not None:
+                self.add_interval(mower, previous, current)
+            previous = current
+
+    def add_interval(self, mower, previous, current):
+        start, kind, battery = previous
+        end, next_kind, next_battery = current
+        if next_kind & ERROR and not kind & ERROR:
+            self.day(int(end // DAY), mower)['errors'] += 1
+        duration = end - start
+        if duration <= 0 or duration > self.max_gap:
+            return
+        stats = self.day(int(start // DAY), mower)
+        if kind & MOWING:
+            stats['mowing'] += duration
+        if kind & CHARGING:
+            stats['charging'] += duration
+        if kind & next_kind & ACTIVE:
+            stats['drain_time'] += duration
+            stats['drain'] += battery - next_battery
+        if kind & next_kind & CHARGING:
+            stats['charge_time'] += duration
+            stats['charge'] += next_battery - battery
+
+    def add_numpy(self, np, mower, rows):
+        previous = self.last.get(mower)
+        data = np.array(([previous] if previous is not None else []) + rows, dtype=np.float64)
+        times, kinds, batteries = data[:, 0], data[:, 1].astype(np.int64), data[:, 2]
+        self.accumulate(np, mower, 'samples', times[len(data) - len(rows):], None)
+        if len(data) < 2:
+            return
+        kind, next_kind = kinds[:-1], kinds[1:]
+        durations = np.diff(times)
+        drops = -np.diff(batteries)
+        valid = (durations > 0) & (durations <= self.max_gap)
+        starts = times[:-1]
+        errors = (next_kind & ERROR).astype(bool) & ~(kind & ERROR).astype(bool)
+        self.accumulate(np, mower, 'errors', times[1:][errors], None)
+        mask = valid & (kind & MOWING).astype(bool)
+        self.accumulate(np, mower, 'mowing', starts[mask], durations[mask])
+        mask = valid & (kind & CHARGING).astype(bool)
+        self.accumulate(np, mower, 'charging', starts[mask], durations[mask])
+        mask = valid & (kind & next_kind & ACTIVE).astype(bool)
+        self.accumulate(np, mower, 'drain_time', starts[mask], durations[mask])
+        self.accumulate(np, mower, 'drain', starts[mask], drops[mask])
+        mask = valid & (kind & next_kind & CHARGING).astype(bool)
+        self.accumulate(np, mower, 'charge_time', starts[mask], durations[mask])
+        self.accumulate(np, mower, 'charge', starts[mask], -drops[mask])
+
+    def accumulate(self, np, mower, field, times, values):
+        # Adds values (1 for each time when None) to the field of the day of each time
+        if not len(times):
+            return
+        days, inverse = np.unique((times // DAY).astype(np.int64), return_inverse=True)
+        sums = np.bincount(inverse, weights=values)
+        for day, value in zip(days.tolist(), sums.tolist()):
+            stats = self.day(day, mower)
+            stats[field] += int(value) if values is None else value
+
+    def rows(self):
+        for (day, mower), stats in sorted(self.days.items()):
+            drain_time, charge_time = stats['drain_time'], stats['charge_time']
+            yield {
+                'day': (_EPOCH + timedelta(day)).date().isoformat(),
+                'mower': mower,
+                'samples': stats['samples'],
+                'mowing hours': round(stats['mowing'] / 3600, 2),
+                'charging hours': round(stats['charging'] / 3600, 2),
+                'discharge %/h': round(stats['drain'] * 3600 / drain_time, 1) if drain_time else None,
+                'charge %/h': round(stats['charge'] * 3600 / charge_time, 1) if charge_time else None,
+                'errors': stats['errors'],
+            }
+
+
+def run_report(args):
+    report = Report(args.max_gap)
+    report.add_files(args.files)
+    if args.json:
+        print(json.dumps(list(report.rows()), indent=2))
+        return
+    print(','.join(FIELDS))
+    for row in report.rows():
+        print(','.join('' if row[field] is None else str(row[field]) for field in FIELDS))
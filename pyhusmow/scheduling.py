@@ -0,0 +1,124 @@
+from datetime import datetime
+
+# Scheduling policies decide when the status of a mower is polled next, from the status just received.
+# There is one policy per mower: a policy can keep what it learnt from the previous statuses.
+#
+#     policy = make_policy('adaptive', delay=60, max_delay=1800)
+#     delay = policy.next_delay(status, time())    # after each status
+#     delay = policy.error_delay(time())           # after each failed poll
+
+# Statuses in which the mower mows until its battery is low
+MOWING_STATUSES = ('OK_CUTTING', 'OK_CUTTING_NOT_AUTO')
+# Statuses that only last a few minutes: leaving the charging station or searching for it
+TRANSIENT_STATUSES = ('OK_LEAVING', 'OK_SEARCHING')
+
+
+def next_start(status):
+    # nextStartTimestamp is the local time of the next start, expressed as a UTC timestamp
+    if not status.get('nextStartTimestamp'):
+        return None
+    return datetime.utcfromtimestamp(status['nextStartTimestamp']).timestamp()
+
+
+class FixedPolicy:
+    # Polls every delay seconds, every active_delay seconds (when shorter) while the mower moves. A mower
+    # parked by the timer with a full battery is not polled until start_lead seconds before its next start,
+    # or for max_delay seconds when given
+    def __init__(self, delay, start_lead=2 * 60, max_delay=None, active_delay=None):
+        self.delay = delay
+        self.start_lead = start_lead
+        self.max_delay = max_delay
+        self.active_delay = active_delay
+
+    def next_delay(self, status, now):
+        if status['mowerStatus'] in MOWING_STATUSES + TRANSIENT_STATUSES and self.active_delay:
+            return min(self.delay, self.active_delay)
+        if status['mowerStatus'] == 'PARKED_TIMER' and status['batteryPercent'] == 100:
+            start = next_start(status)
+            # fallback to the usual operation if the start is not in the future
+            if start is not None and start - self.start_lead > now:
+                delay = start - self.start_lead - now
+                return max(self.delay, min(delay, self.max_delay)) if self.max_delay else delay
+        return self.delay
+
+    def error_delay(self, now):
+        return self.delay
+
+
+class AdaptivePolicy:
+    # Polls every delay seconds around the events, and less often when the next event can be predicted:
+    # - for settle seconds after a status change, to catch the transitions that quickly follow each other,
+    #   and while the mower leaves or searches the charging station
+    # - while charging, at half the time left until the battery is full, estimated from the charging rate
+    # - while mowing, at half the time left until the battery is low, estimated from the discharge rate
+    # - while parked with a scheduled start, until start_lead seconds before the start
+    # - in the other statuses, at half the time elapsed since the status changed
+    # The delays are capped by max_delay. Failed polls are retried with an exponential backoff.
+    def __init__(self, delay, max_delay=30 * 60, start_lead=2 * 60, settle=None, low_battery=30):
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        self.start_lead = start_lead
+        self.settle = 5 * delay if settle is None else settle
+        self.low_battery = low_battery
+        self.status = None
+        # (time, battery) of the first sample in the current status
+        self.first = None
+        self.changed = None
+        self.errors = 0
+
+    def clamp(self, delay):
+        return max(self.delay, min(self.max_delay, delay))
+
+    def battery_rate(self, now, battery):
+        # Battery change (percent per second) since the status changed. None until the battery changed
+        first_time, first_battery = self.first
+        if now <= first_time or battery == first_battery:
+            return None
+        return (battery - first_battery) / (now - first_time)
+
+    def next_delay(self, status, now):
+        self.errors = 0
+        mower_status = status['mowerStatus']
+        battery = status['batteryPercent']
+        if mower_status != self.status:
+            self.status = mower_status
+            self.changed = now
+            self.first = (now, battery)
+        if now - self.changed < self.settle or mower_status in TRANSIENT_STATUSES:
+            return self.delay
+
+        start = next_start(status)
+        if start is not None and mower_status.startswith('PARKED'):
+            if start - self.start_lead > now:
+                return self.clamp(start - self.start_lead - now)
+            if start + self.settle > now:
+                return self.delay
+
+        rate = self.battery_rate(now, battery)
+        if mower_status == 'OK_CHARGING':
+            if battery >= 100:
+                # Charged: the mower leaves or parks soon
+                return self.delay
+            if rate is not None and rate > 0:
+                return self.clamp((100 - battery) / rate / 2)
+            return self.delay
+        if mower_status in MOWING_STATUSES:
+            if rate is not None and rate < 0 and battery > self.low_battery:
+                return self.clamp((battery - self.low_battery) / -rate / 2)
+            return self.delay
+        return self.clamp((now - self.changed) / 2)
+
+    def error_delay(self, now):
+        self.errors += 1
+        return self.clamp(self.delay * 2 ** (self.errors - 1))
+
+
+POLICIES = {
+    'fixed': FixedPolicy,
+    'adaptive': AdaptivePolicy,
+}
+
+
+def make_policy(name, delay, **kwargs):
+    # The options are those of the policy: an option it does not support raises a TypeError
+    return POLICIES[name](delay, **kwargs)
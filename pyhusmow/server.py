@@ -0,0 +1,631 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from socketserver import ThreadingUnixStreamServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import requests
+
+from . import metrics
+from .daemon import daemon_running
+from .history import HistoryStore, parse_time
+from .husmow import CircuitOpenException, CommandException, batch_control, connect_api, find_robot, refresh_api
+from .replay import SYSTEM_CLOCK, make_clock
+from .scheduling import make_policy
+
+logger = logging.getLogger("main")
+
+
+# Longest time a long-poll request waits for a change
+MAX_WAIT = 300
+# Delay between two keep-alive comments sent to the event stream subscribers
+KEEP_ALIVE = 15
+
+# Responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+# Default polling interval (seconds) while the mower moves, with --poll and --schedule fixed
+POLL_ACTIVE = 30
+
+
+def make_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+def gzip_etag(etag):
+    # A strong validator changes with the content coding: the gzipped body has its own
+    return etag[:-1] + '-gzip"'
+
+
+class CachedStatus:
+    def __init__(self, status, updated, previous=None, clock=SYSTEM_CLOCK):
+        self.status = status
+        self.clock = clock
+        self.updated = updated
+        # The response is encoded once per refresh and shared by all the requests
+        self.body = json.dumps(status).encode('ascii')
+        if previous is not None and previous.body == self.body:
+            self.etag = previous.etag
+            self.modified = previous.modified
+        else:
+            self.etag = make_etag(self.body)
+            self.modified = updated
+        self._gzipped = None
+
+    def age(self):
+        return self.clock.time() - self.updated
+
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body)
+        return self._gzipped
+
+
+class StatusChange:
+    def __init__(self, version, entry):
+        status = entry.status
+        locations = status.get('lastLocations') or []
+        self.version = version
+        # Only these fields are watched: a new status with the same key is not a change
+        self.key = (status.get('mowerStatus'), status.get('batteryPercent'), locations[0] if locations else None)
+        self.body = json.dumps({
+            'version': version,
+            'mowerStatus': self.key[0],
+            'batteryPercent': self.key[1],
+            'location': self.key[2],
+            'updated': entry.updated
+        }).encode('ascii')
+
+
+class StatusCache:
+    def __init__(self, expire, on_update=None, clock=SYSTEM_CLOCK):
+        # expire is None when a poller keeps the cache up to date
+        self.expire = expire
+        # Virtual clock of a replay, or the real time
+        self.clock = clock
+        # Called with each new entry fetched from Husqvarna servers
+        self.on_update = on_update
+        self.cond = threading.Condition()
+        self.entry = None
+        self.change = None
+        self.error = None
+        self.fetching = False
+
+    def fresh(self):
+        return self.entry is not None and (self.expire is None or self.entry.age() < self.expire)
+
+    def get(self, fetch, force=False):
+        # Returns (entry, cached). Concurrent misses wait for a single call to fetch and share its result
+        with self.cond:
+            if not force and self.fresh():
+                return self.entry, True
+            if self.fetching:
+                while self.fetching:
+                    self.cond.wait()
+                if self.error is not None:
+                    raise self.error
+                return self.entry, True
+            self.fetching = True
+        try:
+            status = fetch()
+        except Exception as ex:
+            with self.cond:
+                self.error = ex
+                self.fetching = False
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            entry = CachedStatus(status, self.clock.time(), self.entry, self.clock)
+            self.entry = entry
+            change = StatusChange(self.change.version + 1 if self.change else 1, entry)
+            if self.change is None or change.key != self.change.key:
+                self.change = change
+            self.error = None
+            self.fetching = False
+            self.cond.notify_all()
+        if self.on_update is not None:
+            self.on_update(entry)
+        return entry, False
+
+    def wait_change(self, version, timeout):
+        # Returns the latest change when it is not version, None if nothing changed before timeout. A version
+        # newer than the latest one was given by a previous run of the server: the versions restart at 1
+        deadline = self.clock.time() + timeout
+        with self.cond:
+            while self.change is None or self.change.version == version:
+                remaining = deadline - self.clock.time()
+                if remaining <= 0:
+                    return None
+                self.clock.wait(self.cond, remaining)
+            return self.change
+
+
+class StatusPoller(threading.Thread):
+    def __init__(self, handler, robot):
+        super(StatusPoller, self).__init__(name='poller-%s' % robot['id'], daemon=True)
+        self.handler = handler
+        self.robot = robot
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        args = self.handler.args
+        clock = self.handler.clock
+        cache = self.handler.status_caches[self.robot['id']]
+        device_id = self.robot['id']
+        # The same policies as husmow_logger
+        options = {'max_delay': args.poll_parked}
+        if args.schedule == 'fixed':
+            options['active_delay'] = POLL_ACTIVE if args.poll_active is None else args.poll_active
+        policy = make_policy(args.schedule, args.poll, **options)
+        while not self.stop_event.is_set():
+            try:
+                entry, _ = cache.get(lambda: self.handler.call_api(lambda mow: mow.status(device_id)), force=True)
+                delay = policy.next_delay(entry.status, clock.time())
+                logger.info("Polled status of %s: %s. Next poll in %ds" % (
+                    self.robot['name'], entry.status['mowerStatus'], delay))
+            except Exception as ex:
+                delay = policy.error_delay(clock.time())
+                logger.error("[ERROR] Failed to poll the status of %s: %s" % (self.robot['name'], ex))
+            self.handler.clock.wait(self.stop_event, delay)
+
+
+class HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections when many clients connect at once
+    request_queue_size = 128
+
+
+class UnixHTTPServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            if daemon_running(self.server_address):
+                raise CommandException('A daemon is already listening on %s' % self.server_address)
+            # Left by a daemon that did not stop properly
+            os.unlink(self.server_address)
+        super(UnixHTTPServer, self).server_bind()
+        # Only the user running the daemon can send it commands
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super(UnixHTTPServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class HTTPRequestHandler(BaseHTTPRequestHandler):
+    config = None
+    tokenConfig = None
+    args = None
+    # Virtual clock when replaying a recording
+    clock = SYSTEM_CLOCK
+    mow = None
+    # Mowers of the account, loaded once at startup. The first one (or the one given with --mower) is
+    # used by the routes without mower
+    robots = []
+    default_robot = None
+    status_caches = {}
+    # Fetches the statuses of /mowers/status
+    executor = None
+    # Sends the commands of POST /control: they do not queue behind slow status requests
+    control_executor = None
+    history = None
+    trails = None
+    # Serialize the token renewal between the request threads
+    login_lock = threading.Lock()
+
+    def address_string(self):
+        # Clients of the unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+    @classmethod
+    def call_api(cls, action):
+        # Failed requests are retried by the API itself. Only retry once here after a new login when the
+        # token was revoked or expired earlier than announced
+        token = None
+        for force_login in (False, True):
+            with HTTPRequestHandler.login_lock:
+                # The concurrent requests refused with the same token share a single new login
+                if not force_login or HTTPRequestHandler.mow.token == token:
+                    refresh_api(HTTPRequestHandler.mow, HTTPRequestHandler.config, HTTPRequestHandler.tokenConfig,
+                                HTTPRequestHandler.args, force=force_login)
+                token = HTTPRequestHandler.mow.token
+            try:
+                return action(HTTPRequestHandler.mow)
+            except requests.HTTPError as ex:
+                if force_login or ex.response.status_code != 401:
+                    raise
+                logger.error("[ERROR] The token was refused. Logging in again")
+
+    def not_modified(self, etag, modified):
+        # etag is the one of the identity body: the client may hold the gzipped body
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            return '*' in tags or etag in tags or gzip_etag(etag) in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and modified is not None:
+            try:
+                return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_body(self, body, etag=None, modified=None, age=None, gzipped=None):
+        not_modified = etag is not None and self.not_modified(etag, modified)
+        compressible = HTTPRequestHandler.args.gzip and len(body) >= GZIP_MIN_SIZE
+        compress = compressible and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if not_modified:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            if compress:
+                body = gzipped() if gzipped else gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+        if compressible:
+            self.send_header('Vary', 'Accept-Encoding')
+        if etag is not None:
+            self.send_header('ETag', gzip_etag(etag) if compress else etag)
+        if modified is not None:
+            self.send_header('Last-Modified', formatdate(modified, usegmt=True))
+        if age is not None:
+            self.send_header('Age', str(int(age)))
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+
+    def send_json(self, obj, modified=None):
+        body = json.dumps(obj).encode('ascii')
+        self.send_body(body, make_etag(body), modified)
+
+    def send_metrics(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_status(self, entry):
+        self.send_body(entry.body, entry.etag, entry.modified, entry.age(), entry.gzipped)
+
+    def mower_status(self, robot):
+        cache = HTTPRequestHandler.status_caches[robot['id']]
+        try:
+            entry, cached = cache.get(lambda: self.call_api(lambda mow: mow.status(robot['id'])))
+        except (CircuitOpenException, requests.RequestException) as ex:
+            if cache.entry is None:
+                raise
+            # Husqvarna servers are down: the last known status is better than nothing
+            logger.error("[ERROR] %s. Serving the status of %s from %ds ago" % (ex, robot['name'], cache.entry.age()))
+            return cache.entry
+        metrics.STATUS_CACHE.inc('hit' if cached else 'miss')
+        logger.info("Get status of %s from %s" % (robot['name'], "cache" if cached else "Husqvarna servers"))
+        return entry
+
+    def all_status(self):
+        def fetch(robot):
+            try:
+                entry = self.mower_status(robot)
+                return {'id': robot['id'], 'name': robot['name'], 'status': entry.status,
+                        'updated': entry.updated}, entry.modified
+            except Exception as ex:
+                logger.error("[ERROR] Failed to get the status of %s: %s" % (robot['name'], ex))
+                return {'id': robot['id'], 'name': robot['name'], 'error': str(ex)}, None
+
+        results = list(HTTPRequestHandler.executor.map(fetch, HTTPRequestHandler.robots))
+        modified = [modified for _, modified in results if modified is not None]
+        return [result for result, _ in results], max(modified) if modified else None
+
+    def wait_change(self, robot, version, timeout):
+        cache = HTTPRequestHandler.status_caches[robot['id']]
+        deadline = self.clock.time() + timeout
+        while True:
+            # Without poller, the cache is refreshed here when it expired. All the waiting clients share the
+            # same upstream call
+            if cache.expire is not None:
+                self.mower_status(robot)
+            remaining = deadline - self.clock.time()
+            if remaining <= 0:
+                return None
+            change = cache.wait_change(version, min(remaining, cache.expire or remaining))
+            if change is not None:
+                return change
+
+    def long_poll(self, robot):
+        try:
+            since = int(self.query.get('since', ['0'])[0])
+            timeout = min(float(self.query.get('timeout', [str(MAX_WAIT)])[0]), MAX_WAIT)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        change = self.wait_change(robot, since, timeout)
+        if change is None:
+            self.send_response(204)
+            self.end_headers()
+        else:
+            self.send_body(change.body)
+
+    def stream_events(self, robot):
+        try:
+            version = int(self.headers.get('Last-Event-ID', self.query.get('since', ['0'])[0]))
+        except ValueError:
+            version = 0
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    change = self.wait_change(robot, version, KEEP_ALIVE)
+                except (CommandException, CircuitOpenException, requests.RequestException) as ex:
+                    logger.error("[ERROR] Failed to refresh the status of %s: %s" % (robot['name'], ex))
+                    change = None
+                if change is None:
+                    self.wfile.write(b': keep-alive\n\n')
+                else:
+                    version = change.version
+                    self.wfile.write(b'id: %d\nevent: status\ndata: %s\n\n' % (version, change.body))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("Event stream of %s closed by the client" % robot['name'])
+
+    def send_history(self):
+        if HTTPRequestHandler.history is None:
+            self.send_response(404, 'The history is not enabled. Use --history-db')
+            self.end_headers()
+            return
+        try:
+            start = parse_time(self.query.get('from', [None])[0])
+            end = parse_time(self.query.get('to', [None])[0])
+            step = float(self.query.get('step', ['0'])[0])
+            limit = int(self.query.get('limit', ['0'])[0])
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        mower = self.query.get('mower', [None])[0]
+        if mower is not None:
+            try:
+                mower = find_robot(HTTPRequestHandler.robots, mower)['id']
+            except CommandException as ce:
+                logger.error("[ERROR] %s" % ce)
+                self.send_response(404)
+                self.end_headers()
+                return
+        self.send_json(HTTPRequestHandler.history.query(mower, start, end, step, limit))
+
+    def send_geo(self, robot):
+        if HTTPRequestHandler.trails is None:
+            self.send_response(404, 'The location trails are not enabled. Use --geo')
+            self.end_headers()
+            return
+        # Fetches the latest locations when the cached status expired
+        self.mower_status(robot)
+        heatmap = self.query.get('heatmap', ['0'])[0] not in ('0', 'false', '')
+        self.send_json(HTTPRequestHandler.trails[robot['id']].summary(heatmap))
+
+    def handle_mower(self, robot, command):
+        if command in ('start', 'stop', 'park'):
+            self.call_api(lambda mow: mow.control(command.upper(), robot['id']))
+            self.send_response(200)
+            self.end_headers()
+        elif command == 'status':
+            self.send_status(self.mower_status(robot))
+        elif command == 'changes':
+            self.long_poll(robot)
+        elif command == 'events':
+            self.stream_events(robot)
+        elif command == 'geo':
+            self.send_geo(robot)
+        else:
+            self.send_response(400)
+            self.end_headers()
+
+    def control_mowers(self, orders):
+        # orders is either {"command": "PARK", "mowers": [...]} (all the mowers when omitted) or a list of
+        # {"mower": ..., "command": ...}
+        if isinstance(orders, dict):
+            mowers = orders.get('mowers')
+            if mowers is None:
+                mowers = [robot['id'] for robot in HTTPRequestHandler.robots]
+            orders = [{'mower': mower, 'command': orders['command']} for mower in mowers]
+        results = []
+        valid = []
+        for order in orders:
+            try:
+                valid.append((find_robot(HTTPRequestHandler.robots, order['mower']), str(order['command']).upper()))
+            except CommandException as ce:
+                results.append({'id': None, 'name': order['mower'], 'command': order['command'], 'success': False,
+                                'duration': 0, 'error': str(ce)})
+
+        def control(command, device_id):
+            self.call_api(lambda mow: mow.control(command, device_id))
+
+        results.extend(batch_control(control, valid, HTTPRequestHandler.control_executor))
+        for result in results:
+            logger.info("%s %s: %s in %.3fs" % (result['command'], result['name'],
+                                                 'done' if result['success'] else result['error'],
+                                                 result['duration']))
+        return results
+
+    def do_POST(self):
+        logger.info("Try to execute POST " + self.path)
+        if urlsplit(self.path).path.rstrip('/') != '/control':
+            self.send_response(404)
+            self.end_headers()
+            return
+        try:
+            orders = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(orders, (dict, list)) or any(
+                    not isinstance(order, dict) or 'mower' not in order or 'command' not in order
+                    for order in (orders if isinstance(orders, list) else [])):
+                raise ValueError('Expected an object or a list of {"mower", "command"} objects')
+            if isinstance(orders, dict) and ('command' not in orders or
+                                             not isinstance(orders.get('mowers', []), list)):
+                raise ValueError('Expected {"command": ..., "mowers": [...]}')
+        except ValueError as ex:
+            logger.error("[ERROR] Wrong parameters: %s" % ex)
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        try:
+            self.send_json(self.control_mowers(orders))
+        except CircuitOpenException as ce:
+            logger.error("[ERROR] %s" % ce)
+            self.send_response(503)
+            self.end_headers()
+        except Exception as ex:
+            logger.error(ex)
+            logger.error("[ERROR] Failed to send the commands")
+            self.send_response(500)
+            self.end_headers()
+
+        logger.info("Done")
+
+    def do_GET(self):
+        logger.info("Try to execute " + self.path)
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        self.query = parse_qs(url.query)
+
+        try:
+            if parts == ['mowers']:
+                self.send_json(HTTPRequestHandler.robots)
+            elif parts == ['mowers', 'status']:
+                self.send_json(*self.all_status())
+            elif parts == ['history']:
+                self.send_history()
+            elif parts == ['metrics']:
+                self.send_metrics()
+            elif len(parts) == 3 and parts[0] == 'mowers':
+                try:
+                    robot = find_robot(HTTPRequestHandler.robots, parts[1])
+                except CommandException as ce:
+                    logger.error("[ERROR] %s" % ce)
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.handle_mower(robot, parts[2])
+            elif len(parts) == 1:
+                self.handle_mower(HTTPRequestHandler.default_robot, parts[0])
+            elif len(parts) == 2 and parts[0] == 'status' and parts[1] in ('changes', 'events'):
+                # /status/changes and /status/events only: a GET must not send a command
+                self.handle_mower(HTTPRequestHandler.default_robot, parts[1])
+            else:
+                self.send_response(400)
+                self.end_headers()
+        except CommandException as ce:
+            msg = "[ERROR] Wrong parameters: %s" % ce
+            logger.error(msg)
+            self.send_response(500, msg)
+            self.end_headers()
+        except CircuitOpenException as ce:
+            logger.error("[ERROR] %s" % ce)
+            self.send_response(503)
+            self.send_header('Retry-After', str(HTTPRequestHandler.mow.circuit_breaker.reset_timeout))
+            self.end_headers()
+        except Exception as ex:
+            logger.error(ex)
+            logger.error("[ERROR] Failed to send the command")
+            self.send_response(500)
+            self.end_headers()
+
+        logger.info("Done")
+
+
+def load_trails(mow, robots, args):
+    from .geo import Trail
+
+    trails = {}
+    for robot in robots:
+        try:
+            geofence = mow.geo_status(robot['id'])
+        except Exception as ex:
+            logger.error("[ERROR] Failed to get the geofence of %s: %s" % (robot['name'], ex))
+            geofence = None
+        path = os.path.join(args.trail_dir, '%s.trail' % robot['id']) if args.trail_dir else None
+        trails[robot['id']] = Trail(path, args.geo_cell, geofence)
+    return trails
+
+
+def run_server(config, tokenConfig, args):
+    server_address = (args.address, args.port)
+    HTTPRequestHandler.config = config
+    HTTPRequestHandler.tokenConfig = tokenConfig
+    HTTPRequestHandler.args = args
+    HTTPRequestHandler.clock = make_clock(args)
+    # One authenticated session, with its connection pool, serves all the requests
+    mow = connect_api(config, tokenConfig, args)
+    robots = mow.list_robots()
+    mow.select_robot(args.mower, robots)
+    HTTPRequestHandler.mow = mow
+    HTTPRequestHandler.robots = robots
+    HTTPRequestHandler.default_robot = find_robot(robots, mow.device_id)
+    # When the statuses are polled in background, the pollers decide when the cache is refreshed
+    expire = None if args.poll else config.expire_status
+    history = HistoryStore(args.history_db) if args.history_db else None
+    HTTPRequestHandler.history = history
+
+    trails = load_trails(mow, robots, args) if args.geo else None
+    HTTPRequestHandler.trails = trails
+
+    def recorder(robot):
+        def record(entry):
+            metrics.observe_status(robot['name'], entry.status, entry.updated)
+            if history is not None:
+                history.add_status(robot['id'], entry.updated, entry.status)
+            if trails is not None:
+                trails[robot['id']].update(entry.status, entry.updated)
+        return record
+
+    HTTPRequestHandler.status_caches = {robot['id']: StatusCache(expire, recorder(robot), HTTPRequestHandler.clock)
+                                         for robot in robots}
+    HTTPRequestHandler.executor = ThreadPoolExecutor(max_workers=len(robots))
+    HTTPRequestHandler.control_executor = ThreadPoolExecutor(max_workers=len(robots))
+    pollers = [StatusPoller(HTTPRequestHandler, robot) for robot in robots] if args.poll else []
+    for poller in pollers:
+        poller.start()
+    # Each request is handled in its own thread so a slow call to Husqvarna servers does not block the others
+    httpd = HTTPServer(server_address, HTTPRequestHandler)
+    unix_httpd = None
+    if args.listen_socket:
+        unix_httpd = UnixHTTPServer(args.socket, HTTPRequestHandler)
+        threading.Thread(target=unix_httpd.serve_forever, name='unix-socket', daemon=True).start()
+        logger.info('Listening on %s' % args.socket)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if unix_httpd is not None:
+            unix_httpd.shutdown()
+            unix_httpd.server_close()
+        for poller in pollers:
+            poller.stop()
+        HTTPRequestHandler.executor.shutdown(wait=False)
+        HTTPRequestHandler.control_executor.shutdown(wait=False)
+        if history is not None:
+            history.close()
+        for trail in (trails or {}).values():
+            trail.close()
+        if not args.token:
+            mow.logout()
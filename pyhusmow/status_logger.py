@@ -1,78 +1,284 @@
 import argparse
+import os
+import re
+import signal
+import sys
+from configparser import ConfigParser
 from datetime import datetime, timedelta
 from sched import scheduler
-from sys import stdout
-from time import time
+from . import metrics
+from .husmow import API, AutoMowerConfig, CommandException, TokenConfig, find_robot, refresh_api
+from .scheduling import POLICIES, make_policy
+from .writers import CsvStatusWriter, JsonlStatusWriter, LogWriter, parse_size
 
-from .husmow import TokenConfig, API
 
+def output_path(path, robot):
+    # {mower} in a file name is replaced by the name of the mower to get one file per mower
+    if not path or '{mower}' not in path:
+        return path
+    return path.replace('{mower}', re.sub(r'[^\w.-]+', '_', robot['name']))
 
-def run_logger(tc, args, stop_time):
-    mow = API()
-    mow.set_token(tc.token, tc.provider)
-    mow.select_robot(args.mower)
 
-    sch = scheduler(timefunc=time)
-    status = {'status': None, 'status_changed': None}
+class Checkpoint(ConfigParser):
+    # State of the logger, saved after each sample so that a restarted logger continues where it stopped:
+    # one section per mower with its status, when the status changed and the time of its last sample
+    def __init__(self, path):
+        super(Checkpoint, self).__init__(interpolation=None)
+        self.path = path
 
-    def write_log(*strings, fName=args.file, mode='a'):
-        out = open(fName, mode) if fName else stdout
-        print(*strings, sep=',', file=out)
-        if fName:
-            out.close()
+    def load(self):
+        return self.read(self.path)
+
+    def mower(self, robot):
+        # Returns (status, status_changed, last_sample) of the mower, None when unknown
+        if not self.has_section(robot['id']):
+            return None, None, None
+        section = self[robot['id']]
+        status_changed = section.get('status_changed')
+        last_sample = section.get('last_sample')
+        return (section.get('status') or None,
+                datetime.fromisoformat(status_changed) if status_changed else None,
+                datetime.fromisoformat(last_sample) if last_sample else None)
+
+    def update(self, robot, status, status_changed, last_sample):
+        self[robot['id']] = {
+            'name': robot['name'],
+            'status': status,
+            'status_changed': status_changed.isoformat(),
+            'last_sample': last_sample.isoformat(),
+        }
+
+    def save(self):
+        # Written in a temporary file then renamed: a crash leaves either the old or the new checkpoint
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            self.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+# Renewed tokens are saved in token.cfg, like husmow does
+TOKEN_ARGS = argparse.Namespace(token=True)
+
+
+def unauthorized(ex):
+    response = getattr(ex, 'response', None)
+    return response is not None and response.status_code == 401
+
+
+def run_logger(tc, config, args, stop_time):
+    from .replay import install, make_clock
+
+    mow = API(args.auth_url or config.auth_url, args.track_url or config.track_url)
+    install(mow, args)
+    # Virtual clock when replaying a recording
+    clock = make_clock(args)
+    # The fake token of a replay is not saved
+    token_args = argparse.Namespace(token=False) if args.replay else TOKEN_ARGS
+    if tc.token_valid():
+        mow.set_token(tc.token, tc.provider, tc.expire_on)
+
+    def call_api(action):
+        # Logs in with the login and password of automower.cfg when the token is about to expire, and once
+        # more when Husqvarna servers refuse the token before it expires
+        refresh_api(mow, config, tc, token_args)
+        try:
+            return action()
+        except Exception as ex:
+            if not unauthorized(ex):
+                raise
+        refresh_api(mow, config, tc, token_args, force=True)
+        return action()
+
+    # Wait for Husqvarna servers when they are down at start
+    delay = args.delay
+    while True:
+        try:
+            robots = call_api(mow.list_robots)
+            break
+        except Exception as ex:
+            if clock.now() + timedelta(0, delay) > stop_time:
+                raise
+            print('Failed to list the mowers: %s. Retrying in %ds' % (ex, delay), file=sys.stderr)
+            clock.sleep(delay)
+            delay = min(2 * delay, args.max_delay)
+    if args.all_mowers:
+        if not robots:
+            raise CommandException('No mower found')
+    else:
+        mow.select_robot(args.mower, robots)
+        robots = [find_robot(robots, mow.device_id)]
+
+    # Writers are shared by the mowers logging in the same file
+    writers = {}
+
+    def wait(delay):
+        # The rows are flushed flush_interval seconds after they were written, even when the next poll (and
+        # the next write) comes hours later
+        while True:
+            due = [writer.flush_due() for writer in writers.values()]
+            due = [seconds for seconds in due if seconds is not None]
+            if not due or min(due) >= delay:
+                clock.sleep(delay)
+                return
+            pause = max(0, min(due))
+            clock.sleep(pause)
+            delay -= pause
+            for writer in writers.values():
+                seconds = writer.flush_due()
+                if seconds is not None and seconds <= 0:
+                    writer.flush()
+
+    # All the mowers are polled from the same scheduler, each one at its own pace
+    sch = scheduler(timefunc=clock.time, delayfunc=wait)
+
+    checkpoint = None
+    resuming = False
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint)
+        resuming = bool(checkpoint.load())
+
+    # A resumed logger continues its files
+    writer_options = dict(flush_interval=args.flush_interval, rotate_size=args.rotate_size,
+                          rotate_daily=args.rotate_daily, compression=args.compress, append=resuming)
+
+    def get_writer(template, robot, factory):
+        path = output_path(template, robot)
+        key = (factory, path)
+        if key not in writers:
+            tagged = len([other for other in robots if output_path(template, other) == path]) > 1
+            writers[key] = factory(path, tagged)
+        return writers[key]
+
+    def status_writer(path, tagged):
+        if args.format == 'binary':
+            from .binary_log import BinaryLogWriter
+            return BinaryLogWriter(path, flush_interval=args.flush_interval, append=resuming)
+        if args.format == 'jsonl':
+            return JsonlStatusWriter(path, **writer_options)
+        return CsvStatusWriter(path, tagged=tagged, **writer_options)
+
+    def summary_writer(path, tagged):
+        header = 'time,status,status duration'
+        return LogWriter(path, header='mower,' + header if tagged else header, **writer_options)
+
+    history = None
+    if args.history_db:
+        from .history import HistoryStore
+        history = HistoryStore(args.history_db)
+    # Trails are saved one file per mower
+    trails = {}
+    if args.trail_file:
+        from .geo import Trail
+        for robot in robots:
+            trails[robot['id']] = Trail(output_path(args.trail_file, robot))
 
     def now():
-        return datetime.now().replace(microsecond=0)
-
-    def log_status():
-        mow_status = mow.status()
-        start = datetime.utcfromtimestamp(
-            mow_status['nextStartTimestamp']) if mow_status['nextStartTimestamp'] else None
-        if status['status'] != mow_status['mowerStatus']:
-            if args.summary and status['status'] is not None:
-                # Write the summary. Skip the first iteration
-                write_log(
-                    now().isoformat(),
-                    status['status'],
-                    now() - status['status_changed'],
-                    fName=args.summary)
-            status['status'] = mow_status['mowerStatus']
-            status['status_changed'] = now()
-        # The latest location has index 0
-        location = mow_status['lastLocations'][0]
-        currentTime = datetime.now()
-        write_log(currentTime.isoformat(), mow_status['mowerStatus'], mow_status['batteryPercent'],
-                  start.isoformat() if start else '',
-                  now() - status['status_changed'], location['latitude'], location['longitude'])
-        if stop_time >= currentTime:
-            if mow_status['mowerStatus'] == 'PARKED_TIMER' and mow_status['batteryPercent'] == 100:
-                # The mower has a full battery and is waiting for the next timer.
-                # Skip until 2 minutes before the next timer start
-                nextStart = start - timedelta(0, 2 * 60)
-                if nextStart > datetime.now():
-                    # fallback to the usual operation if the nextStart is not in the future
-                    return sch.enterabs(nextStart.timestamp(), 1, log_status)
-            sch.enter(args.delay, 1, log_status)
-        elif args.summary and status['status'] is not None:
-            write_log(
-                now(), status['status'], now() - status['status_changed'], fName=args.summary)
-
-    write_log(
-        'time',
-        'status',
-        'battery %',
-        'next start time',
-        'status duration',
-        'latitude',
-        'longitude',
-        mode='w')
-    if args.summary:
-        write_log('time', 'status', 'status duration', fName=args.summary, mode='w')
-    log_status()
-    sch.run()
-
-
-def parse_until(args):
+        return clock.now().replace(microsecond=0)
+
+    def mower_logger(robot):
+        status = {'status': None, 'status_changed': None}
+        if checkpoint is not None:
+            status['status'], status['status_changed'], last_sample = checkpoint.mower(robot)
+            if last_sample:
+                print('Resuming %s: last sample at %s, %s since %s' % (
+                    robot['name'], last_sample, status['status'], status['status_changed']), file=sys.stderr)
+        # --max-delay only applies to adaptive: fixed waits for the next start however far it is
+        options = {'max_delay': args.max_delay} if args.schedule == 'adaptive' else {}
+        policy = make_policy(args.schedule, args.delay, **options)
+        log_writer = get_writer(args.file, robot, status_writer)
+        summary = get_writer(args.summary, robot, summary_writer) if args.summary else None
+
+        def write_summary(*values):
+            summary.write_row(*((robot['name'],) + values if summary.header.startswith('mower,') else values))
+
+        def schedule(delay):
+            # The last poll happens when the logger stops. Called only before stop_time, so the delay is positive
+            # and a virtual clock advances
+            sch.enter(min(delay, max(0, (stop_time - clock.now()).total_seconds())), 1, log_status)
+
+        def write_sample(mow_status):
+            start = datetime.utcfromtimestamp(
+                mow_status['nextStartTimestamp']) if mow_status['nextStartTimestamp'] else None
+            if status['status'] != mow_status['mowerStatus']:
+                if summary and status['status'] is not None:
+                    # Write the summary. Skip the first iteration
+                    write_summary(
+                        now().isoformat(),
+                        status['status'],
+                        now() - status['status_changed'])
+                status['status'] = mow_status['mowerStatus']
+                status['status_changed'] = now()
+            # The latest location has index 0
+            location = mow_status['lastLocations'][0]
+            currentTime = clock.now()
+            if history:
+                history.add_status(robot['id'], currentTime.timestamp(), mow_status)
+            if trails:
+                trails[robot['id']].update(mow_status, currentTime.timestamp())
+            if args.metrics_file:
+                metrics.observe_status(robot['name'], mow_status, currentTime.timestamp())
+                metrics.write_textfile(args.metrics_file)
+            log_writer.write_status(currentTime, mow_status['mowerStatus'], mow_status['batteryPercent'], start,
+                                    now() - status['status_changed'], location['latitude'], location['longitude'],
+                                    mower=robot['name'], raw=mow_status)
+            if checkpoint is not None:
+                # The checkpoint must not get ahead of the files: the rows it covers are on the disk first
+                log_writer.flush()
+                if summary:
+                    summary.flush()
+                if history:
+                    history.flush()
+                checkpoint.update(robot, status['status'], status['status_changed'], currentTime)
+                checkpoint.save()
+
+        def log_status():
+            try:
+                mow_status = call_api(lambda: mow.status(robot['id']))
+            except Exception as ex:
+                # The API already retried. Try again later rather than stopping the logger
+                delay = policy.error_delay(clock.time())
+                print('Failed to get the status of %s: %s. Retrying in %ds' % (robot['name'], ex, delay),
+                      file=sys.stderr)
+                if stop_time > clock.now():
+                    schedule(delay)
+                return
+            try:
+                write_sample(mow_status)
+                delay = policy.next_delay(mow_status, clock.time())
+            except Exception as ex:
+                # An unexpected status or a failed write loses this sample, not the logger
+                delay = policy.error_delay(clock.time())
+                print('Failed to log the status of %s: %s. Retrying in %ds' % (robot['name'], ex, delay),
+                      file=sys.stderr)
+            if stop_time > clock.now():
+                schedule(delay)
+            elif summary and status['status'] is not None:
+                write_summary(
+                    now(), status['status'], now() - status['status_changed'])
+
+        return log_status
+
+    try:
+        for robot in robots:
+            sch.enter(0, 1, mower_logger(robot))
+        sch.run()
+    finally:
+        for writer in writers.values():
+            writer.close()
+        if history:
+            history.close()
+        for trail in trails.values():
+            trail.close()
+
+
+def terminate(signum, frame):
+    # Stops the logger like Ctrl+C does: run_logger closes (and flushes) the files on its way out
+    raise SystemExit(128 + signum)
+
+
+def parse_until(args, now):
     until = args.until.lower()
     try:
         num = int(until[:-1])
@@ -80,9 +286,9 @@ def parse_until(args):
         print('The until argument is not valid.', until)
         exit(2)
     if until.endswith('m'):
-        return datetime.now() + timedelta(0, 60 * num)
+        return now + timedelta(0, 60 * num)
     if until.endswith('d'):
-        return datetime.now() + timedelta(num)
+        return now + timedelta(num)
     print('The until argument is not valid.')
     exit(3)
 
@@ -91,20 +297,37 @@ def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description='Periodically log the mower status.',
-        epilog='A valid token.cfg config file is required. Use husmow to create it.')
+        epilog='A valid token.cfg config file is required, or a login and a password saved in automower.cfg \
+        to create it and to renew the token. Use husmow to create them.')
     parser.add_argument(
         '-d',
         '--delay',
         help='How often (in seconds) should the status be logged.',
         default=60,
         type=int)
+    parser.add_argument(
+        '--schedule',
+        choices=sorted(POLICIES),
+        default='fixed',
+        help='When the status is polled. fixed polls every DELAY seconds, except when the mower is parked by \
+        the timer with a full battery. adaptive polls every DELAY seconds around the status changes and the \
+        scheduled starts, and less often when the next change can be predicted: from the charging rate, the \
+        discharge rate or the next start. Failed polls are retried with a backoff.')
+    parser.add_argument(
+        '--max-delay',
+        dest='max_delay',
+        help='Longest delay (in seconds) between two polls with --schedule adaptive.',
+        default=30 * 60,
+        type=int)
     parser.add_argument(
         '-u',
         '--until',
         help='When to stop logging. Use NUMm for minutes or NUMd for days. \
         Es: 20m is 20 minutes; 10d if 10 days',
         default='1d')
-    parser.add_argument('-f', '--file', help='Save output on a file')
+    parser.add_argument('-f', '--file', help='Save output on a file. With --all-mowers, {mower} in the file \
+        name is replaced by the name of the mower to write one file per mower, otherwise the rows of all \
+        the mowers are written in the same file with an additional mower column.')
     parser.add_argument(
         '-s',
         '--summary-file',
@@ -116,14 +339,121 @@ def main():
         '--mower',
         dest='mower',
         help='Select the mower to use. When not provied the first mower will be used.')
+    parser.add_argument(
+        '--all-mowers',
+        dest='all_mowers',
+        action='store_true',
+        help='Log all the mowers of the account.')
+    parser.add_argument(
+        '--flush-interval',
+        dest='flush_interval',
+        help='How often (in seconds) the output files are flushed to the disk: a row is on the disk at most \
+        this long after it was logged.',
+        default=60,
+        type=int)
+    parser.add_argument(
+        '--rotate-size',
+        dest='rotate_size',
+        help='Start a new output file when it reaches this size. Es: 500k, 10M',
+        type=parse_size)
+    parser.add_argument(
+        '--rotate-daily',
+        dest='rotate_daily',
+        action='store_true',
+        help='Start a new output file every day.')
+    parser.add_argument(
+        '--compress',
+        choices=['gzip', 'zstd'],
+        help='Compress the rotated output files. zstd requires the zstandard package.')
+    parser.add_argument(
+        '--format',
+        choices=['csv', 'binary', 'jsonl'],
+        default='csv',
+        help='Format of the output file. binary is a compact fixed-size record format that can be read with \
+        pyhusmow.binary_log.BinaryLogReader. It requires --file and is neither rotated nor compressed. jsonl \
+        writes one JSON object per sample with the raw status and the changes since the previous sample. \
+        Without --file, each line is flushed to the standard output as soon as it is written.')
+    parser.add_argument(
+        '--history-db',
+        dest='history_db',
+        help='Also record the status in this SQLite database. It can be shared with husmow server.')
+    parser.add_argument(
+        '--trail-file',
+        dest='trail_file',
+        help='Save all the locations of the mower in this file, without duplicates, for "husmow geo --trail". \
+        Requires numpy. With --all-mowers, {mower} is required in the file name.')
+    parser.add_argument(
+        '--metrics-file',
+        dest='metrics_file',
+        help='Write the metrics in this file in the Prometheus text format after each sample, for the textfile \
+        collector of node_exporter.')
+    parser.add_argument(
+        '--checkpoint',
+        dest='checkpoint',
+        help='Save the state of the logger in this file after each sample. When the file exists, the logger \
+        resumes from it: the status durations continue and the output files are appended to.')
+    parser.add_argument('--auth-url', dest='auth_url', help='Base URL of the authentication API.')
+    parser.add_argument('--track-url', dest='track_url', help='Base URL of the mower API.')
+    parser.add_argument(
+        '--record',
+        dest='record',
+        help='Record the responses of Husqvarna servers in this file (gzip), for --replay.')
+    parser.add_argument(
+        '--replay',
+        dest='replay',
+        help='Poll the responses recorded with --record instead of Husqvarna servers, from the time of the \
+        first one. --until counts from this time. No token or login is needed.')
+    parser.add_argument(
+        '--speed',
+        dest='speed',
+        help='With --replay, how many times faster than the real time the recording is replayed. 0 replays \
+        as fast as possible: the time only advances between the polls.',
+        default=0,
+        type=float)
+    subparsers = parser.add_subparsers(dest='command')
+    parser_report = subparsers.add_parser(
+        'report',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help='Daily statistics over log files: mowing and charging time, discharge and charge rates, errors.')
+    parser_report.add_argument('files', nargs='+', help='csv or jsonl log files, possibly compressed with gzip or \
+        zstd. Es: log.csv*')
+    parser_report.add_argument('--max-gap', dest='max_gap', type=int, default=2 * 3600,
+                               help='Longest time (in seconds) between two samples attributed to the status of the \
+                               first one. Longer gaps are not counted.')
+    parser_report.add_argument('--json', dest='json', action='store_true', help='Print the report in JSON.')
     args = parser.parse_args()
+    if args.command == 'report':
+        from .report import run_report
+        run_report(args)
+        return
+    if args.format == 'binary' and not args.file:
+        parser.error('--format binary requires --file')
+    if args.format == 'binary' and (args.rotate_size or args.rotate_daily or args.compress):
+        parser.error('--format binary does not support --rotate-size, --rotate-daily and --compress')
+    if args.trail_file and args.all_mowers and '{mower}' not in args.trail_file:
+        parser.error('--trail-file with --all-mowers requires {mower} in the file name')
+    if args.format == 'binary' and args.all_mowers and '{mower}' not in args.file:
+        parser.error('--format binary with --all-mowers requires {mower} in the file name')
 
-    stop_time = parse_until(args)
+    if args.speed < 0:
+        parser.error('--speed must not be negative')
+    if args.delay <= 0:
+        parser.error('--delay must be positive')
 
+    from .replay import make_clock
+    stop_time = parse_until(args, make_clock(args).now())
+
+    config = AutoMowerConfig()
     tc = TokenConfig()
-    tc.load_config()
-    if tc.token_valid():
-        run_logger(tc, args, stop_time)
+    if args.replay:
+        # The replay accepts any login
+        config.login = config.password = 'replay'
+    else:
+        config.load_config()
+        tc.load_config()
+    if tc.token_valid() or (config.login and config.password):
+        signal.signal(signal.SIGTERM, terminate)
+        run_logger(tc, config, args, stop_time)
     else:
-        print('The token is not valid.')
+        print('The token is not valid and automower.cfg has no login and password to renew it.')
         exit(1)
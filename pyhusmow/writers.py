@@ -0,0 +1,183 @@
+import json
+import math
+import os
+import shutil
+import sys
+from datetime import datetime
+from time import time
+
+
+def parse_size(value):
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def compress_file(path, compression):
+    if compression == 'gzip':
+        import gzip
+        target = path + '.gz'
+        opener = lambda: gzip.open(target, 'wb')
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('zstd compression requires the zstandard package')
+        target = path + '.zst'
+        opener = lambda: zstandard.ZstdCompressor().stream_writer(open(target, 'wb'))
+    else:
+        raise ValueError('Unknown compression %s' % compression)
+    with open(path, 'rb') as src, opener() as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.remove(path)
+    return target
+
+
+class LogWriter:
+    # Keeps the output file open and buffered, flushing (and syncing to disk) at most every flush_interval
+    # seconds. The file can be rotated when it reaches rotate_size bytes or when the day changes, and the
+    # rotated segments compressed. Each segment starts with the header. With append, an existing file is
+    # continued: the header is only written in an empty file.
+    def __init__(self, path, header=None, flush_interval=60, rotate_size=None, rotate_daily=False,
+                 compression=None, buffer_size=64 * 1024, append=False):
+        self.path = path
+        self.header = header
+        self.flush_interval = flush_interval
+        self.rotate_size = rotate_size
+        self.rotate_daily = rotate_daily
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.file = None
+        self.opened_on = None
+        self.flushed_on = time()
+        # Whether lines were written since the last flush
+        self.dirty = False
+        self._open('a' if append else 'w')
+
+    def _open(self, mode):
+        if self.path:
+            self.file = open(self.path, mode, buffering=self.buffer_size)
+        else:
+            self.file = sys.stdout
+        self.opened_on = datetime.now().date()
+        # The standard output cannot tell where it is: it always gets the header
+        if self.header is not None and (mode == 'w' or not self.path or self.file.tell() == 0):
+            self.file.write(self.header + '\n')
+            self.dirty = True
+
+    def _should_rotate(self):
+        if not self.path:
+            return False
+        if self.rotate_size and self.file.tell() >= self.rotate_size:
+            return True
+        return self.rotate_daily and datetime.now().date() != self.opened_on
+
+    def rotate(self):
+        self.close()
+        rotated = base = '%s.%s' % (self.path, datetime.now().strftime('%Y%m%d-%H%M%S'))
+        suffix = 1
+        while any(os.path.exists(rotated + ext) for ext in ('', '.gz', '.zst')):
+            rotated = '%s-%d' % (base, suffix)
+            suffix += 1
+        os.replace(self.path, rotated)
+        if self.compression:
+            compress_file(rotated, self.compression)
+        self._open('w')
+
+    def write(self, line):
+        if self._should_rotate():
+            self.rotate()
+        self.file.write(line + '\n')
+        self.dirty = True
+        if time() - self.flushed_on >= self.flush_interval:
+            self.flush()
+
+    def write_row(self, *values):
+        self.write(','.join(str(value) for value in values))
+
+    def flush_due(self):
+        # Seconds until the written lines must be flushed, None when everything is flushed
+        return self.flushed_on + self.flush_interval - time() if self.dirty else None
+
+    def flush(self):
+        self.file.flush()
+        if self.path:
+            os.fsync(self.file.fileno())
+        self.flushed_on = time()
+        self.dirty = False
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        if self.path:
+            self.file.close()
+        self.file = None
+
+
+class CsvStatusWriter(LogWriter):
+    HEADER = 'time,status,battery %,next start time,status duration,latitude,longitude'
+
+    def __init__(self, path, tagged=False, **kwargs):
+        # A tagged file is shared by several mowers: each row starts with the name of its mower
+        self.tagged = tagged
+        super(CsvStatusWriter, self).__init__(path, header='mower,' + self.HEADER if tagged else self.HEADER,
+                                              **kwargs)
+
+    def write_status(self, sample_time, status, battery, next_start, duration, latitude, longitude, mower=None,
+                     raw=None):
+        row = (sample_time.isoformat(), status, battery, next_start.isoformat() if next_start else '',
+               duration, latitude, longitude)
+        self.write_row(*((mower,) + row if self.tagged else row))
+
+
+class JsonlStatusWriter(LogWriter):
+    # One compact JSON object per line and per sample, with the raw status received from Husqvarna servers
+    # and what changed since the previous sample of the same mower. Written to stdout, each line is flushed
+    # right away so the samples can be piped into other tools.
+    _encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def __init__(self, path, tagged=False, **kwargs):
+        if not path:
+            kwargs['flush_interval'] = 0
+        super(JsonlStatusWriter, self).__init__(path, **kwargs)
+        # Previous sample of each mower
+        self.previous = {}
+
+    def delta(self, previous, sample_time, status, battery, latitude, longitude, raw):
+        if previous is None:
+            return None
+        previous_time, previous_status, previous_battery, previous_location, previous_raw = previous
+        # Distance in meters, on a plane: the mower does not go far between two samples
+        dy = math.radians(latitude - previous_location[0])
+        dx = math.radians(longitude - previous_location[1]) * math.cos(math.radians(latitude))
+        delta = {
+            'seconds': round((sample_time - previous_time).total_seconds(), 3),
+            'battery': battery - previous_battery,
+            'moved': round(6371008.8 * math.hypot(dx, dy), 2),
+            'previous_status': previous_status if status != previous_status else None,
+        }
+        if raw is not None and previous_raw is not None:
+            delta['changed'] = sorted(key for key in raw.keys() | previous_raw.keys()
+                                      if raw.get(key) != previous_raw.get(key))
+        return delta
+
+    def write_status(self, sample_time, status, battery, next_start, duration, latitude, longitude, mower=None,
+                     raw=None):
+        current = (sample_time, status, battery, (latitude, longitude), raw)
+        delta = self.delta(self.previous.get(mower), sample_time, status, battery, latitude, longitude, raw)
+        self.previous[mower] = current
+        self.write(self._encoder.encode({
+            'time': sample_time.isoformat(),
+            'mower': mower,
+            'status': status,
+            'battery': battery,
+            'next_start': next_start.isoformat() if next_start else None,
+            'status_duration': duration.total_seconds(),
+            'latitude': latitude,
+            'longitude': longitude,
+            'delta': delta,
+            'raw': raw,
+        }))
@@ -8,6 +8,7 @@ setup(
     license='GPLv3',
     version='0.2.0',
     packages=['pyhusmow'],
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             'husmow=pyhusmow:main',
@@ -15,8 +16,12 @@ setup(
         ],
     },
     install_requires=[
-        'requests',
-        'python-dateutil'
+        'requests'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'numpy': ['numpy'],
+        'async': ['aiohttp'],
+    },
     zip_safe=False,
 )
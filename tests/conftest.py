@@ -0,0 +1,172 @@
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from pyhusmow.husmow import AutoMowerConfig
+from pyhusmow.mock_server import start_mock_server
+
+# End-to-end tests against pyhusmow.mock_server. The commands run in a temporary directory: husmow and
+# husmow_logger read and write their configuration files in the current directory.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Mock:
+    def __init__(self, **kwargs):
+        self.httpd, self.url, self.state = start_mock_server(**kwargs)
+
+    def calls(self, key):
+        with self.state.lock:
+            return self.state.calls.get(key, 0)
+
+    def hold(self, status):
+        # The mowers follow a cycle driven by the time of the day: a mower parked by the timer is rarely polled.
+        # Tests counting the polls hold the mowers in a status
+        for mower in self.state.mowers:
+            mower.override = status
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def mock_factory():
+    mocks = []
+
+    def factory(**kwargs):
+        kwargs.setdefault('mowers', 2)
+        mocks.append(Mock(**kwargs))
+        return mocks[-1]
+
+    yield factory
+    for mock in mocks:
+        mock.close()
+
+
+@pytest.fixture
+def mock(mock_factory):
+    return mock_factory()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def mock_config(mock):
+    config = AutoMowerConfig()
+    config.login = 'me'
+    config.password = 'secret'
+    config.auth_url = mock.url
+    config.track_url = mock.url
+    return config
+
+
+def run_command(module, cwd, args, timeout):
+    # Runs the main function of a pyhusmow module. Returns the completed process
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, '-c', 'import pyhusmow.%s as m; m.main()' % module] + list(args),
+                          cwd=str(cwd), env=env, capture_output=True, text=True, timeout=timeout)
+
+
+def husmow(cwd, *args, timeout=60):
+    return run_command('husmow', cwd, args, timeout)
+
+
+def husmow_logger(cwd, *args, timeout=60):
+    return run_command('status_logger', cwd, args, timeout)
+
+
+def url_args(mock):
+    # The URLs are not saved: the runs using token.cfg give them again
+    return ['--auth-url', mock.url, '--track-url', mock.url, '--no-daemon']
+
+
+def mock_args(mock):
+    return ['--login', 'me', '--password', 'secret'] + url_args(mock)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Server:
+    # husmow server started with args (global options) and server_args (options of the server command)
+    def __init__(self, cwd, args, server_args):
+        self.port = free_port()
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        self.log = open(os.path.join(str(cwd), 'server.log'), 'wb')
+        self.process = subprocess.Popen([sys.executable, '-c', 'import pyhusmow.husmow as m; m.main()'] + args +
+                                        ['server', '--port', str(self.port)] + server_args, cwd=str(cwd),
+                                        env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError('The server exited: %s' % open(self.log.name).read())
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def request(self, method, path, body=None, headers=None):
+        # Returns (status, headers, body)
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            conn.close()
+
+    def get_json(self, path):
+        status, _, body = self.request('GET', path)
+        assert status == 200, path
+        return json.loads(body)
+
+    def stop(self):
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+
+@pytest.fixture
+def server_factory(workdir):
+    servers = []
+
+    def factory(args, *server_args):
+        servers.append(Server(workdir, args, list(server_args)))
+        return servers[-1]
+
+    yield factory
+    for server in servers:
+        server.stop()
+
+
+def logger_args(**kwargs):
+    # Options of husmow_logger with their defaults
+    args = argparse.Namespace(delay=1, schedule='fixed', max_delay=30 * 60, until='1d', file=None, summary=None,
+                              mower=None, all_mowers=True, flush_interval=0, rotate_size=None, rotate_daily=False,
+                              compress=None, format='csv', history_db=None, trail_file=None, metrics_file=None,
+                              checkpoint=None, auth_url=None, track_url=None, record=None, replay=None, speed=0)
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
@@ -0,0 +1,116 @@
+import time
+
+import pytest
+import requests
+
+from pyhusmow.husmow import API, CircuitBreaker, CircuitOpenException, RateLimiter
+
+
+def connect(mock, **kwargs):
+    mow = API(mock.url, mock.url, **kwargs)
+    mow.login('me', 'secret')
+    return mow, mow.list_robots()
+
+
+def test_status(mock):
+    mow, robots = connect(mock)
+    assert [robot['name'] for robot in robots] == ['mower1', 'mower2']
+    status = mow.status(robots[0]['id'])
+    assert status['mowerStatus'] and status['lastLocations']
+
+
+def test_retry_until_success(mock):
+    mow, robots = connect(mock, backoff=0.01)
+    delays = []
+
+    def sleep(delay):
+        # The servers recover after the second failure
+        delays.append(delay)
+        if len(delays) == 2:
+            mock.state.error_rate = 0
+
+    mow.sleep = sleep
+    mock.state.error_rate = 1
+    mow.status(robots[0]['id'])
+    assert len(delays) == 2
+    assert all(0 <= delay <= 0.01 * 2 ** attempt for attempt, delay in enumerate(delays, 1))
+    assert mock.calls('GET mowers/<id>/status') == 3
+
+
+def test_give_up_after_retries(mock):
+    mow, robots = connect(mock, retries=2, backoff=0)
+    mock.state.error_rate = 1
+    with pytest.raises(requests.HTTPError) as error:
+        mow.status(robots[0]['id'])
+    assert error.value.response.status_code == 503
+    assert mock.calls('GET mowers/<id>/status') == 3
+
+
+def test_retry_after_longer_than_max_backoff(mock):
+    # The mock asks to retry after 1s: too long, the request fails right away
+    mow, robots = connect(mock, max_backoff=0.5)
+    mock.state.throttle_rate = 1
+    with pytest.raises(requests.HTTPError) as error:
+        mow.status(robots[0]['id'])
+    assert error.value.response.status_code == 429
+    assert mock.calls('GET mowers/<id>/status') == 1
+
+
+def test_client_errors_are_not_retried(mock):
+    mow, _ = connect(mock)
+    with pytest.raises(requests.HTTPError) as error:
+        mow.status('unknown')
+    assert error.value.response.status_code == 404
+    assert mock.calls('GET mowers/<id>/status') == 1
+
+
+def test_circuit_breaker(mock):
+    mow, robots = connect(mock, retries=0, failure_threshold=2, reset_timeout=0.5)
+    mock.state.error_rate = 1
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            mow.status(robots[0]['id'])
+    # Open: the servers are not called anymore
+    with pytest.raises(CircuitOpenException):
+        mow.status(robots[0]['id'])
+    assert mock.calls('GET mowers/<id>/status') == 2
+
+    mock.state.error_rate = 0
+    time.sleep(0.6)
+    assert mow.status(robots[0]['id'])['mowerStatus']
+    assert not mow.circuit_breaker.is_open()
+
+
+def test_connection_errors(mock_factory):
+    mock = mock_factory()
+    url = mock.url
+    mock.close()
+    mow = API(url, url, retries=1, backoff=0)
+    with pytest.raises(requests.ConnectionError):
+        mow.login('me', 'secret')
+    assert mow.circuit_breaker.failures == 1
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=10, burst=3)
+    # The burst, then one request every 1/rate second, queued behind each other
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 0]
+    waits = [limiter.reserve() for _ in range(3)]
+    assert waits == pytest.approx([0.1, 0.2, 0.3], abs=0.01)
+
+
+def test_circuit_breaker_half_open():
+    now = [0]
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10, timefunc=lambda: now[0])
+    breaker.failure()
+    breaker.check()
+    breaker.failure()
+    with pytest.raises(CircuitOpenException):
+        breaker.check()
+    now[0] = 10
+    # A single request tests the servers, the other ones still fail
+    breaker.check()
+    with pytest.raises(CircuitOpenException):
+        breaker.check()
+    breaker.success()
+    breaker.check()
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from pyhusmow.async_api import AsyncAPI  # noqa: E402
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_status(mock):
+    async def statuses():
+        async with AsyncAPI(mock.url, mock.url, retries=1, backoff=0) as mow:
+            await mow.login('me', 'secret')
+            robots = await mow.list_robots()
+            return await asyncio.gather(*[mow.status(robot['id']) for robot in robots * 5])
+
+    results = run(statuses())
+    assert len(results) == 10 and all(status['mowerStatus'] for status in results)
+    assert mock.calls('GET mowers/<id>/status') == 10
+
+
+def test_retries(mock):
+    async def status():
+        async with AsyncAPI(mock.url, mock.url, retries=1, backoff=0) as mow:
+            await mow.login('me', 'secret')
+            robots = await mow.list_robots()
+            mock.state.error_rate = 1
+            with pytest.raises(aiohttp.ClientResponseError) as error:
+                await mow.status(robots[0]['id'])
+            return error.value
+
+    assert run(status()).status == 503
+    # The failed request and its retry
+    assert mock.calls('GET mowers/<id>/status') == 2
+
+
+def test_control(mock):
+    async def control():
+        async with AsyncAPI(mock.url, mock.url) as mow:
+            await mow.login('me', 'secret')
+            robots = await mow.list_robots()
+            await mow.control('PARK', robots[1]['id'])
+
+    run(control())
+    assert [mower.override for mower in mock.state.mowers] == [None, 'PARKED_PARKED_SELECTED']
@@ -0,0 +1,104 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import husmow_logger
+
+from pyhusmow.binary_log import HEADER_SIZE, RECORD, BinaryLogReader, BinaryLogWriter
+
+START = datetime(2024, 5, 1, 10, 0)
+STATUSES = ['OK_CUTTING', 'OK_CUTTING', 'OK_SEARCHING', 'OK_CHARGING', 'OK_CHARGING']
+
+
+def write(path, count=5, start=START, append=False):
+    writer = BinaryLogWriter(path, append=append)
+    for i in range(count):
+        writer.write_status(start + timedelta(0, 60 * i), STATUSES[i % len(STATUSES)], 50 + i,
+                            START + timedelta(1) if i == 0 else None, timedelta(0, 30 * i), 45 + i / 1000,
+                            5 - i / 1000)
+    writer.close()
+
+
+def test_write_and_read(workdir):
+    write('log.bin')
+    assert os.path.getsize('log.bin') == HEADER_SIZE + 5 * RECORD.size
+    with BinaryLogReader('log.bin') as reader:
+        assert len(reader) == 5
+        assert reader.statuses == ['OK_CUTTING', 'OK_SEARCHING', 'OK_CHARGING']
+        rows = list(reader.rows())
+    next_start = (START + timedelta(1) - datetime(1970, 1, 1)).total_seconds()
+    assert rows[0] == (START.timestamp(), 'OK_CUTTING', 50, next_start, 0, 45.0, 5.0)
+    assert [row[1] for row in rows] == STATUSES
+    assert [row[3] for row in rows[1:]] == [0] * 4
+    assert rows[4][4] == 120 and rows[4][5] == pytest.approx(45.004)
+
+
+def test_reopen(workdir):
+    write('log.bin', count=3)
+    # A resumed logger continues the log, a new run starts it again
+    write('log.bin', count=2, start=START + timedelta(0, 3600), append=True)
+    with BinaryLogReader('log.bin') as reader:
+        assert [row[0] for row in reader.rows()] == [START.timestamp() + t for t in (0, 60, 120, 3600, 3660)]
+        assert [row[1] for row in reader.rows()] == STATUSES[:3] + STATUSES[:2]
+    write('log.bin', count=2, start=START - timedelta(1))
+    with BinaryLogReader('log.bin') as reader:
+        assert len(reader) == 2
+
+
+def test_truncated_record(workdir):
+    write('log.bin', count=3)
+    # A record partially written before a crash is dropped when the log is continued
+    with open('log.bin', 'ab') as f:
+        f.write(b'\1' * 10)
+    write('log.bin', count=1, start=START + timedelta(0, 3600), append=True)
+    with BinaryLogReader('log.bin') as reader:
+        assert len(reader) == 4
+
+
+def test_not_a_binary_log(workdir):
+    with open('log.csv', 'w') as f:
+        f.write('time,status\n' * 500)
+    with pytest.raises(ValueError):
+        BinaryLogReader('log.csv')
+
+
+def test_range(workdir):
+    write('log.bin')
+    with BinaryLogReader('log.bin') as reader:
+        times = [row[0] for row in reader.rows(START + timedelta(0, 60), START + timedelta(0, 180))]
+        assert times == [START.timestamp() + 60, START.timestamp() + 120]
+        assert len(list(reader.rows(start=START.timestamp() + 61))) == 3
+        assert len(list(reader.rows(end=START))) == 0
+        assert len(list(reader.rows(START + timedelta(0, 180), START))) == 0
+
+
+def test_records_and_columns(workdir):
+    pytest.importorskip('numpy')
+    write('log.bin')
+    with BinaryLogReader('log.bin') as reader:
+        records = reader.records(START + timedelta(0, 60), START + timedelta(0, 180))
+        assert list(records['battery']) == [51, 52]
+        # An end before the start selects nothing, like rows()
+        assert len(reader.records(START + timedelta(0, 120), START + timedelta(0, 60))) == 0
+        assert len(reader.records(START + timedelta(0, 180), START)) == 0
+        columns = reader.columns()
+        assert sorted(columns) == sorted(['time', 'status', 'battery', 'next_start', 'duration', 'latitude',
+                                          'longitude'])
+        assert [reader.statuses[code] for code in columns['status']] == STATUSES
+        assert list(columns['duration']) == [0, 30, 60, 90, 120]
+        del records, columns
+
+
+def test_empty(workdir):
+    BinaryLogWriter('log.bin').close()
+    with BinaryLogReader('log.bin') as reader:
+        assert len(reader) == 0 and list(reader.rows()) == []
+
+
+def test_logger_options(workdir):
+    for options in (['--rotate-size', '1M'], ['--rotate-daily'], ['--compress', 'gzip']):
+        result = husmow_logger(workdir, '--format', 'binary', '-f', 'log.bin', *options)
+        assert result.returncode == 2 and 'does not support' in result.stderr
+    result = husmow_logger(workdir, '--format', 'binary')
+    assert result.returncode == 2 and 'requires --file' in result.stderr
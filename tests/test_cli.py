@@ -0,0 +1,83 @@
+import json
+import os
+
+from conftest import husmow, mock_args, url_args
+
+
+def run_json(workdir, *args):
+    # The output and the errors are printed as separate json documents, merged here
+    result = husmow(workdir, '--json', *args)
+    assert result.returncode == 0, result.stderr
+    decoder = json.JSONDecoder()
+    output = {}
+    text = result.stdout.strip()
+    while text:
+        document, end = decoder.raw_decode(text)
+        output.update(document)
+        text = text[end:].strip()
+    return output
+
+
+def test_batch_control_with_an_unknown_mower(mock, workdir):
+    output = run_json(workdir, *mock_args(mock) + ['control', 'PARK', '--mower', 'mower1,unknown,mower2'])
+    results = {result['name']: result for result in output['control']}
+    assert results['mower1']['success'] and results['mower2']['success']
+    assert not results['unknown']['success'] and 'unknown' in results['unknown']['error']
+    assert mock.calls('POST mowers/<id>/control') == 2
+
+
+def test_batch_control_all(mock, workdir):
+    output = run_json(workdir, *mock_args(mock) + ['control', 'STOP', '--all'])
+    assert [result['success'] for result in output['control']] == [True, True]
+    assert [mower.override for mower in mock.state.mowers] == ['PAUSED', 'PAUSED']
+
+
+def test_status_uses_the_mower_cache(mock, workdir):
+    # The login is saved in automower.cfg: the cached list belongs to it
+    status = run_json(workdir, *mock_args(mock) + ['--save', 'status'])['status']
+    assert status['mowerStatus']
+    assert all(os.path.exists(name) for name in ('automower.cfg', 'token.cfg', 'mowers.cfg'))
+    assert mock.calls('GET mowers') == 1
+
+    # The saved token and the cached mower list: a single request
+    run_json(workdir, *url_args(mock) + ['status'])
+    run_json(workdir, *url_args(mock) + ['--mower', 'mower2', 'status'])
+    assert mock.calls('GET mowers') == 1
+    assert mock.calls('POST token') == 1
+    assert mock.calls('GET mowers/<id>/status') == 3
+
+
+def test_mower_added_after_the_cache(mock, workdir):
+    run_json(workdir, *mock_args(mock) + ['--save', 'status'])
+    with open('mowers.cfg') as f:
+        cache = f.read()
+    with open('mowers.cfg', 'w') as f:
+        f.write('\n'.join(line for line in cache.splitlines() if 'mower2' not in line))
+    run_json(workdir, *url_args(mock) + ['--mower', 'mower2', 'status'])
+    assert mock.calls('GET mowers') == 2
+
+
+def test_list_refreshes_the_cache(mock, workdir):
+    robots = run_json(workdir, *mock_args(mock) + ['list'])['list']
+    assert [robot['name'] for robot in robots] == ['mower1', 'mower2']
+    run_json(workdir, *url_args(mock) + ['list'])
+    assert mock.calls('GET mowers') == 2
+
+
+def test_control(mock, workdir):
+    run_json(workdir, *mock_args(mock) + ['--mower', 'mower2', 'control', 'PARK'])
+    assert mock.calls('POST mowers/<id>/control') == 1
+    assert mock.state.mowers[1].override == 'PARKED_PARKED_SELECTED'
+
+
+def test_missing_login(workdir):
+    result = husmow(workdir, '--json', '--no-daemon', 'status')
+    assert result.returncode == 1
+    assert json.loads(result.stdout)['errors'] == ['Missing login or password']
+
+
+def test_mower_cache_disabled(mock, workdir):
+    run_json(workdir, *mock_args(mock) + ['--mower-cache-ttl', '0', 'status'])
+    run_json(workdir, *mock_args(mock) + ['--mower-cache-ttl', '0', 'status'])
+    assert not os.path.exists('mowers.cfg')
+    assert mock.calls('GET mowers') == 2
@@ -0,0 +1,78 @@
+import argparse
+import json
+import socket
+import threading
+
+import pytest
+
+from conftest import husmow, mock_args
+
+from pyhusmow import daemon
+
+
+@pytest.fixture
+def listener(tmp_path):
+    path = str(tmp_path / 'husmow.sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    yield sock
+    sock.close()
+
+
+def command_args(path, command='status', **kwargs):
+    args = argparse.Namespace(command=command, socket=path, mower=None, mowers=None, all_mowers=False,
+                              action=None, json=False)
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def test_no_daemon(tmp_path):
+    assert not daemon.forward_command(command_args(str(tmp_path / 'husmow.sock')), print)
+    # Only status, control and list are forwarded
+    assert not daemon.forward_command(command_args(str(tmp_path), command='geo'), print)
+
+
+def test_daemon_stopped(tmp_path):
+    # A socket left by a stopped daemon: the command is sent directly
+    path = str(tmp_path / 'husmow.sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.close()
+    assert not daemon.forward_command(command_args(path), print)
+
+
+def test_daemon_without_answer(listener, monkeypatch, caplog):
+    # A daemon that accepts the command and never answers: reported, and not sent again directly
+    monkeypatch.setattr(daemon.UnixHTTPConnection.__init__, '__defaults__', (0.5,))
+    assert daemon.forward_command(command_args(listener.getsockname(), 'control', action='PARK'), print)
+    assert 'no answer from the daemon' in caplog.text
+
+
+def test_daemon_closes_the_connection(listener, caplog):
+    # The daemon read the command before closing the connection: it may have been sent
+    def serve():
+        conn, _ = listener.accept()
+        conn.recv(65536)
+        conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    assert daemon.forward_command(command_args(listener.getsockname(), 'control', action='PARK'), print)
+    assert 'no answer from the daemon' in caplog.text
+
+
+def test_forwarded_commands(mock, server_factory, workdir):
+    server_factory(mock_args(mock), '--daemon')
+    result = husmow(workdir, '--json', 'status')
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout)['status']['mowerStatus']
+    result = husmow(workdir, '--json', 'list')
+    assert [robot['name'] for robot in json.loads(result.stdout)['list']] == ['mower1', 'mower2']
+    result = husmow(workdir, '--json', 'control', 'PARK', '--mower', 'mower2,unknown')
+    # Followed by the errors
+    results = json.JSONDecoder().raw_decode(result.stdout)[0]['control']
+    assert {result['name']: result['success'] for result in results} == {'mower2': True, 'unknown': False}
+    # The daemon logged in once: the commands did not log in again
+    assert mock.calls('POST token') == 1
+    assert mock.calls('POST mowers/<id>/control') == 1
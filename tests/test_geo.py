@@ -0,0 +1,110 @@
+import json
+import os
+
+import pytest
+
+from conftest import husmow, mock_args
+
+np = pytest.importorskip('numpy')
+
+from pyhusmow.geo import RECORD_SIZE, Trail, new_points, parse_geofence  # noqa: E402
+
+# About one meter north
+STEP = 90e-7
+GEOFENCE = {'centralPoint': {'location': {'latitude': 45.0, 'longitude': 5.0}, 'sensitivity': {'radius': 10}}}
+
+
+def locations(first, count):
+    # lastLocations of a mower walking north: points first to first + count - 1, latest first
+    return [{'latitude': 45.0 + i * STEP, 'longitude': 5.0} for i in reversed(range(first, first + count))]
+
+
+def status(first, count):
+    return {'mowerStatus': 'OK_CUTTING', 'lastLocations': locations(first, count)}
+
+
+def points(first, count):
+    return [(450000000 + i * 90, 50000000) for i in range(first, first + count)]
+
+
+def test_new_points():
+    assert new_points([], locations(0, 5)) == points(0, 5)
+    # The next status shares most of its locations with the previous one
+    assert new_points(points(0, 5), locations(2, 5)) == points(5, 2)
+    assert new_points(points(0, 5), locations(0, 5)) == []
+    # No overlap: the mower went further than lastLocations
+    assert new_points(points(0, 5), locations(20, 5)) == points(20, 5)
+    # A mower that does not move repeats the same point
+    still = [{'latitude': 45.0, 'longitude': 5.0}] * 5
+    assert new_points(new_points([], still), still) == []
+
+
+def test_parse_geofence():
+    assert parse_geofence(GEOFENCE) == ((45.0, 5.0), 10)
+    assert parse_geofence({'centralPoint': None}) is None
+
+
+def test_trail():
+    trail = Trail(cell_size=1.0, geofence=GEOFENCE)
+    assert trail.update(status(0, 10), 100) == 10
+    assert trail.update(status(5, 10), 160) == 5
+    assert trail.update(status(5, 10), 220) == 0
+    summary = trail.summary(heatmap=True)
+    assert summary['points'] == 15 and summary['updated'] == 160
+    assert summary['distance'] == pytest.approx(14 * 1.0007, abs=0.05)
+    assert summary['cells'] == 15 and summary['covered_area'] == 15
+    assert sum(count for _, _, count in summary['heatmap']) == 15
+    # Points 10 to 14 are further than 10 meters from the center
+    assert summary['geofence']['outside'] == 5
+    assert summary['geofence']['max_distance'] == pytest.approx(14 * 1.0007, abs=0.05)
+    assert summary['geofence']['margin'] == pytest.approx(10 - 14 * 1.0007, abs=0.05)
+
+
+def test_trail_file(workdir):
+    trail = Trail('mower.trail')
+    trail.update(status(0, 10), 100)
+    trail.close()
+    assert os.path.getsize('mower.trail') == 10 * RECORD_SIZE
+    # A partial record written during a crash is ignored
+    with open('mower.trail', 'ab') as f:
+        f.write(b'\0' * 5)
+
+    trail = Trail('mower.trail')
+    assert trail.summary()['points'] == 10
+    # Reloaded points are known: only the new ones are added
+    assert trail.update(status(5, 10), 160) == 5
+    trail.close()
+    records = np.fromfile('mower.trail', dtype=[('time', '<u4'), ('latitude', '<i4'), ('longitude', '<i4')])
+    assert len(records) == 15
+    assert records['time'][-1] == 160
+
+    # Analyzed without being continued
+    trail = Trail('mower.trail', append=False)
+    trail.update(status(20, 5), 200)
+    trail.close()
+    assert Trail('mower.trail', append=False).summary()['points'] == 15
+
+
+def test_cli_trail(workdir):
+    trail = Trail('mower.trail')
+    trail.update(status(0, 10), 100)
+    trail.close()
+    result = husmow(workdir, '--json', 'geo', '--trail', 'mower.trail', '--heatmap')
+    assert result.returncode == 0, result.stderr
+    summary = json.loads(result.stdout)['geo']
+    assert summary['points'] == 10 and len(summary['heatmap']) == 10
+
+
+def test_server_geo(mock, server_factory, workdir):
+    server = server_factory(mock_args(mock), '--geo', '--trail-dir', '.')
+    summary = server.get_json('/geo')
+    assert summary['points'] == 50 and summary['geofence']['radius'] == 50
+    summary = server.get_json('/mowers/mower2/geo?heatmap=1')
+    assert summary['points'] == 50 and summary['heatmap']
+    assert sorted(name for name in os.listdir('.') if name.endswith('.trail')) == sorted(
+        '%s.trail' % mower.id for mower in mock.state.mowers)
+
+
+def test_server_without_geo(mock, server_factory):
+    server = server_factory(mock_args(mock))
+    assert server.request('GET', '/geo')[0] == 404
@@ -0,0 +1,78 @@
+import sqlite3
+from datetime import datetime
+
+from conftest import mock_args
+
+from pyhusmow.history import HistoryStore, parse_time
+
+
+def status(mower_status, battery, latitude=45.0):
+    return {'mowerStatus': mower_status, 'batteryPercent': battery, 'nextStartTimestamp': 0,
+            'lastLocations': [{'latitude': latitude, 'longitude': 5.0}]}
+
+
+def test_parse_time():
+    assert parse_time(None) is None and parse_time('') is None
+    assert parse_time('1700000000.5') == 1700000000.5
+    assert parse_time('2024-05-01T10:00:00') == datetime(2024, 5, 1, 10).timestamp()
+
+
+def test_batches(workdir):
+    store = HistoryStore('history.db', batch_size=3, flush_interval=3600)
+    for i in range(4):
+        store.add_status('a', 100 + i, status('OK_CUTTING', 90 - i))
+    # The first batch is in the database, the last sample is still pending
+    conn = sqlite3.connect('history.db')
+    assert conn.execute('SELECT COUNT(*) FROM status').fetchone() == (3,)
+    store.close()
+    assert conn.execute('SELECT COUNT(*) FROM status').fetchone() == (4,)
+    conn.close()
+
+
+def test_query(workdir):
+    store = HistoryStore('history.db')
+    for i in range(10):
+        store.add_status('a', 100 + 10 * i, status('OK_CUTTING', 90 - i, 45 + i))
+        store.add_status('b', 105 + 10 * i, status('OK_CHARGING', 50 + i))
+    store.add_status('b', 300, {'mowerStatus': 'OFF', 'batteryPercent': 0, 'lastLocations': []})
+
+    rows = store.query()
+    assert len(rows) == 21 and [row['time'] for row in rows] == sorted(row['time'] for row in rows)
+    assert rows[0] == {'mower': 'a', 'time': 100, 'status': 'OK_CUTTING', 'battery': 90, 'next_start': None,
+                       'latitude': 45.0, 'longitude': 5.0}
+    assert rows[-1]['latitude'] is None
+    assert len(store.query('a')) == 10
+    assert [row['time'] for row in store.query('a', 120, 150)] == [120, 130, 140]
+    assert len(store.query(limit=5)) == 5
+
+    # The latest sample of each 50 seconds period
+    rows = store.query('a', step=50)
+    assert [row['time'] for row in rows] == [140, 190]
+    assert [row['battery'] for row in rows] == [86, 81]
+    assert [row['latitude'] for row in rows] == [49.0, 54.0]
+    assert len(store.query(step=50)) == 5
+    store.close()
+
+    # Reopened
+    store = HistoryStore('history.db')
+    assert len(store.query('b')) == 11
+    store.close()
+
+
+def test_server_history(mock, server_factory, workdir):
+    server = server_factory(mock_args(mock), '--history-db', 'history.db')
+    assert server.request('GET', '/status')[0] == 200
+    server.request('GET', '/mowers/mower2/status')
+    rows = server.get_json('/history')
+    assert len(rows) == 2
+    mower2 = server.get_json('/mowers')[1]['id']
+    rows = server.get_json('/history?mower=mower2&step=60&from=0')
+    assert len(rows) == 1 and rows[0]['mower'] == mower2
+    assert server.get_json('/history?to=0') == []
+    assert server.request('GET', '/history?mower=unknown')[0] == 404
+    assert server.request('GET', '/history?step=x')[0] == 400
+
+
+def test_server_without_history(mock, server_factory):
+    server = server_factory(mock_args(mock))
+    assert server.request('GET', '/history')[0] == 404
@@ -0,0 +1,175 @@
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import ROOT, husmow, logger_args, mock_args, mock_config
+
+from pyhusmow import status_logger
+from pyhusmow.husmow import API, TokenConfig
+from pyhusmow.writers import CsvStatusWriter
+
+
+@pytest.fixture
+def mock(mock_factory):
+    mock = mock_factory()
+    mock.hold('OK_CUTTING')
+    return mock
+
+
+def run(mock, seconds=2.5, **kwargs):
+    # Logs every second for a few seconds. The last poll happens at the stop time
+    args = logger_args(**kwargs)
+    status_logger.run_logger(TokenConfig(), mock_config(mock), args, datetime.now() + timedelta(0, seconds))
+
+
+def read_lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def test_csv(mock, workdir):
+    run(mock, file='log.csv')
+    lines = read_lines('log.csv')
+    assert lines[0] == 'mower,' + CsvStatusWriter.HEADER
+    rows = [line.split(',') for line in lines[1:]]
+    # Both mowers polled at the start, after 1 and 2 seconds and at the stop time
+    assert len(rows) == 8
+    assert sorted(row[0] for row in rows) == ['mower1'] * 4 + ['mower2'] * 4
+    assert all(float(row[6]) and float(row[7]) for row in rows)
+
+
+def test_file_per_mower(mock, workdir):
+    run(mock, file='{mower}.csv')
+    for name in ('mower1', 'mower2'):
+        lines = read_lines('%s.csv' % name)
+        assert lines[0] == CsvStatusWriter.HEADER and len(lines) == 5
+
+
+def test_summary(mock, workdir):
+    run(mock, file='log.csv', summary='summary.csv')
+    lines = read_lines('summary.csv')
+    # The status of each mower when the logger stops
+    assert lines[0] == 'mower,time,status,status duration' and len(lines) == 3
+
+
+def test_one_mower(mock, workdir):
+    run(mock, file='log.csv', mower='mower2', all_mowers=False)
+    lines = read_lines('log.csv')
+    assert lines[0] == CsvStatusWriter.HEADER and len(lines) == 5
+    assert mock.calls('GET mowers/<id>/status') == 4
+
+
+def test_jsonl(mock, workdir):
+    run(mock, file='log.jsonl', format='jsonl')
+    samples = [json.loads(line) for line in read_lines('log.jsonl')]
+    assert len(samples) == 8
+    for name in ('mower1', 'mower2'):
+        mower_samples = [sample for sample in samples if sample['mower'] == name]
+        assert mower_samples[0]['delta'] is None
+        assert all(sample['delta']['seconds'] > 0 for sample in mower_samples[1:])
+        assert all(sample['status'] == sample['raw']['mowerStatus'] for sample in mower_samples)
+
+
+def test_jsonl_to_stdout(mock, workdir, capsys):
+    run(mock, seconds=0.5, format='jsonl', mower='mower1', all_mowers=False)
+    samples = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(samples) == 2 and samples[1]['delta']['previous_status'] is None
+    assert samples[0]['raw']['lastLocations'][0]['latitude'] == samples[0]['latitude']
+
+
+def test_resume(mock, workdir):
+    run(mock, seconds=1.5, file='log.csv', checkpoint='checkpoint.cfg')
+    assert os.path.exists('checkpoint.cfg')
+    first = read_lines('log.csv')
+    run(mock, seconds=1.5, file='log.csv', checkpoint='checkpoint.cfg')
+    lines = read_lines('log.csv')
+    # Appended to, without a second header
+    assert lines[:len(first)] == first and len(lines) > len(first)
+    assert [line for line in lines if line.startswith('mower,')] == [lines[0]]
+
+
+def test_resume_to_a_pipe(mock, workdir, monkeypatch):
+    # The standard output may not be seekable: the rows are still written, after the header
+    read_fd, write_fd = os.pipe()
+    output = []
+    reader = threading.Thread(target=lambda: output.append(os.fdopen(read_fd).read()))
+    reader.start()
+    pipe = io.TextIOWrapper(io.FileIO(write_fd, 'w'), line_buffering=True)
+    monkeypatch.setattr(sys, 'stdout', pipe)
+    open('checkpoint.cfg', 'w').close()
+    run(mock, seconds=1.5, checkpoint='checkpoint.cfg')
+    run(mock, seconds=1.5, checkpoint='checkpoint.cfg')
+    pipe.close()
+    reader.join()
+    lines = output[0].splitlines()
+    assert lines[0] == 'mower,' + CsvStatusWriter.HEADER
+    assert len([line for line in lines if line.startswith('mower1,')]) >= 4
+
+
+def test_bad_status_is_skipped(mock, workdir, monkeypatch, capsys):
+    # A status without locations loses its sample, not the logger
+    status = API.status
+    calls = []
+
+    def first_without_locations(self, *args, **kwargs):
+        mow_status = status(self, *args, **kwargs)
+        calls.append(mow_status)
+        if len(calls) == 1:
+            mow_status['lastLocations'] = []
+        return mow_status
+
+    monkeypatch.setattr(API, 'status', first_without_locations)
+    run(mock, file='log.csv')
+    assert 'Failed to log the status of mower1' in capsys.readouterr().err
+    rows = read_lines('log.csv')[1:]
+    assert len([row for row in rows if row.startswith('mower1,')]) == 3
+    assert len([row for row in rows if row.startswith('mower2,')]) == 4
+
+
+def test_servers_down(mock, workdir):
+    # The logger waits for the servers, then logs until the stop time
+    mock.state.error_rate = 1
+    timer = threading.Timer(1.5, lambda: setattr(mock.state, 'error_rate', 0))
+    timer.start()
+    try:
+        run(mock, seconds=6, file='log.csv', mower='mower1', all_mowers=False)
+    finally:
+        timer.cancel()
+    assert mock.calls('POST token') > 1
+    assert len(read_lines('log.csv')) > 1
+
+
+@pytest.mark.parametrize('signum', [signal.SIGKILL, signal.SIGTERM])
+def test_killed(mock, workdir, signum):
+    # The rows covered by the checkpoint are on the disk, however the logger is stopped
+    husmow(workdir, *mock_args(mock) + ['--save', 'status'])
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    logger = subprocess.Popen([sys.executable, '-c', 'import pyhusmow.status_logger as m; m.main()', '--all-mowers',
+                               '--delay', '1', '--flush-interval', '3600', '--file', 'log.csv', '--summary-file',
+                               'summary.csv', '--checkpoint', 'ck.cfg', '--auth-url', mock.url, '--track-url',
+                               mock.url], cwd=str(workdir), env=env, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(3)
+    finally:
+        logger.send_signal(signum)
+        logger.wait(10)
+    checkpoint = ConfigParser(interpolation=None)
+    checkpoint.read('ck.cfg')
+    lines = read_lines('log.csv')
+    assert lines[0] == 'mower,' + CsvStatusWriter.HEADER
+    for mower in checkpoint.sections():
+        section = checkpoint[mower]
+        assert [line for line in lines if line.startswith('%s,%s,' % (section['name'], section['last_sample']))]
+    assert len(checkpoint.sections()) == 2
+    if signum == signal.SIGTERM:
+        # The files are closed on the way out: the header of the summary is on the disk too
+        assert logger.returncode == 128 + signum and len(read_lines('summary.csv')) == 1
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+from conftest import logger_args, mock_args, mock_config
+
+from pyhusmow import metrics, status_logger
+from pyhusmow.husmow import API, TokenConfig
+
+
+def test_counter_labels():
+    counter = metrics.Counter('test_total', 'Test', ['operation', 'code'])
+    counter.inc('status', 200)
+    counter.inc('status', 'error')
+    counter.inc('status', 200, amount=2)
+    counter.inc('say "hi"\n', 200)
+    # Mixed codes and errors sort and render
+    assert counter.render().splitlines() == [
+        '# HELP test_total Test',
+        '# TYPE test_total counter',
+        'test_total{operation="say \\"hi\\"\\n",code="200"} 1',
+        'test_total{operation="status",code="200"} 3',
+        'test_total{operation="status",code="error"} 1',
+    ]
+    assert metrics.Counter('test_logins_total', 'Test').render().endswith('\ntest_logins_total 0')
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'Test', ['operation'], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, 'status')
+    assert histogram.render().splitlines()[2:] == [
+        'test_seconds_bucket{operation="status",le="0.1"} 1',
+        'test_seconds_bucket{operation="status",le="1"} 3',
+        'test_seconds_bucket{operation="status",le="+Inf"} 4',
+        'test_seconds_sum{operation="status"} 6.05',
+        'test_seconds_count{operation="status"} 4',
+    ]
+
+
+def test_mower_status():
+    metrics.observe_status('test-mower', {'mowerStatus': 'OK_CUTTING', 'batteryPercent': 80}, 100)
+    metrics.observe_status('test-mower', {'mowerStatus': 'OK_SEARCHING', 'batteryPercent': 20}, 160)
+    text = metrics.render()
+    # Only the current status of the mower is exported
+    assert 'husmow_mower_status{mower="test-mower",status="OK_SEARCHING"} 1' in text
+    assert 'husmow_mower_status{mower="test-mower",status="OK_CUTTING"}' not in text
+    assert 'husmow_mower_battery_percent{mower="test-mower"} 20' in text
+
+
+def test_api_requests(mock_factory):
+    mock = mock_factory()
+    url = mock.url
+    mock.close()
+    mow = API(url, url, retries=1, backoff=0)
+    with pytest.raises(requests.ConnectionError):
+        mow.login('me', 'secret')
+    text = metrics.render()
+    # Recorded with the code 'error', next to the numeric codes
+    assert 'husmow_api_requests_total{operation="login",code="error"}' in text
+    assert 'husmow_api_retries_total{operation="login"}' in text
+
+
+def test_server_metrics(mock, server_factory):
+    server = server_factory(mock_args(mock), '--expire', '30')
+    server.get_json('/status')
+    server.get_json('/status')
+    status, headers, body = server.request('GET', '/metrics')
+    assert status == 200 and headers['Content-Type'] == metrics.CONTENT_TYPE
+    text = body.decode('utf-8')
+    assert 'husmow_api_requests_total{operation="status",code="200"} 1' in text
+    assert 'husmow_status_cache_total{result="hit"} 1' in text
+    assert 'husmow_mower_battery_percent{mower="mower1"}' in text
+
+
+def test_logger_metrics_file(mock, workdir):
+    args = logger_args(file='log.csv', metrics_file='husmow.prom')
+    status_logger.run_logger(TokenConfig(), mock_config(mock), args, datetime.now() + timedelta(0, 0.5))
+    with open('husmow.prom') as f:
+        text = f.read()
+    assert 'husmow_mower_battery_percent{mower="mower2"}' in text
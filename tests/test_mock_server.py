@@ -0,0 +1,53 @@
+import json
+
+import requests
+
+
+def token(mock):
+    response = requests.post(mock.url + 'token', json={})
+    assert response.status_code == 201
+    return {'Authorization': 'Bearer %s' % response.json()['data']['id']}
+
+
+def test_mowers_and_status(mock):
+    headers = token(mock)
+    mowers = requests.get(mock.url + 'mowers', headers=headers).json()
+    assert [mower['name'] for mower in mowers] == ['mower1', 'mower2']
+    status = requests.get(mock.url + 'mowers/%s/status' % mowers[0]['id'], headers=headers).json()
+    assert status['mowerStatus'] and len(status['lastLocations']) == 50
+    assert mock.calls('GET mowers/<id>/status') == 1
+
+
+def test_unauthorized(mock):
+    assert requests.get(mock.url + 'mowers').status_code == 401
+    assert requests.get(mock.url + 'mowers', headers={'Authorization': 'Bearer other'}).status_code == 401
+
+
+def test_control(mock):
+    headers = token(mock)
+    mower = mock.state.mowers[1]
+    url = mock.url + 'mowers/%s/control' % mower.id
+    assert requests.post(url, json={'action': 'PARK'}, headers=headers).status_code == 200
+    assert mower.override == 'PARKED_PARKED_SELECTED'
+    assert requests.post(url, json={'action': 'OTHER'}, headers=headers).status_code == 400
+    assert requests.get(mock.url + 'mowers/unknown/status', headers=headers).status_code == 404
+
+
+def test_injected_failures(mock):
+    mock.state.error_rate = 1
+    assert requests.post(mock.url + 'token', json={}).status_code == 503
+    mock.state.error_rate = 0
+    mock.state.throttle_rate = 1
+    response = requests.post(mock.url + 'token', json={})
+    assert response.status_code == 429 and response.headers['Retry-After'] == '1'
+    assert json.loads(response.content)['errors'] == [{'status': '429'}]
+    assert mock.calls('POST token') == 2
+
+
+def test_cycle(mock_factory):
+    mock = mock_factory(mowers=1, period=100)
+    mower = mock.state.mowers[0]
+    # Leaving, cutting, searching, charging, then parked by the timer with a next start
+    statuses = [mower.status(now)['mowerStatus'] for now in (1, 20, 52, 60, 90)]
+    assert statuses == ['OK_LEAVING', 'OK_CUTTING', 'OK_SEARCHING', 'OK_CHARGING', 'PARKED_TIMER']
+    assert mower.status(90)['nextStartTimestamp'] and not mower.status(20)['nextStartTimestamp']
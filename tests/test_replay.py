@@ -0,0 +1,53 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import husmow, husmow_logger, logger_args, mock_config
+
+from pyhusmow import status_logger
+from pyhusmow.husmow import TokenConfig
+
+
+@pytest.fixture
+def recording(mock, workdir):
+    # Three seconds of traffic of the mock, polled every second
+    mock.hold('OK_CUTTING')
+    args = logger_args(record='traffic.gz')
+    status_logger.run_logger(TokenConfig(), mock_config(mock), args, datetime.now() + timedelta(0, 3))
+    return 'traffic.gz'
+
+
+def replay(workdir, recording, output, *args):
+    # A replay as fast as possible must end: the timeout fails a replay polling forever
+    result = husmow_logger(workdir, '--all-mowers', '-d', '1', '-u', '1m', '--replay', recording, '-f', output,
+                           *args, timeout=30)
+    assert result.returncode == 0, result.stderr
+    with open(output) as f:
+        return f.read()
+
+
+def test_replay_ends_at_the_stop_time(workdir, recording):
+    rows = replay(workdir, recording, 'replay.csv').splitlines()[1:]
+    # A poll every second of the virtual minute, and the last one at the stop time
+    assert len(rows) == 2 * 61
+    times = [datetime.fromisoformat(row.split(',')[1]) for row in rows]
+    assert (max(times) - min(times)).total_seconds() == pytest.approx(60, abs=1)
+
+
+def test_replay_is_deterministic(workdir, recording):
+    first = replay(workdir, recording, 'first.csv', '--schedule', 'adaptive', '-s', 'summary.csv')
+    second = replay(workdir, recording, 'second.csv', '--schedule', 'adaptive', '-s', 'summary.csv')
+    assert first == second
+
+
+def test_cli_replay_keeps_the_mower_cache(workdir, recording):
+    with open('mowers.cfg', 'w') as f:
+        f.write('[husqvarna.net]\nlogin = me\nupdated_on = 2100-01-01T00:00:00\n\n[mowers]\nother = other\n\n')
+    with open('mowers.cfg') as f:
+        cache = f.read()
+    result = husmow(workdir, '--replay', recording, '--json', 'status', timeout=30)
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout)['status']['mowerStatus']
+    with open('mowers.cfg') as f:
+        assert f.read() == cache
@@ -0,0 +1,119 @@
+import gzip
+import json
+import random
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import husmow_logger
+
+from pyhusmow.report import FIELDS, Report
+from pyhusmow.writers import CsvStatusWriter
+
+START = datetime(2026, 6, 1, 10)
+
+# (minutes since START, status, battery)
+SAMPLES = [
+    (0, 'OK_LEAVING', 100),
+    (1, 'OK_CUTTING', 99),
+    (61, 'OK_CUTTING', 69),
+    (121, 'OK_SEARCHING', 39),
+    (126, 'OK_CHARGING', 38),
+    (186, 'OK_CHARGING', 98),
+    (216, 'PARKED_TIMER', 100),
+    # 10 hours later: the logger was stopped
+    (816, 'ERROR', 100),
+    (850, 'PARKED_TIMER', 100),
+    (860, 'OK_CUTTING', 100),
+]
+
+EXPECTED = [
+    {'day': '2026-06-01', 'mower': 'mower1', 'samples': 8, 'mowing hours': 2.0, 'charging hours': 1.5,
+     'discharge %/h': 30.2, 'charge %/h': 60.0, 'errors': 1},
+    {'day': '2026-06-02', 'mower': 'mower1', 'samples': 2, 'mowing hours': 0.0, 'charging hours': 0.0,
+     'discharge %/h': None, 'charge %/h': None, 'errors': 0},
+]
+
+
+def sample_time(minutes):
+    return START + timedelta(0, 60 * minutes)
+
+
+def write_csv(path, samples, mower=None, opener=open):
+    with opener(path, 'wt') as f:
+        f.write(('mower,' if mower else '') + CsvStatusWriter.HEADER + '\n')
+        for minutes, status, battery in samples:
+            row = [sample_time(minutes).isoformat(), status, str(battery), '', '0:01:00', '58.4', '12.3']
+            f.write(','.join(([mower] if mower else []) + row) + '\n')
+
+
+def report(paths, **kwargs):
+    result = Report()
+    result.add_files(paths, **kwargs)
+    return list(result.rows())
+
+
+def test_csv(workdir):
+    write_csv('log.csv', SAMPLES, mower='mower1')
+    assert report(['log.csv']) == EXPECTED
+
+
+def test_jsonl(workdir):
+    with open('log.jsonl', 'w') as f:
+        for minutes, status, battery in SAMPLES:
+            f.write(json.dumps({'time': sample_time(minutes).isoformat(), 'mower': 'mower1', 'status': status,
+                                'battery': battery, 'raw': {}, 'delta': None}) + '\n')
+    assert report(['log.jsonl']) == EXPECTED
+
+
+def test_rotated_files(workdir):
+    # Segments without mower column are named after the file, and read in chronological order
+    write_csv('mower1.csv.1.gz', SAMPLES[:5], opener=gzip.open)
+    write_csv('mower1.csv', SAMPLES[5:])
+    assert report(['mower1.csv', 'mower1.csv.1.gz']) == EXPECTED
+
+
+def test_max_gap(workdir):
+    write_csv('log.csv', SAMPLES, mower='mower1')
+    result = Report(max_gap=30 * 60)
+    result.add_files(['log.csv'])
+    rows = list(result.rows())
+    # Only the intervals of at most 30 minutes are counted: no mowing hour, and the last half hour of charging
+    assert rows[0]['mowing hours'] == 0 and rows[0]['charging hours'] == 0.5 and rows[0]['charge %/h'] is None
+
+
+def random_samples(mowers, count):
+    generator = random.Random(1)
+    statuses = ['OK_LEAVING', 'OK_CUTTING', 'OK_SEARCHING', 'OK_CHARGING', 'PARKED_TIMER', 'ERROR',
+                'OFF_HATCH_OPEN']
+    samples = {mower: [] for mower in mowers}
+    for mower in mowers:
+        minutes = 0
+        for _ in range(count):
+            minutes += generator.choice([1, 5, 60, 200])
+            samples[mower].append((minutes, generator.choice(statuses), generator.randint(0, 100)))
+    return samples
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64 * 1024])
+def test_numpy_and_python(workdir, monkeypatch, chunk_size):
+    pytest.importorskip('numpy')
+    for mower, samples in random_samples(['mower1', 'mower2'], 500).items():
+        write_csv('%s.csv' % mower, samples)
+    numpy_rows = report(['mower1.csv', 'mower2.csv'], chunk_size=chunk_size)
+    assert len(numpy_rows) > 10
+    # Without NumPy, and whatever the chunks: the same statistics
+    monkeypatch.setitem(sys.modules, 'numpy', None)
+    python_rows = report(['mower1.csv', 'mower2.csv'], chunk_size=chunk_size)
+    assert python_rows == numpy_rows
+    assert report(['mower1.csv', 'mower2.csv']) == numpy_rows
+
+
+def test_command(workdir):
+    write_csv('log.csv', SAMPLES, mower='mower1')
+    result = husmow_logger(workdir, 'report', 'log.csv', '--json')
+    assert result.returncode == 0 and json.loads(result.stdout) == EXPECTED
+    result = husmow_logger(workdir, 'report', 'log.csv')
+    lines = result.stdout.splitlines()
+    assert lines == [','.join(FIELDS), '2026-06-01,mower1,8,2.0,1.5,30.2,60.0,1', '2026-06-02,mower1,2,0.0,0.0,,,0']
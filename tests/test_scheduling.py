@@ -0,0 +1,102 @@
+import pytest
+
+from conftest import husmow
+
+from pyhusmow.scheduling import AdaptivePolicy, FixedPolicy, make_policy, next_start
+
+NOW = 1700000000.0
+
+
+def status(mower_status, battery=80, start=None):
+    timestamp = 0
+    if start is not None:
+        # nextStartTimestamp is the local time of the start, expressed as a UTC timestamp
+        timestamp = int(start + start - next_start({'nextStartTimestamp': int(start)}))
+    return {'mowerStatus': mower_status, 'batteryPercent': battery, 'nextStartTimestamp': timestamp}
+
+
+def test_next_start():
+    assert next_start(status('OK_CUTTING')) is None
+    assert next_start(status('PARKED_TIMER', 100, NOW + 3600)) == NOW + 3600
+
+
+def test_fixed():
+    policy = FixedPolicy(60)
+    assert policy.next_delay(status('OK_CUTTING'), NOW) == 60
+    assert policy.next_delay(status('OK_CHARGING'), NOW) == 60
+    # Parked by the timer with a full battery: until 2 minutes before the next start
+    assert policy.next_delay(status('PARKED_TIMER', 100, NOW + 3600), NOW) == 3600 - 120
+    assert policy.next_delay(status('PARKED_TIMER', 90, NOW + 3600), NOW) == 60
+    assert policy.next_delay(status('PARKED_TIMER', 100, NOW + 60), NOW) == 60
+    assert policy.next_delay(status('PARKED_TIMER', 100), NOW) == 60
+    assert policy.error_delay(NOW) == 60
+
+
+def test_fixed_options():
+    policy = FixedPolicy(60, max_delay=600, active_delay=10)
+    assert policy.next_delay(status('OK_CUTTING'), NOW) == 10
+    assert policy.next_delay(status('OK_LEAVING'), NOW) == 10
+    assert policy.next_delay(status('OK_CHARGING'), NOW) == 60
+    assert policy.next_delay(status('PARKED_TIMER', 100, NOW + 3600), NOW) == 600
+    # The delay is never shorter than the usual one
+    assert FixedPolicy(60, active_delay=120).next_delay(status('OK_CUTTING'), NOW) == 60
+    assert FixedPolicy(900, max_delay=600).next_delay(status('PARKED_TIMER', 100, NOW + 3600), NOW) == 900
+
+
+def test_adaptive_settle():
+    policy = AdaptivePolicy(60, max_delay=1800)
+    # Every delay seconds for 5 delays after a change, and while leaving or searching
+    assert policy.next_delay(status('OK_CUTTING', 90), NOW) == 60
+    assert policy.next_delay(status('OK_CUTTING', 90), NOW + 240) == 60
+    assert policy.next_delay(status('OK_SEARCHING', 30), NOW + 300) == 60
+    assert policy.next_delay(status('OK_SEARCHING', 30), NOW + 900) == 60
+
+
+def test_adaptive_battery():
+    policy = AdaptivePolicy(60, max_delay=1800)
+    policy.next_delay(status('OK_CUTTING', 90), NOW)
+    # 10% in 600s: 50% left to the low battery in 3000s, polled after half of it
+    assert policy.next_delay(status('OK_CUTTING', 80), NOW + 600) == 1500
+    assert policy.next_delay(status('OK_CUTTING', 30), NOW + 3600) == 60
+
+    policy.next_delay(status('OK_CHARGING', 20), NOW)
+    # No rate known yet
+    assert policy.next_delay(status('OK_CHARGING', 20), NOW + 600) == 60
+    # 40% in 1200s: 40% left in 1200s
+    assert policy.next_delay(status('OK_CHARGING', 60), NOW + 1200) == 600
+    assert policy.next_delay(status('OK_CHARGING', 100), NOW + 2400) == 60
+
+
+def test_adaptive_parked():
+    policy = AdaptivePolicy(60, max_delay=1800)
+    policy.next_delay(status('PARKED_TIMER', 100, NOW + 7200), NOW)
+    assert policy.next_delay(status('PARKED_TIMER', 100, NOW + 7200), NOW + 600) == 1800
+    assert policy.next_delay(status('PARKED_TIMER', 100, NOW + 7200), NOW + 6000) == 1080
+    assert policy.next_delay(status('PARKED_TIMER', 100, NOW + 7200), NOW + 7100) == 60
+    # Any other status: at half the time since the change
+    policy.next_delay(status('PARKED_PARKED_SELECTED', 100), NOW)
+    assert policy.next_delay(status('PARKED_PARKED_SELECTED', 100), NOW + 1000) == 500
+    assert policy.next_delay(status('PARKED_PARKED_SELECTED', 100), NOW + 10000) == 1800
+
+
+def test_adaptive_backoff():
+    policy = AdaptivePolicy(60, max_delay=600)
+    assert [policy.error_delay(NOW) for _ in range(6)] == [60, 120, 240, 480, 600, 600]
+    # Reset by a status
+    policy.next_delay(status('OK_CUTTING'), NOW)
+    assert policy.error_delay(NOW) == 60
+
+
+def test_make_policy():
+    assert isinstance(make_policy('fixed', 60, active_delay=10), FixedPolicy)
+    assert make_policy('adaptive', 60, max_delay=600).max_delay == 600
+    # An option the policy does not support is not silently ignored
+    with pytest.raises(TypeError):
+        make_policy('adaptive', 60, active_delay=10)
+    with pytest.raises(TypeError):
+        make_policy('fixed', 60, settle=10)
+
+
+def test_server_options(workdir):
+    result = husmow(workdir, '--no-daemon', 'server', '--poll', '60', '--schedule', 'adaptive', '--poll-active', '10')
+    assert result.returncode == 2 and '--poll-active only applies to --schedule fixed' in result.stderr
@@ -0,0 +1,243 @@
+import gzip
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+from conftest import mock_args
+
+from pyhusmow.server import StatusCache
+
+STATUS_CALLS = 'GET mowers/<id>/status'
+
+
+@pytest.fixture
+def server(mock, server_factory):
+    return server_factory(mock_args(mock), '--expire', '30')
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_status_cache():
+    cache = StatusCache(expire=0.2)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return {'mowerStatus': 'OK_CUTTING', 'batteryPercent': len(calls)}
+
+    results = []
+    run_threads(lambda: results.append(cache.get(fetch)), 10)
+    # A single fetch, shared by the concurrent misses
+    assert len(calls) == 1
+    assert [cached for _, cached in results].count(False) == 1
+    assert cache.get(fetch) == (results[0][0], True)
+    time.sleep(0.2)
+    entry, cached = cache.get(fetch)
+    assert not cached and entry.status['batteryPercent'] == 2
+
+
+def test_status_cache_error():
+    cache = StatusCache(expire=30)
+    errors = []
+
+    def fetch():
+        time.sleep(0.1)
+        raise RuntimeError('down')
+
+    def get():
+        try:
+            cache.get(fetch)
+        except RuntimeError as ex:
+            errors.append(ex)
+
+    run_threads(get, 5)
+    # The waiting requests get the error of the fetch they waited for
+    assert len(errors) == 5
+    assert cache.get(lambda: {'mowerStatus': 'OK_CUTTING'})[0].status == {'mowerStatus': 'OK_CUTTING'}
+
+
+def test_coalescing(mock_factory, server_factory):
+    # Concurrent requests on an expired status share a single call to the servers
+    mock = mock_factory(latency=0.3)
+    server = server_factory(mock_args(mock), '--expire', '1')
+    results = []
+    run_threads(lambda: results.append(server.request('GET', '/status')[0]), 20)
+    assert results == [200] * 20
+    assert mock.calls(STATUS_CALLS) == 1
+
+
+def test_control(mock, server):
+    assert server.request('GET', '/park')[0] == 200
+    assert mock.calls('POST mowers/<id>/control') == 1
+    assert server.get_json('/status')['mowerStatus'] == 'PARKED_PARKED_SELECTED'
+
+
+def test_mowers(server):
+    mowers = server.get_json('/mowers')
+    assert [mower['name'] for mower in mowers] == ['mower1', 'mower2']
+    statuses = server.get_json('/mowers/status')
+    assert [status['name'] for status in statuses] == ['mower1', 'mower2']
+    assert all(status['status']['mowerStatus'] for status in statuses)
+
+
+def test_status_routes(mock, server):
+    mowers = server.get_json('/mowers')
+    assert server.get_json('/status')['mowerStatus']
+    assert server.get_json('/mowers/mower2/status')['mowerStatus']
+    assert server.get_json('/mowers/%s/status' % mowers[1]['id'])['mowerStatus']
+    assert server.request('GET', '/mowers/unknown/status')[0] == 404
+    assert server.request('GET', '/unknown')[0] == 400
+    # Both mowers fetched once, then served from their own cache
+    assert mock.calls(STATUS_CALLS) == 2
+
+
+def test_mower_control(mock, server):
+    assert server.request('GET', '/mowers/mower2/park')[0] == 200
+    assert [mower.override for mower in mock.state.mowers] == [None, 'PARKED_PARKED_SELECTED']
+
+
+def test_default_mower(mock, server_factory):
+    server = server_factory(mock_args(mock) + ['--mower', 'mower2'])
+    server.request('GET', '/stop')
+    assert [mower.override for mower in mock.state.mowers] == [None, 'PAUSED']
+
+
+def test_poller(mock, server_factory):
+    mock.hold('OK_CUTTING')
+    server = server_factory(mock_args(mock), '--poll', '1')
+    time.sleep(2.5)
+    calls = mock.calls(STATUS_CALLS)
+    # Both mowers polled every second, and the clients served from memory
+    assert calls >= 4
+    for _ in range(10):
+        status, headers, _ = server.request('GET', '/status')
+        assert status == 200 and 'Age' in headers
+    assert mock.calls(STATUS_CALLS) <= calls + 2
+
+
+def test_conditional_get(server):
+    status, headers, body = server.request('GET', '/status')
+    assert status == 200 and headers['ETag'] and headers['Last-Modified']
+    status, _, body = server.request('GET', '/status', headers={'If-None-Match': headers['ETag']})
+    assert status == 304 and body == b''
+    status, _, _ = server.request('GET', '/status', headers={'If-None-Match': 'W/' + headers['ETag']})
+    assert status == 304
+    status, _, _ = server.request('GET', '/status', headers={'If-Modified-Since': headers['Last-Modified']})
+    assert status == 304
+    status, _, _ = server.request('GET', '/status', headers={'If-None-Match': '"other"'})
+    assert status == 200
+
+
+def test_gzip(mock, server_factory):
+    server = server_factory(mock_args(mock), '--gzip')
+    _, identity, body = server.request('GET', '/mowers/status')
+    status, headers, gzipped = server.request('GET', '/mowers/status', headers={'Accept-Encoding': 'gzip'})
+    assert status == 200 and headers['Content-Encoding'] == 'gzip' and headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(gzipped) == body
+    # Each content coding has its own strong validator, and both are recognized
+    assert headers['ETag'] == identity['ETag'][:-1] + '-gzip"'
+    for etag in (identity['ETag'], headers['ETag']):
+        status, headers_304, _ = server.request('GET', '/mowers/status',
+                                                headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        assert status == 304 and headers_304['ETag'] == headers['ETag']
+    status, headers_304, _ = server.request('GET', '/mowers/status', headers={'If-None-Match': headers['ETag']})
+    assert status == 304 and headers_304['ETag'] == identity['ETag']
+
+
+def test_wait_change():
+    cache = StatusCache(expire=None)
+    assert cache.wait_change(0, 0.1) is None
+    cache.get(lambda: {'mowerStatus': 'OK_CUTTING', 'batteryPercent': 90}, force=True)
+    cache.get(lambda: {'mowerStatus': 'OK_CUTTING', 'batteryPercent': 89}, force=True)
+    assert cache.wait_change(0, 0.1).version == 2
+    assert cache.wait_change(1, 0.1).version == 2
+    assert cache.wait_change(2, 0.1) is None
+    # The same status is not a change
+    cache.get(lambda: {'mowerStatus': 'OK_CUTTING', 'batteryPercent': 89}, force=True)
+    assert cache.wait_change(2, 0.1) is None
+    # A version of a previous run of the server: the current change right away
+    assert cache.wait_change(50, 0.1).version == 2
+
+    threading.Timer(0.1, lambda: cache.get(lambda: {'mowerStatus': 'OK_SEARCHING'}, force=True)).start()
+    assert cache.wait_change(2, 5).body.startswith(b'{"version": 3')
+
+
+def test_status_subroutes_do_not_send_commands(mock, server):
+    for command in ('start', 'stop', 'park', 'status'):
+        assert server.request('GET', '/status/%s' % command)[0] == 400
+    assert mock.calls('POST mowers/<id>/control') == 0
+
+
+def test_long_poll(server):
+    change = server.get_json('/status/changes?since=0')
+    assert change['version'] >= 1 and change['mowerStatus']
+    started = time.time()
+    status, _, _ = server.request('GET', '/status/changes?since=%d&timeout=1' % change['version'])
+    assert status == 204 and time.time() - started >= 1
+    # After a restart of the server
+    assert server.get_json('/status/changes?since=%d&timeout=1' % (change['version'] + 50)) == change
+    assert server.request('GET', '/status/changes?since=x')[0] == 400
+
+
+def test_events(server):
+    conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=30)
+    try:
+        # The client reconnects with the id of an event sent by a previous run of the server
+        conn.request('GET', '/mowers/mower2/events', headers={'Last-Event-ID': '50'})
+        response = conn.getresponse()
+        assert response.status == 200 and response.headers['Content-Type'] == 'text/event-stream'
+        lines = [response.fp.readline() for _ in range(3)]
+    finally:
+        conn.close()
+    assert lines[0] == b'id: 1\n' and lines[1] == b'event: status\n'
+    assert json.loads(lines[2][len(b'data: '):])['version'] == 1
+
+
+def post_control(server, orders):
+    body = json.dumps(orders) if not isinstance(orders, str) else orders
+    status, _, response = server.request('POST', '/control', body, {'Content-Type': 'application/json'})
+    return status, json.loads(response) if status == 200 else None
+
+
+def test_batch_control(mock, server):
+    status, results = post_control(server, {'command': 'PARK', 'mowers': ['mower1', 'unknown', 'mower2']})
+    assert status == 200
+    results = {result['name']: result for result in results}
+    assert results['mower1']['success'] and results['mower2']['success']
+    assert not results['unknown']['success']
+    assert mock.calls('POST mowers/<id>/control') == 2
+
+    status, results = post_control(server, [{'mower': 'mower1', 'command': 'start'},
+                                            {'mower': 'mower2', 'command': 'STOP'}])
+    assert [result['success'] for result in results] == [True, True]
+    assert [mower.override for mower in mock.state.mowers] == [None, 'PAUSED']
+    status, results = post_control(server, {'command': 'STOP'})
+    assert [result['name'] for result in results] == ['mower1', 'mower2']
+
+
+def test_batch_control_errors(mock, server):
+    for orders in ('"PARK"', '', '{}', {'mowers': ['mower1']}, {'command': 'PARK', 'mowers': 'mower1'},
+                   [{'mower': 'mower1'}], 'not json'):
+        assert post_control(server, orders)[0] == 400, orders
+    assert server.request('POST', '/other', '{}')[0] == 404
+    assert mock.calls('POST mowers/<id>/control') == 0
+
+
+def test_batch_control_revoked_token(mock, server):
+    assert mock.calls('POST token') == 1
+    with mock.state.lock:
+        mock.state.tokens.clear()
+    status, results = post_control(server, {'command': 'PARK'})
+    assert [result['success'] for result in results] == [True, True]
+    # A single new login for all the mowers
+    assert mock.calls('POST token') == 2
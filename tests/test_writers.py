@@ -0,0 +1,129 @@
+import gzip
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from conftest import logger_args, mock_config
+
+from pyhusmow import status_logger
+from pyhusmow.husmow import TokenConfig
+from pyhusmow.writers import LogWriter, compress_file, parse_size
+
+
+def test_parse_size():
+    assert parse_size('500') == 500
+    assert parse_size('2k') == 2048
+    assert parse_size('1.5M') == 1536 * 1024
+
+
+def test_header_and_append(workdir):
+    writer = LogWriter('log.csv', header='a,b')
+    writer.write_row(1, 2)
+    writer.close()
+    writer = LogWriter('log.csv', header='a,b', append=True)
+    writer.write_row(3, 4)
+    writer.close()
+    assert open('log.csv').read() == 'a,b\n1,2\n3,4\n'
+    # A new run starts a new file
+    LogWriter('log.csv', header='a,b').close()
+    assert open('log.csv').read() == 'a,b\n'
+
+
+def test_flush_interval(workdir):
+    writer = LogWriter('log.csv', header='a,b', flush_interval=0.2)
+    writer.write_row(1, 2)
+    assert writer.flush_due() > 0
+    assert open('log.csv').read() == ''
+    time.sleep(0.2)
+    assert writer.flush_due() <= 0
+    writer.flush()
+    assert writer.flush_due() is None
+    assert open('log.csv').read() == 'a,b\n1,2\n'
+    writer.close()
+
+
+def test_rotate_size(workdir):
+    writer = LogWriter('log.csv', header='a,b', rotate_size=20, flush_interval=0)
+    for i in range(10):
+        writer.write_row(i, 'x' * 5)
+    writer.close()
+    segments = sorted(name for name in os.listdir('.') if name.startswith('log.csv.'))
+    assert len(segments) == 4
+    rows = []
+    for name in segments + ['log.csv']:
+        lines = open(name).read().splitlines()
+        # Each segment starts with the header
+        assert lines[0] == 'a,b'
+        rows.extend(lines[1:])
+    assert sorted(rows, key=lambda row: int(row.split(',')[0])) == ['%d,xxxxx' % i for i in range(10)]
+
+
+def test_rotate_daily(workdir):
+    writer = LogWriter('log.csv', header='a,b', rotate_daily=True)
+    writer.write_row(1, 2)
+    writer.write_row(3, 4)
+    assert not [name for name in os.listdir('.') if name != 'log.csv']
+    # The day changed since the file was opened
+    writer.opened_on = date.today() - timedelta(1)
+    writer.write_row(5, 6)
+    writer.close()
+    rotated, = [name for name in os.listdir('.') if name != 'log.csv']
+    assert open(rotated).read() == 'a,b\n1,2\n3,4\n'
+    assert open('log.csv').read() == 'a,b\n5,6\n'
+
+
+def test_rotate_gzip(workdir):
+    writer = LogWriter('log.csv', header='a,b', rotate_size=10, compression='gzip')
+    writer.write_row(1, 'long enough')
+    writer.write_row(2, 'long enough')
+    writer.close()
+    rotated, = [name for name in os.listdir('.') if name != 'log.csv']
+    assert rotated.endswith('.gz')
+    with gzip.open(rotated, 'rt') as f:
+        assert f.read() == 'a,b\n1,long enough\n'
+    assert open('log.csv').read() == 'a,b\n2,long enough\n'
+
+
+def test_rotate_name_collision(workdir):
+    # Rotated twice in the same second: the segments do not overwrite each other
+    writer = LogWriter('log.csv', rotate_size=1, compression='gzip')
+    for i in range(3):
+        writer.write_row(i)
+    writer.close()
+    assert len([name for name in os.listdir('.') if name.endswith('.gz')]) == 2
+
+
+def test_compress_zstd(workdir):
+    zstandard = pytest.importorskip('zstandard')
+    with open('log.csv', 'w') as f:
+        f.write('a,b\n1,2\n')
+    target = compress_file('log.csv', 'zstd')
+    assert target == 'log.csv.zst' and not os.path.exists('log.csv')
+    with open(target, 'rb') as f:
+        assert zstandard.ZstdDecompressor().stream_reader(f).read() == b'a,b\n1,2\n'
+
+
+def test_compress_errors(workdir, monkeypatch):
+    open('log.csv', 'w').close()
+    with pytest.raises(ValueError):
+        compress_file('log.csv', 'bz2')
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    with pytest.raises(RuntimeError):
+        compress_file('log.csv', 'zstd')
+
+
+def test_logger_flushes_before_a_long_sleep(mock, workdir):
+    # The next poll is far away: the rows are flushed after flush_interval, not at the next write
+    args = logger_args(file='log.csv', delay=30, flush_interval=1)
+    stop_time = datetime.now() + timedelta(0, 4)
+    logger = threading.Thread(target=status_logger.run_logger, args=(TokenConfig(), mock_config(mock), args, stop_time))
+    logger.start()
+    time.sleep(2.5)
+    lines = open('log.csv').read().splitlines()
+    logger.join()
+    assert len(lines) == 3
+    assert len(open('log.csv').read().splitlines()) == 5